@@ -1,20 +1,23 @@
 #! /usr/bin/env python3
 
 import argparse
+import json
 import logging
 import os
-import subprocess
 import sys
 
+from manager import binaries, charts, controller, fleet, plan, release, schema, trace
+from manager.graph import DependencyError
 from manager.kube import Manager
-from manager.utils import objectify, run_command
-from ruamel.yaml import YAML
+from manager.utils import CommandError, PrefixFilter, run_command
 
 logging.basicConfig(
     level=logging.INFO,
-    format=("%(asctime)s [%(levelname)s] %(message)s"),
+    format=("%(asctime)s [%(levelname)s] %(prefix)s%(message)s"),
     datefmt="%Y-%m-%d %H:%M:%S",
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(PrefixFilter())
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +38,63 @@ def arguments():
         type=str,
         help="The config file to load.",
     )
+    parser.add_argument(
+        "--parallelism",
+        action="store",
+        dest="parallelism",
+        default=int(os.getenv("PARALLELISM", 4)),
+        type=int,
+        help="""The number of addons to work on at the same time. Addons only start once the addons
+            they depend on have finished. If not specified, uses PARALLELISM environment variable.""",
+    )
+    parser.add_argument(
+        "--dump-manifests",
+        action="store",
+        dest="dump_manifests",
+        default=os.getenv("DUMP_MANIFESTS"),
+        type=str,
+        help="""Directory to write the raw manifest bundle of every addon to before it is applied.
+            If not specified, uses DUMP_MANIFESTS environment variable.""",
+    )
+    parser.add_argument(
+        "--force-upgrade",
+        action="store_true",
+        dest="force_upgrade",
+        help="""Upgrade every helm release, even when its chart version and values are the same as
+            the deployed revision.""",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        dest="incremental",
+        help="""Only upgrade the addons whose config section or code changed since the last
+            successful run on the cluster, and the addons that depend on them. Each run stores a
+            digest per addon in the addon-manager-digests ConfigMap of kube-system.""",
+    )
+    parser.add_argument(
+        "--print-plan",
+        action="store_true",
+        dest="print_plan",
+        help="""Print the resolved dependency levels of the enabled addons as json, then exit
+            without touching the cluster.""",
+    )
+
+    parser.add_argument(
+        "--trace-file",
+        action="store",
+        dest="trace_file",
+        default=os.getenv("TRACE_FILE"),
+        type=str,
+        help="""Write the timing of every step of the run to this file in the chrome trace format.
+            If not specified, uses TRACE_FILE environment variable.""",
+    )
+    parser.add_argument(
+        "--skip-helm-repos",
+        action="store_true",
+        dest="skip_helm_repos",
+        help="""Don't add and update the helm repos of the config file, they are already up to date.
+            Used by fleet runs, which update the repos once for every cluster.""",
+    )
 
     subparsers = parser.add_subparsers(dest="providers")
 
@@ -44,7 +104,7 @@ def arguments():
         "-a",
         "--action",
         action="store",
-        choices=["create", "delete", "upgrade"],
+        choices=["create", "delete", "plan", "prefetch", "serve", "upgrade"],
         dest="action",
         default=os.getenv("ACTION"),
         type=str,
@@ -97,7 +157,7 @@ def arguments():
         "-a",
         "--action",
         action="store",
-        choices=["create", "delete", "upgrade"],
+        choices=["create", "delete", "plan", "prefetch", "serve", "upgrade"],
         dest="action",
         default=os.getenv("ACTION"),
         type=str,
@@ -143,6 +203,50 @@ def arguments():
             variable.""",
     )
 
+    fleet_parser = subparsers.add_parser(
+        "fleet", help="Run one action on every cluster of a fleet file at the same time."
+    )
+
+    fleet_parser.add_argument(
+        "-a",
+        "--action",
+        action="store",
+        choices=["create", "delete", "plan", "upgrade"],
+        dest="action",
+        default=os.getenv("ACTION"),
+        type=str,
+    )
+    fleet_parser.add_argument(
+        "-f",
+        "--fleet-file",
+        action="store",
+        dest="fleet_file",
+        default=os.getenv("FLEET_FILE", "fleet.yaml"),
+        type=str,
+        help="""The yaml file listing the clusters to manage addons for. If not specified, uses
+            FLEET_FILE environment variable.""",
+    )
+    fleet_parser.add_argument(
+        "-m",
+        "--max-clusters",
+        action="store",
+        dest="max_clusters",
+        default=os.getenv("MAX_CLUSTERS"),
+        type=int,
+        help="""The number of clusters to work on at the same time, all of them if not set in the
+            fleet file either. If not specified, uses MAX_CLUSTERS environment variable.""",
+    )
+    fleet_parser.add_argument(
+        "-n",
+        "--name",
+        action="store",
+        dest="name",
+        default=os.getenv("NAME", "all"),
+        type=str,
+        help="""The name of the resource to work on on every cluster. If not specified, uses NAME
+            environment variable.""",
+    )
+
     args = parser.parse_args()
 
     if args.providers == None:
@@ -158,6 +262,11 @@ def arguments():
         if None in [args.cluster, args.project]:
             parser.print_help()
             sys.exit(1)
+
+    if args.providers == "fleet":
+        if None in [args.action]:
+            fleet_parser.print_help()
+            sys.exit(1)
     return args
 
 
@@ -165,15 +274,16 @@ def check_required_binaries(config):
     """
     Verify that the required binaries are present on the executing system.
     """
-    binaries = True
-    for binary in config.required_binaries:
-        bin = subprocess.getoutput(f"which {binary}")
-        if not bin:
-            binaries = False
+    found = True
+    for binary in binaries.configure(config.required_binaries):
+        try:
+            logger.info("Using %s %s", binaries.path(binary), binaries.version(binary))
+        except binaries.MissingBinary:
+            found = False
             logger.error(
                 f"You are missing the binary {binary}, check the config file for a link to install the binary."
             )
-    if not binaries:
+    if not found:
         logger.error("Please install the missing binaries, then run addon_manager.py")
         sys.exit(1)
 
@@ -183,8 +293,10 @@ def update_kubeconfig(args):
     Update the local kubeconfig so we can work with the k8s cluster.
     """
     if args.providers == "gcp":
-        gcloud = subprocess.getoutput("which gcloud")
-        run_command([gcloud, "config", "set", "project", args.project])
+        gcloud = binaries.path("gcloud")
+        # fleet runs pin the project through the environment instead of the shared gcloud config
+        if os.getenv("CLOUDSDK_CORE_PROJECT") != args.project:
+            run_command([gcloud, "config", "set", "project", args.project])
         run_command(
             [
                 gcloud,
@@ -198,7 +310,7 @@ def update_kubeconfig(args):
         )
 
     if args.providers == "aws":
-        aws = subprocess.getoutput("which aws")
+        aws = binaries.path("aws")
         run_command(
             [
                 aws,
@@ -214,12 +326,19 @@ def update_kubeconfig(args):
         )
 
 
-def main():
-    args = arguments()
-
-    with open(args.config) as f:
-        config = objectify(YAML().load(f))
-    addons_manager = Manager(args=args, config=config)
+def run_action(args, config, addons_manager):
+    """
+    Prepare the helm repos and the kubeconfig the action needs, then run it.
+    """
+    if args.action == "plan":
+        update_kubeconfig(args)
+        print(plan.report(addons_manager.diff(args.name)))
+        return
+    if not args.skip_helm_repos:
+        addons_manager.add_helm_repos(config.helm.repos, config.helm.repo_ttl, args.name)
+    if args.action == "prefetch":
+        addons_manager.prefetch(args.name)
+        return
     update_kubeconfig(args)
 
     if args.action == "create":
@@ -228,6 +347,56 @@ def main():
         addons_manager.delete(args.name)
     if args.action == "upgrade":
         addons_manager.upgrade(args.name)
+    if args.action == "serve":
+        controller.serve(args, args.config, addons_manager, config)
+
+
+def run_fleet(args):
+    """
+    Run the action on every cluster of the fleet file, then summarize the result per cluster.
+    """
+    try:
+        results = fleet.run(args, os.path.abspath(__file__))
+    except (OSError, ValueError, binaries.MissingBinary, schema.ConfigError) as err:
+        logger.error(err)
+        sys.exit(1)
+    print(fleet.summary(results))
+    if any(result["returncode"] != 0 for result in results):
+        sys.exit(1)
+
+
+def main():
+    args = arguments()
+    if args.providers == "fleet":
+        run_fleet(args)
+        return
+
+    try:
+        config = schema.load(args.config)
+        addons_manager = Manager(args=args, config=config)
+    except (schema.ConfigError, DependencyError) as err:
+        logger.error(err)
+        sys.exit(1)
+
+    if args.print_plan:
+        print(json.dumps(addons_manager.plan(), indent=2))
+        return
+
+    check_required_binaries(config)
+    release.configure(force=args.force_upgrade)
+    charts.configure(config.helm.chart_cache.directory, config.helm.chart_cache.max_size)
+    trace.configure(action=args.action)
+    try:
+        run_action(args, config, addons_manager)
+    except CommandError as err:
+        for line in err.result.tail:
+            logger.error("%s", line)
+        logger.error(err)
+        sys.exit(1)
+    finally:
+        logger.info("Run report for %s:\n%s", args.action, trace.summary())
+        if args.trace_file:
+            trace.write(args.trace_file)
 
 
 if __name__ == "__main__":
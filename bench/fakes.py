@@ -0,0 +1,434 @@
+"""
+In process stand-ins for the kubernetes api and the aws apis, for bench/run.py.
+"""
+import threading
+import time
+
+
+class Counter(object):
+    def __init__(self):
+        """
+        Thread safe call counter.
+        """
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def add(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+
+    def total(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+class FakeResource(object):
+    def __init__(self, api_version, kind):
+        """
+        The api resource of a kind, cluster scoped kinds are the ones without a namespace.
+        """
+        self.api_version = api_version
+        self.kind = kind
+        self.namespaced = kind not in CLUSTER_KINDS
+
+
+class FakeObject(object):
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+
+class FakeClient(object):
+    def __init__(self, engine):
+        """
+        The part of the dynamic client the waits and the cluster state read.
+        """
+        self.engine = engine
+
+    def get(self, resource, name=None, namespace=None, label_selector=None):
+        """
+        Every object exists and is ready, so waits return on the first read. Lists return the
+        objects applied so far.
+        """
+        self.engine.request(f"get {resource.kind}")
+        if name is None:
+            with self.engine.lock:
+                items = [
+                    obj
+                    for (api_version, kind, scope, _), obj in self.engine.objects.items()
+                    if (api_version, kind) == (resource.api_version, resource.kind)
+                    and namespace in [None, scope]
+                ]
+            return FakeObject({"metadata": {"resourceVersion": "1"}, "items": items})
+        return FakeObject(
+            {
+                "metadata": {"name": name, "namespace": namespace, "resourceVersion": "1"},
+                "spec": {"replicas": 1},
+                "status": {
+                    "observedGeneration": 1,
+                    "updatedReplicas": 1,
+                    "conditions": [
+                        {"type": condition, "status": "True"}
+                        for condition in ["Available", "Established", "Ready"]
+                    ],
+                },
+                "subsets": [{"addresses": [{"ip": "10.0.0.1"}]}],
+            }
+        )
+
+    def watch(self, *args, **kwargs):
+        return iter([])
+
+
+class FakeEngine(object):
+    def __init__(self, latency=0.0):
+        """
+        Replaces manager.apply.ApplyEngine: every request takes latency seconds and is counted.
+        The objects created or applied are kept for list calls.
+        """
+        self.latency = latency
+        self.counter = Counter()
+        self.client = FakeClient(self)
+        self.resources = {}
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def apply(self, manifest, action="apply"):
+        self.request(f"{action} {manifest['kind']}")
+        metadata = manifest["metadata"]
+        key = (manifest["apiVersion"], manifest["kind"], metadata.get("namespace"), metadata["name"])
+        with self.lock:
+            if action == "delete":
+                self.objects.pop(key, None)
+            elif action == "apply" or key not in self.objects:
+                self.objects[key] = manifest
+
+    def apply_all(self, manifests, action="apply"):
+        for manifest in manifests:
+            self.apply(manifest, action)
+
+    def cleanup(self):
+        return
+
+    def request(self, name):
+        self.counter.add(name)
+        time.sleep(self.latency)
+
+    def resource(self, api_version, kind):
+        with self.lock:
+            return self.resources.setdefault(
+                (api_version, kind), FakeResource(api_version, kind)
+            )
+
+
+class FakeModel(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeEvents(object):
+    def __init__(self):
+        self.handlers = {}
+
+    def emit(self, event, **kwargs):
+        for handler in self.handlers.get(event, []):
+            handler(**kwargs)
+
+    def register(self, event, handler):
+        self.handlers.setdefault(event, []).append(handler)
+
+
+class FakeServiceModel(object):
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+
+class FakeMeta(object):
+    def __init__(self, service):
+        self.events = FakeEvents()
+        self.service_model = FakeServiceModel(service)
+
+
+class FakeAwsError(Exception):
+    """
+    Base of the modeled errors of the fake clients, like botocore's ClientError.
+    """
+
+
+class FakeExceptions(object):
+    class NoSuchEntityException(FakeAwsError):
+        pass
+
+    class EntityAlreadyExistsException(FakeAwsError):
+        pass
+
+    class DeleteConflictException(FakeAwsError):
+        pass
+
+    class ResourceNotFoundException(FakeAwsError):
+        pass
+
+
+class FakeWaiter(object):
+    def __init__(self, client, name):
+        """
+        Replaces a boto3 waiter: polls the operation of the waiter until it succeeds, or until
+        it fails with not found for the waiters of deletes.
+        """
+        self.client = client
+        self.operation, self.gone = WAITERS[name]
+
+    def wait(self, WaiterConfig=None, **kwargs):
+        config = dict({"Delay": 1, "MaxAttempts": 20}, **(WaiterConfig or {}))
+        for _ in range(config["MaxAttempts"]):
+            try:
+                getattr(self.client, self.operation)(**kwargs)
+                if not self.gone:
+                    return
+            except (FakeExceptions.NoSuchEntityException, FakeExceptions.ResourceNotFoundException):
+                if self.gone:
+                    return
+            time.sleep(config["Delay"])
+        raise FakeAwsError(f"Waiter for {self.operation} gave up")
+
+
+class FakeAws(object):
+    def __init__(self, account="000000000000"):
+        """
+        Account state shared by the fake clients of one bench run, enough of iam, sts and eks
+        for manager/iam.py and cluster_autoscaler: policies with their versions and attachment
+        counts, roles with their attached policies, one oidc provider per cluster and fargate
+        profiles, which become active or go away as soon as they are created or deleted.
+        """
+        self.account = account
+        self.policies = {}
+        self.roles = {}
+        self.fargate_profiles = {}
+        self.lock = threading.Lock()
+
+    def get_caller_identity(self):
+        return {"Account": self.account, "Arn": f"arn:aws:iam::{self.account}:user/bench"}
+
+    def create_policy(self, PolicyName, PolicyDocument):
+        arn = f"arn:aws:iam::{self.account}:policy/{PolicyName}"
+        with self.lock:
+            if arn in self.policies:
+                raise FakeExceptions.EntityAlreadyExistsException(arn)
+            self.policies[arn] = {
+                "Arn": arn,
+                "PolicyName": PolicyName,
+                "AttachmentCount": 0,
+                "Versions": [{"VersionId": "v1", "IsDefaultVersion": True}],
+            }
+            return {"Policy": self.policy(arn)}
+
+    def get_policy(self, PolicyArn):
+        with self.lock:
+            return {"Policy": self.policy(PolicyArn)}
+
+    def list_policy_versions(self, PolicyArn):
+        with self.lock:
+            self.policy(PolicyArn)
+            return {"Versions": list(self.policies[PolicyArn]["Versions"])}
+
+    def delete_policy_version(self, PolicyArn, VersionId):
+        with self.lock:
+            self.policy(PolicyArn)
+            versions = self.policies[PolicyArn]["Versions"]
+            self.policies[PolicyArn]["Versions"] = [
+                v for v in versions if v["VersionId"] != VersionId
+            ]
+            return {}
+
+    def delete_policy(self, PolicyArn):
+        with self.lock:
+            policy = self.policy(PolicyArn)
+            if policy["AttachmentCount"] or len(self.policies[PolicyArn]["Versions"]) > 1:
+                raise FakeExceptions.DeleteConflictException(PolicyArn)
+            del self.policies[PolicyArn]
+            return {}
+
+    def policy(self, arn):
+        if arn not in self.policies:
+            raise FakeExceptions.NoSuchEntityException(arn)
+        return {k: v for k, v in self.policies[arn].items() if k != "Versions"}
+
+    def create_role(self, RoleName, AssumeRolePolicyDocument, Description=""):
+        with self.lock:
+            if RoleName in self.roles:
+                raise FakeExceptions.EntityAlreadyExistsException(RoleName)
+            arn = f"arn:aws:iam::{self.account}:role/{RoleName}"
+            self.roles[RoleName] = {"Arn": arn, "RoleName": RoleName, "Policies": []}
+            return {"Role": self.role(RoleName)}
+
+    def get_role(self, RoleName):
+        with self.lock:
+            return {"Role": self.role(RoleName)}
+
+    def update_assume_role_policy(self, RoleName, PolicyDocument):
+        with self.lock:
+            self.role(RoleName)
+            return {}
+
+    def attach_role_policy(self, RoleName, PolicyArn):
+        with self.lock:
+            self.role(RoleName)
+            policies = self.roles[RoleName]["Policies"]
+            if PolicyArn not in policies:
+                policies.append(PolicyArn)
+                if PolicyArn in self.policies:
+                    self.policies[PolicyArn]["AttachmentCount"] += 1
+            return {}
+
+    def detach_role_policy(self, RoleName, PolicyArn):
+        with self.lock:
+            self.role(RoleName)
+            self.roles[RoleName]["Policies"].remove(PolicyArn)
+            if PolicyArn in self.policies:
+                self.policies[PolicyArn]["AttachmentCount"] -= 1
+            return {}
+
+    def list_attached_role_policies(self, RoleName):
+        with self.lock:
+            self.role(RoleName)
+            return {
+                "AttachedPolicies": [
+                    {"PolicyArn": arn, "PolicyName": arn.split("/")[-1]}
+                    for arn in self.roles[RoleName]["Policies"]
+                ]
+            }
+
+    def list_role_policies(self, RoleName):
+        with self.lock:
+            self.role(RoleName)
+            return {"PolicyNames": []}
+
+    def delete_role(self, RoleName):
+        with self.lock:
+            self.role(RoleName)
+            if self.roles[RoleName]["Policies"]:
+                raise FakeExceptions.DeleteConflictException(RoleName)
+            del self.roles[RoleName]
+            return {}
+
+    def role(self, name):
+        if name not in self.roles:
+            raise FakeExceptions.NoSuchEntityException(name)
+        return {k: v for k, v in self.roles[name].items() if k != "Policies"}
+
+    def get_open_id_connect_provider(self, OpenIDConnectProviderArn):
+        return {"ClientIDList": ["sts.amazonaws.com"]}
+
+    def describe_cluster(self, name):
+        issuer = f"https://oidc.eks.us-west-2.amazonaws.com/id/{name.upper()}"
+        return {"cluster": {"name": name, "identity": {"oidc": {"issuer": issuer}}}}
+
+    def create_fargate_profile(self, clusterName, fargateProfileName, **kwargs):
+        with self.lock:
+            profile = dict(kwargs, fargateProfileName=fargateProfileName, status="ACTIVE")
+            self.fargate_profiles[(clusterName, fargateProfileName)] = profile
+            return {"fargateProfile": profile}
+
+    def describe_fargate_profile(self, clusterName, fargateProfileName):
+        with self.lock:
+            return {"fargateProfile": self.fargate_profile(clusterName, fargateProfileName)}
+
+    def delete_fargate_profile(self, clusterName, fargateProfileName):
+        with self.lock:
+            profile = self.fargate_profile(clusterName, fargateProfileName)
+            del self.fargate_profiles[(clusterName, fargateProfileName)]
+            return {"fargateProfile": profile}
+
+    def fargate_profile(self, cluster, name):
+        if (cluster, name) not in self.fargate_profiles:
+            raise FakeExceptions.ResourceNotFoundException(name)
+        return self.fargate_profiles[(cluster, name)]
+
+
+class FakeAwsClient(object):
+    exceptions = FakeExceptions
+
+    def __init__(self, service, counter, latency=0.0, state=None):
+        """
+        Replaces a boto3 client: every operation takes latency seconds, is counted, fires the
+        botocore before-call and after-call events and is answered from the shared account state.
+        """
+        self.counter = counter
+        self.latency = latency
+        self.meta = FakeMeta(service)
+        self.service = service
+        self.state = state or FakeAws()
+
+    def get_waiter(self, name):
+        return FakeWaiter(self, name)
+
+    def __getattr__(self, operation):
+        if operation.startswith("_") or operation not in OPERATIONS.get(self.service, []):
+            raise AttributeError(operation)
+
+        def call(**kwargs):
+            model = FakeModel("".join(word.capitalize() for word in operation.split("_")))
+            context = {}
+            self.meta.events.emit("before-call", context=context, model=model)
+            self.counter.add(f"{self.service} {operation}")
+            time.sleep(self.latency)
+            try:
+                return getattr(self.state, operation)(**kwargs)
+            finally:
+                self.meta.events.emit(
+                    "after-call", context=context, model=model, http_response=None
+                )
+
+        return call
+
+
+OPERATIONS = {
+    "eks": [
+        "create_fargate_profile",
+        "delete_fargate_profile",
+        "describe_cluster",
+        "describe_fargate_profile",
+    ],
+    "iam": [
+        "attach_role_policy",
+        "create_policy",
+        "create_role",
+        "delete_policy",
+        "delete_policy_version",
+        "delete_role",
+        "detach_role_policy",
+        "get_open_id_connect_provider",
+        "get_policy",
+        "get_role",
+        "list_attached_role_policies",
+        "list_policy_versions",
+        "list_role_policies",
+        "update_assume_role_policy",
+    ],
+    "sts": ["get_caller_identity"],
+}
+# Waiters by name: the operation polled and whether the waiter waits for not found.
+WAITERS = {
+    "fargate_profile_active": ("describe_fargate_profile", False),
+    "fargate_profile_deleted": ("describe_fargate_profile", True),
+    "policy_exists": ("get_policy", False),
+    "role_exists": ("get_role", False),
+}
+
+CLUSTER_KINDS = [
+    "ClusterIssuer",
+    "ClusterRole",
+    "ClusterRoleBinding",
+    "CustomResourceDefinition",
+    "MutatingWebhookConfiguration",
+    "Namespace",
+    "PriorityClass",
+    "RBACDefinition",
+    "ValidatingWebhookConfiguration",
+]
@@ -0,0 +1,302 @@
+#! /usr/bin/env python3
+"""
+Measure the orchestration overhead of the addon manager without a cluster or a cloud account.
+
+helm, kubectl, ouctl, eksctl and the cloud clis are replaced by bench/stub.py with a fixed
+latency per call, the kubernetes api and boto3 by the fakes of bench/fakes.py. Every enabled
+addon of each config is then installed, upgraded with --force-upgrade, upgraded again with
+nothing changed and deleted, at each parallelism. For every step this reports the wall clock,
+the processes spawned, the bytes handed to them through stdin and temp files, the temp files
+created, and the api and aws calls made.
+
+    python bench/run.py
+    python bench/run.py --latency 0.2 --parallelism 1 --parallelism 4 --json bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from argparse import Namespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import boto3  # noqa: E402
+
+import manager.apply  # noqa: E402
+from fakes import Counter, FakeAws, FakeAwsClient, FakeEngine  # noqa: E402
+from manager import binaries, charts, release, schema, trace  # noqa: E402
+from manager.kube import Manager  # noqa: E402
+
+BINARIES = ["aws", "eksctl", "gcloud", "helm", "kubectl", "op", "ouctl"]
+
+# Values the addons read from the environment.
+ENVIRONMENT = {
+    "CF_API_KEY": "bench",
+    "ECR_ACCESS_KEY": "bench",
+    "ECR_SECRET_ACCESS_KEY": "bench",
+    "OAUTH_CLIENT_SECRET": "bench",
+    "OP_CONNECT_TOKEN": "bench",
+    "OPENUNISON_SVC_ACCOUNT": "YmVuY2g=",
+    "SISU_CA_CERT": "YmVuY2g=",
+    "SISU_CA_KEY": "YmVuY2g=",
+    "SUMO_ACCESS_ID": "bench",
+    "SUMO_ACCESS_KEY": "bench",
+    "VAULT_APPROLE_ROLE_ID": "bench",
+    "VAULT_APPROLE_SECRET_ID": "bench",
+}
+
+COLUMNS = [
+    ("config", "CONFIG"),
+    ("parallelism", "PAR"),
+    ("step", "STEP"),
+    ("seconds", "SECONDS"),
+    ("spawns", "SPAWNS"),
+    ("stdin_bytes", "STDIN B"),
+    ("temp_bytes", "TEMP B"),
+    ("temp_files", "TEMP FILES"),
+    ("api_calls", "API"),
+    ("aws_calls", "AWS"),
+]
+
+_temp_files = Counter()
+
+
+def arguments():
+    """
+    Init argparer and parse arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the addon manager against stubs.")
+    parser.add_argument(
+        "--config",
+        action="append",
+        dest="configs",
+        help="Config file to benchmark, repeat for several. Defaults to both shipped configs.",
+    )
+    parser.add_argument(
+        "--latency",
+        action="store",
+        default=0.05,
+        type=float,
+        help="Seconds every stubbed binary takes.",
+    )
+    parser.add_argument(
+        "--api-latency",
+        action="store",
+        dest="api_latency",
+        default=0.01,
+        type=float,
+        help="Seconds every kubernetes and aws api call takes.",
+    )
+    parser.add_argument(
+        "--parallelism",
+        action="append",
+        type=int,
+        help="Parallelism to run the addons with, repeat for several. Defaults to 1 and 4.",
+    )
+    parser.add_argument(
+        "--json", action="store", dest="json", help="Write the results to this json file."
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the log of the addon manager."
+    )
+    args = parser.parse_args()
+    args.configs = args.configs or ["config.yaml", "config-remote-dataplane.yaml"]
+    args.parallelism = args.parallelism or [1, 4]
+    return args
+
+
+def audit(event, args):
+    """
+    Count the files opened for writing in a temp directory by the addon manager itself.
+    """
+    if event != "open" or not isinstance(args[0], str):
+        return
+    path, mode, flags = args
+    writing = mode and any(m in mode for m in "wax")
+    writing = writing or (flags or 0) & (os.O_WRONLY | os.O_RDWR)
+    if writing and any(path.startswith(d) for d in [tempfile.gettempdir(), "/dev/shm"]):
+        _temp_files.add(path)
+
+
+def install_stubs(workdir):
+    """
+    Create a wrapper per binary that runs bench/stub.py, return the directory to put on the PATH.
+    """
+    bin_dir = os.path.join(workdir, "bin")
+    os.makedirs(bin_dir)
+    stub = os.path.join(ROOT, "bench", "stub.py")
+    for binary in BINARIES:
+        path = os.path.join(bin_dir, binary)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{stub}" {binary} "$@"\n')
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_dir
+
+
+def measure(step, log, engine, aws, run):
+    """
+    Run one step and return what it cost.
+    """
+    offset = os.path.getsize(log) if os.path.exists(log) else 0
+    engine.counter.reset()
+    aws.reset()
+    _temp_files.reset()
+    error = None
+    start = time.monotonic()
+    try:
+        run()
+    except Exception as err:
+        # keep going, the cost of the steps that did run is still worth reporting
+        error = f"{type(err).__name__}: {err}"
+    seconds = time.monotonic() - start
+
+    calls = []
+    if os.path.exists(log):
+        with open(log) as f:
+            f.seek(offset)
+            calls = [json.loads(line) for line in f if line.strip()]
+    spawns = {}
+    for call in calls:
+        spawns[call["binary"]] = spawns.get(call["binary"], 0) + 1
+    return {
+        "step": step,
+        "seconds": round(seconds, 3),
+        "spawns": len(calls),
+        "spawns_by_binary": spawns,
+        "stdin_bytes": sum(call["stdin"] for call in calls),
+        "temp_bytes": sum(call["temp_bytes"] for call in calls),
+        "temp_files": _temp_files.total(),
+        "api_calls": engine.counter.total(),
+        "aws_calls": aws.total(),
+        "error": error,
+    }
+
+
+def bench(path, parallelism, args, workdir):
+    """
+    Run every step for one config at one parallelism, against a fresh stub cluster.
+    """
+    config = schema.load(path)
+    state = tempfile.mkdtemp(prefix="state-", dir=workdir)
+    log = os.path.join(state, "calls.log")
+    os.environ["BENCH_STATE"] = state
+    os.environ["BENCH_LOG"] = log
+
+    engine = FakeEngine(args.api_latency)
+    manager.apply._engine = engine
+    aws = Counter()
+    account = FakeAws()
+    boto3.client = lambda service, *a, **kw: FakeAwsClient(
+        service, aws, args.api_latency, account
+    )
+
+    binaries.configure(config.required_binaries)
+    release.configure(force=False)
+    charts.configure(os.path.join(state, "charts"))
+    trace.configure()
+
+    cli = Namespace(
+        providers="aws",
+        cluster="bench-cluster",
+        environment="default",
+        region="us-west-2",
+        name="all",
+        parallelism=parallelism,
+        dump_manifests=None,
+    )
+    addons = Manager(args=cli, config=config)
+    ttl = config.helm.repo_ttl
+    steps = [
+        ("helm repos (cold)", lambda: addons.add_helm_repos(config.helm.repos, ttl)),
+        ("helm repos (warm)", lambda: addons.add_helm_repos(config.helm.repos, ttl)),
+        ("create", lambda: addons.install("all")),
+        ("upgrade (forced)", lambda: upgrade(addons, force=True)),
+        ("upgrade (no changes)", lambda: upgrade(addons, force=False)),
+        ("create (existing)", lambda: addons.install("all")),
+        ("delete", lambda: addons.delete("all")),
+    ]
+    results = []
+    for step, run in steps:
+        result = measure(step, log, engine, aws, run)
+        result.update(config=os.path.basename(path), parallelism=parallelism)
+        results.append(result)
+    return results
+
+
+def upgrade(addons, force):
+    """
+    Upgrade every addon, force upgrades releases that haven't changed too.
+    """
+    release.configure(force=force)
+    try:
+        addons.upgrade("all")
+    finally:
+        release.configure(force=False)
+
+
+def table(results):
+    """
+    Render the results as a table.
+    """
+    rows = [[title for _, title in COLUMNS]]
+    for result in results:
+        rows.append([str(result[key]) for key, _ in COLUMNS])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+    lines = [
+        "  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows
+    ]
+    for result in results:
+        if result["error"]:
+            lines.append(
+                f"{result['config']} {result['parallelism']} {result['step']} failed: "
+                f"{result['error']}"
+            )
+    return "\n".join(lines)
+
+
+def main():
+    args = arguments()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.ERROR,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+    configs = [os.path.abspath(path) for path in args.configs]
+    output = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="addon-manager-bench-")
+    try:
+        os.environ.update(ENVIRONMENT)
+        os.environ["BENCH_LATENCY"] = str(args.latency)
+        os.environ["PATH"] = f"{install_stubs(workdir)}{os.pathsep}{os.environ['PATH']}"
+        # the addons read assets and credentials relative to the working directory
+        shutil.copytree(os.path.join(ROOT, "assets"), os.path.join(workdir, "assets"))
+        with open(os.path.join(workdir, "1password-credentials.json"), "w") as f:
+            f.write("{}")
+        os.chdir(workdir)
+        sys.addaudithook(audit)
+
+        results = []
+        for path in configs:
+            for parallelism in args.parallelism:
+                results.extend(bench(path, parallelism, args, workdir))
+        print(table(results))
+        if output:
+            with open(output, "w") as f:
+                json.dump(
+                    {"latency": args.latency, "api_latency": args.api_latency, "results": results},
+                    f,
+                    indent=2,
+                )
+        return 1 if any(result["error"] for result in results) else 0
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
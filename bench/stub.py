@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Stand-in for helm, kubectl, ouctl, eksctl and the cloud clis. bench/run.py puts a wrapper
+named after each binary first on the PATH that runs `stub.py <binary> <args>`. Every call
+sleeps BENCH_LATENCY seconds and appends one json line (binary, args, stdin bytes, temp file
+bytes) to BENCH_LOG. helm keeps just
+enough release and repo state in BENCH_STATE for no-op upgrades, the repo cache and the chart
+cache to behave like they do against a cluster.
+"""
+import fcntl
+import json
+import os
+import sys
+import time
+
+TEMP_DIRS = ["/dev/shm", os.getenv("TMPDIR") or "/tmp"]
+# helm flags followed by a value.
+VALUE_FLAGS = [
+    "--destination",
+    "--filter",
+    "--namespace",
+    "--output",
+    "--set-file",
+    "--values",
+    "--version",
+]
+
+
+def main():
+    binary = sys.argv[1]
+    args = sys.argv[2:]
+    stdin = ""
+    if "-" in args or binary == "kubectl" and "-f" in args and option(args, "-f") == "-":
+        stdin = sys.stdin.read()
+    temp_bytes = sum(
+        os.path.getsize(arg)
+        for arg in args
+        if os.path.isfile(arg) and any(arg.startswith(d) for d in TEMP_DIRS)
+    )
+    with open(os.environ["BENCH_LOG"], "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(
+            json.dumps(
+                {"binary": binary, "args": args, "stdin": len(stdin), "temp_bytes": temp_bytes}
+            )
+            + "\n"
+        )
+    time.sleep(float(os.getenv("BENCH_LATENCY", "0")))
+    if binary == "helm":
+        sys.exit(helm(args, stdin))
+
+
+def helm(args, stdin):
+    """
+    Answer the helm calls addon_manager.py reads the output of.
+    """
+    state = os.environ["BENCH_STATE"]
+    os.makedirs(state, exist_ok=True)
+    namespace = option(args, "--namespace") or "default"
+    words = positional(args)
+    with open(os.path.join(state, "lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        repos = load(os.path.join(state, "repos.json"), {})
+        if words[:1] == ["env"]:
+            print(f'HELM_REPOSITORY_CACHE="{os.path.join(state, "repository")}"')
+        elif words[:2] == ["repo", "list"]:
+            if not repos:
+                return 1
+            print(json.dumps([{"name": name, "url": url} for name, url in repos.items()]))
+        elif words[:2] == ["repo", "add"]:
+            repos[words[2]] = words[3]
+            save(os.path.join(state, "repos.json"), repos)
+            touch(os.path.join(state, "repository", f"{words[2]}-index.yaml"))
+        elif words[:2] == ["repo", "update"]:
+            for name in words[2:] or list(repos):
+                touch(os.path.join(state, "repository", f"{name}-index.yaml"))
+        elif words[:1] == ["pull"]:
+            chart, version = words[1], option(args, "--version")
+            path = os.path.join(option(args, "--destination"), f"{chart.split('/')[-1]}.tgz")
+            with open(path, "w") as f:
+                f.write(f"{chart} {version}\n")
+        elif words[:1] == ["upgrade"] or words[:1] == ["install"]:
+            release, chart = words[1], words[2]
+            path = os.path.join(state, f"release-{namespace}-{release}.json")
+            existing = load(path, None)
+            # fail like helm does on the releases it refuses to touch
+            if words[0] == "install" and existing:
+                print("Error: INSTALLATION FAILED: cannot re-use a name that is still in use")
+                return 1
+            if words[0] == "upgrade" and not existing and "--install" not in args:
+                print(f'Error: UPGRADE FAILED: "{release}" has no deployed releases')
+                return 1
+            version = option(args, "--version")
+            if chart.endswith(".tgz"):
+                with open(chart) as f:
+                    chart, version = f.read().split()
+            values = json.loads(stdin) if stdin.lstrip().startswith("{") else parse(stdin)
+            save(
+                path,
+                {
+                    "name": release,
+                    "namespace": namespace,
+                    "revision": str(int((existing or {}).get("revision", 0)) + 1),
+                    "status": "deployed",
+                    "chart": f"{chart.split('/')[-1]}-{version or '0.0.0'}",
+                    "values": values,
+                },
+            )
+        elif words[:1] == ["list"]:
+            releases = []
+            prefix = "release-" if "--all-namespaces" in args else f"release-{namespace}-"
+            for name in os.listdir(state):
+                if name.startswith(prefix):
+                    release = load(os.path.join(state, name), {})
+                    releases.append({k: v for k, v in release.items() if k != "values"})
+            wanted = option(args, "--filter")
+            if wanted:
+                releases = [r for r in releases if r["name"] == wanted.strip("^$")]
+            print(json.dumps(releases))
+        elif words[:2] == ["get", "values"]:
+            path = os.path.join(state, f"release-{namespace}-{words[2]}.json")
+            if not os.path.exists(path):
+                return 1
+            print(json.dumps(load(path, {})["values"]))
+        elif words[:1] in [["delete"], ["uninstall"]]:
+            path = os.path.join(state, f"release-{namespace}-{words[1]}.json")
+            if os.path.exists(path):
+                os.unlink(path)
+    return 0
+
+
+def load(path, default):
+    """
+    Read a json state file, default if it doesn't exist.
+    """
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def option(args, name):
+    """
+    Return the value following a flag, None if the flag isn't passed.
+    """
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return None
+
+
+def positional(args):
+    """
+    Return the arguments that are neither flags nor flag values.
+    """
+    words = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in VALUE_FLAGS:
+            skip = True
+        elif not arg.startswith("-"):
+            words.append(arg)
+    return words
+
+
+def parse(document):
+    """
+    Parse helm values the way helm does, yaml is only imported when values are passed.
+    """
+    if not document.strip():
+        return {}
+    from ruamel.yaml import YAML
+
+    return json.loads(json.dumps(YAML(typ="safe").load(document) or {}, default=str))
+
+
+def save(path, data):
+    """
+    Write a json state file.
+    """
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def touch(path):
+    """
+    Write an empty repo index.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("entries: {}\n")
+
+
+if __name__ == "__main__":
+    main()
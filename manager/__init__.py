@@ -1,16 +1,59 @@
-import subprocess
+import logging
 
+from . import binaries, charts, recorder, release as releases, state, values as layers
+from .apply import engine
+from .bundle import Bundle
+from .executor import run_all
+from . import utils
 from .utils import run_command
 
+logger = logging.getLogger(__name__)
+
 
 class BaseManager(object):
+    # Helm repos the charts of the addon come from, None refreshes every repo of the config.
+    repos = None
+
     def __init__(self, **kwargs):
         self.kwargs = kwargs
         self.post_init()
 
+    def bundle(self):
+        """
+        Start an empty manifest bundle for this addon.
+        """
+        args = self.kwargs.get("args")
+        name = self.kwargs.get("name")
+        return Bundle(name, dump_dir=getattr(args, "dump_manifests", None), owner=name)
+
     def install(self):
         raise NotImplementedError
 
+    def run_releases(self, releases):
+        """
+        Run the independent helm releases ({name: callable}) of this addon at the same time, as
+        many at once as the parallelism of the run allows.
+        """
+        args = self.kwargs.get("args")
+        run_all(releases, getattr(args, "parallelism", 1))
+
+    def layer_values(self, release, *base, providers=None):
+        """
+        Build the helm values of a release from layers, deep merged in order: the base layers, the
+        overlay of the provider of the run from providers ({provider: values}), then the values of
+        the release set for every cluster (values.<release>) and for this cluster only
+        (cluster_values.<cluster>.<release>) in the config of the addon.
+        """
+        args = self.kwargs.get("args")
+        config = self.kwargs.get("config")
+        cluster = config.cluster_values.get(getattr(args, "cluster", None)) or {}
+        return layers.layer(
+            *base,
+            (providers or {}).get(getattr(args, "providers", None)),
+            config.values.get(release),
+            cluster.get(release),
+        )
+
     def post_init(self):
         return
 
@@ -24,11 +67,40 @@ def helm(
     version=None,
     license_file=None,
     noout=None,
+    check=None,
 ):
     """
-    Pass through method to execute a helm command.
+    Pass through method to execute a helm command. values is the values object for the chart, it
+    is streamed to helm on stdin instead of going through a file. Upgrades that wouldn't change
+    the deployed release are skipped, so are installs of a release that is already deployed,
+    other installs run as upgrade --install to take over a failed one. Pinned chart versions are
+    installed from the local chart cache. A failing command raises CommandError, except for
+    deletes unless check is set: a release that is already gone is not an error. While recording
+    a plan the release is only recorded.
     """
-    command = [subprocess.getoutput("which helm")]
+    if recorder.active():
+        recorder.active().releases.append(
+            {
+                "action": action,
+                "namespace": namespace,
+                "release": release,
+                "chart": chart,
+                "version": version,
+                "values": values,
+            }
+        )
+        return
+    if action == "upgrade" and releases.unchanged(release, namespace, chart, version, values):
+        return
+    if action == "install" and releases.listed(release, namespace):
+        logger.info("%s is already installed", release)
+        return
+    if action in ["install", "upgrade"] and chart:
+        cached = charts.archive(chart, version)
+        if cached:
+            # the archive is the pinned version, helm ignores --version for local charts
+            chart, version = cached, None
+    command = [binaries.path("helm")]
     if namespace:
         command.append("--namespace")
         command.append(namespace)
@@ -38,8 +110,9 @@ def helm(
             command.append(arg)
     else:
         command.append(action)
-    if action == "upgrade":
+    if action in ["install", "upgrade"]:
         # adds a switch so if a release by this name doesn't already exist, install the release
+        command[-1] = "upgrade"
         command.append("--install")
     if release:
         command.append(release)
@@ -48,20 +121,44 @@ def helm(
     if license_file:
         command.append("--set-file")
         command.append(f"license={license_file}")
+    stdin = None
     if values:
         command.append("--values")
-        command.append(values)
+        command.append("-")
+        stdin = utils.stringify_yaml(values)
     if version:
         command.append("--version")
         command.append(version)
-    run_command(command, noout)
+    if check is None:
+        check = action not in ["delete", "uninstall"]
+    try:
+        return run_command(command, noout, stdin=stdin, check=check)
+    finally:
+        if release and state.current():
+            state.current().release_changed(release, namespace)
 
 
-def kubectl(action, namespace=None, resource=None, filename=None, literal=None):
+def manifest(action, spec):
     """
-    Pass through method to exectue a kubectl command.
+    Pass through method to create, apply or delete a manifest through the kubernetes api. The
+    create of an object the cluster snapshot holds is skipped.
     """
-    command = [subprocess.getoutput("which kubectl")]
+    if recorder.active():
+        recorder.active().manifests.append((action, spec))
+        return
+    if action == "create" and state.exists(spec):
+        logger.info("%s/%s already exists", spec["kind"], spec["metadata"]["name"])
+        return
+    engine().apply(spec, action)
+    state.record(action, [spec])
+
+
+def kubectl(action, namespace=None, resource=None, filename=None, literal=None, check=True):
+    """
+    Pass through method to exectue a kubectl command. A failing command raises CommandError
+    unless check is False.
+    """
+    command = [binaries.path("kubectl")]
     if namespace:
         command.append("--namespace")
         command.append(namespace)
@@ -79,14 +176,12 @@ def kubectl(action, namespace=None, resource=None, filename=None, literal=None):
                 command.append(arg)
         else:
             command.append(resource)
-        run_command(command)
-        return
+        return run_command(command, check=check)
     if filename:
         command.append("-f")
         command.append(filename)
-        run_command(command)
-        return
+        return run_command(command, check=check)
     if literal:
         command.append("--from-literal")
         command.append(literal)
-        run_command(command)
+        return run_command(command, check=check)
@@ -6,17 +6,21 @@ def _import(package, plugin):
     """
     Import the given plugin file from a package
     """
-    _importlib.import_module(f"{package}.{plugin}")
+    return _importlib.import_module(f"{package}.{plugin}")
 
 
-def _import_all(package):
+def names(package=__name__):
     """
-    Import all plugins in a package
+    Return the names of the plugins in a package, without importing them
     """
-    files = _resources.contents(package)
-    plugins = [f[:-3] for f in files if f.endswith(".py") and f[0] != "_"]
-    for plugin in plugins:
-        _import(package, plugin)
+    files = [entry.name for entry in _resources.files(package).iterdir()]
+    return sorted(f[:-3] for f in files if f.endswith(".py") and f[0] != "_")
 
 
-_import_all(__name__)
+def load(name, package=__name__):
+    """
+    Import a plugin on first use and return its module
+    """
+    if name not in names(package):
+        raise KeyError(name)
+    return _import(package, name)
@@ -1,15 +1,16 @@
 import base64
 import logging
 import os
-import time
 
-from manager import BaseManager, helm, kubectl, utils
-from ruamel.yaml import YAML
+from manager import BaseManager, helm, utils, wait
+from manager.values import node_selector
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["jetstack"]
+
     def post_init(self):
         self.config = self.kwargs.get("config")
         self.issuers = [i.name for i in self.config.cluster_issuer.issuers]
@@ -38,28 +39,21 @@ class Manager(BaseManager):
                 '--dns01-recursive-nameservers="8.8.8.8:53"',
             ]
 
-        if self.kwargs.get("provider") == "gcp":
-            values["nodeSelector"] = {"nodegroup": "addons"}
-
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        values = self.layer_values("cert-manager", values, providers={"gcp": node_selector()})
 
         params = {"action": action, "namespace": "cert-manager", "release": "cert-manager"}
         if action != "delete":
             params["chart"] = "jetstack/cert-manager"
-            params["values"] = "values.yaml"
+            params["values"] = values
             params["version"] = self.config.version
             logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(values))
 
         helm(**params)
-        os.unlink("values.yaml")
 
-    def cert_manager_approle_secret(self, action="create"):
+    def cert_manager_approle_secret(self):
         """
         Create kubernetes secret with the secret_id for the vault approle auth.
         """
-        if action not in ["create", "apply", "delete"]:
-            raise ValueError("action must be create, apply, or delete.")
         secret = {
             "apiVersion": "v1",
             "kind": "Secret",
@@ -72,12 +66,9 @@ class Manager(BaseManager):
                 "secretId": base64.b64encode(os.getenv("VAULT_APPROLE_SECRET_ID").encode("utf-8"))
             },
         }
-        with open("secret.yaml", "w") as f:
-            YAML().dump(secret, f)
-
-        kubectl(action=action, filename="secret.yaml")
+        return secret
 
-    def cert_manager_clusterissuer(self, issuer, action="create"):
+    def cert_manager_clusterissuer(self, issuer):
         """
         Create the letsencrypt clusterissuer for use with cert-manager.
         """
@@ -153,18 +144,12 @@ class Manager(BaseManager):
                 "spec": {"ca": {"secretName": config.secret}},
             }
 
-        with open("cluster_issuer.yaml", "w") as f:
-            YAML().dump(spec, f)
+        return spec
 
-        kubectl(action=action, namespace="cert-manager", filename="cluster_issuer.yaml")
-        os.unlink("cluster_issuer.yaml")
-
-    def cert_manager_cloudflare_secret(self, action="create"):
+    def cert_manager_cloudflare_secret(self):
         """
         Create kubernetes secret with the secret_id for the vault approle auth.
         """
-        if action not in ["create", "apply", "delete"]:
-            raise ValueError("action must be create, apply, or delete.")
         secret = {
             "apiVersion": "v1",
             "kind": "Secret",
@@ -175,21 +160,15 @@ class Manager(BaseManager):
             },
             "data": {"api-key": base64.b64encode(os.getenv("CF_API_KEY").encode("utf-8"))},
         }
-        with open("secret.yaml", "w") as f:
-            YAML().dump(secret, f)
-
-        kubectl(action=action, filename="secret.yaml")
-        os.unlink("secret.yaml")
+        return secret
 
-    def cert_manager_sisu_ca_secret(self, action="create"):
+    def cert_manager_sisu_ca_secret(self):
         """
         Create kubernetes secret with the secret_id for the vault approle auth.
         """
         for cluster_issuer in self.config.cluster_issuer.issuers:
             if cluster_issuer.name == "sisu-ca":
                 config = cluster_issuer
-        if action not in ["create", "apply", "delete"]:
-            raise ValueError("action must be create, apply, or delete.")
         secret = {
             "apiVersion": "v1",
             "kind": "Secret",
@@ -200,20 +179,13 @@ class Manager(BaseManager):
             },
             "data": {"tls.crt": os.getenv("SISU_CA_CERT"), "tls.key": os.getenv("SISU_CA_KEY")},
         }
-        with open("secret.yaml", "w") as f:
-            YAML().dump(secret, f)
-
-        kubectl(action=action, filename="secret.yaml")
-        os.unlink("secret.yaml")
+        return secret
 
     def delete(self, issuer="letsencrypt"):
         """
         Delete the cert-manager addon.
         """
-        for issuer in self.issuers:
-            self.cert_manager_clusterissuer(issuer, action="delete")
-        self.cert_manager_cloudflare_secret(action="delete")
-        self.cert_manager_sisu_ca_secret(action="delete")
+        self.manifests().apply("delete")
         self.cert_manager(issuer, action="delete")
 
     def install(self, issuer="letsencrypt"):
@@ -222,19 +194,25 @@ class Manager(BaseManager):
         """
         self.cert_manager(issuer, action="upgrade")
 
-        # Allow cert-manager pods to start
-        time.sleep(30)
-        self.cert_manager_cloudflare_secret(action="create")
-        self.cert_manager_sisu_ca_secret(action="create")
-        for issuer in self.issuers:
-            self.cert_manager_clusterissuer(issuer, action="create")
+        # Issuers can only be created once the CRDs are served and the webhook answers
+        timeout = self.config.wait_timeout
+        wait.crd_established("clusterissuers.cert-manager.io", timeout=timeout)
+        wait.deployment_available("cert-manager-webhook", "cert-manager", timeout=timeout)
+        wait.webhook_ready("cert-manager-webhook", "cert-manager", timeout=timeout)
+        self.manifests().apply("create")
+
+    def manifests(self):
+        """
+        Bundle the issuer secrets and the clusterissuers.
+        """
+        bundle = self.bundle()
+        bundle.add(self.cert_manager_cloudflare_secret(), self.cert_manager_sisu_ca_secret())
+        bundle.add(*[self.cert_manager_clusterissuer(issuer) for issuer in self.issuers])
+        return bundle
 
     def upgrade(self, issuer="letsencrypt"):
         """
         Upgrade the cert-manager install.
         """
         self.cert_manager(issuer, action="upgrade")
-        self.cert_manager_cloudflare_secret(action="apply")
-        self.cert_manager_sisu_ca_secret(action="apply")
-        for issuer in self.issuers:
-            self.cert_manager_clusterissuer(issuer, action="apply")
+        self.manifests().apply("apply")
@@ -1,28 +1,41 @@
+import functools
+import glob
 import json
 import logging
-import os
-import sys
-import time
 
-import boto3
-from manager import BaseManager, helm
-from manager.utils import objectify, run_command
 from ruamel.yaml import YAML
 
+from manager import BaseManager, helm, run_all, trace
+from manager.iam import Iam, role_name
+
 logger = logging.getLogger(__name__)
 
+FARGATE_PROFILES = "assets/fargate_profiles/*.yaml"
+FARGATE_POD_EXECUTION_POLICY = "arn:aws:iam::aws:policy/AmazonEKSFargatePodExecutionRolePolicy"
+# Service accounts of the addon ({name: namespace}), each gets its own iam role and policy.
+SERVICE_ACCOUNTS = {"cluster-autoscaler": "cluster-autoscaler"}
+
 
 class Manager(BaseManager):
+    repos = ["autoscaler"]
+
     def post_init(self):
         self.args = self.kwargs.get("args")
         self.provider = self.args.providers
 
         if self.provider == "aws":
+            # boto3 takes a while to import, only aws clusters pay for it
+            import boto3
+
             self.cluster = self.args.cluster
             self.config = self.kwargs.get("config")
-            self.iam = boto3.client("iam")
             self.region = self.args.region
-            self.sts = boto3.client("sts")
+            self.eks = trace.instrument(boto3.client("eks", region_name=self.region))
+            self.iam = Iam(
+                trace.instrument(boto3.client("iam")),
+                trace.instrument(boto3.client("sts")),
+                self.eks,
+            )
 
     def cluster_autoscaler(self, action="upgrade"):
         """
@@ -40,8 +53,7 @@ class Manager(BaseManager):
             },
             # "nodeSelector": {"nodegroup": "kube-addons"},
         }
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        values = self.layer_values("cluster-autoscaler", values)
 
         params = {
             "action": action,
@@ -50,11 +62,10 @@ class Manager(BaseManager):
         }
         if action != "delete":
             params["chart"] = "autoscaler/cluster-autoscaler"
-            params["values"] = "values.yaml"
+            params["values"] = values
             logger.info("Values for helm chart are: %s", values)
 
         helm(**params)
-        os.unlink("values.yaml")
 
     def delete(self):
         """
@@ -62,133 +73,219 @@ class Manager(BaseManager):
         """
         if self.provider == "aws":
             self.cluster_autoscaler(action="delete")
-            self.delete_iam_service_account("cluster-autoscaler", "cluster-autoscaler")
-            self.delete_fargateprofile("cluster-autoscaler")
+            self.run_all(
+                {
+                    "irsa": lambda: self.delete_iam_service_accounts(SERVICE_ACCOUNTS),
+                    "fargate": lambda: self.delete_fargate_profiles("cluster-autoscaler"),
+                }
+            )
 
     def install(self):
         """
         Logic for the initial installation of the cluster-autoscaler.
         """
         if self.provider == "aws":
-            self.create_iam_service_account("cluster-autoscaler", "cluster-autoscaler")
-            self.create_fargate_profile("cluster-autoscaler", "cluster-autoscaler")
+            self.run_all(
+                {
+                    "irsa": lambda: self.create_iam_service_accounts(SERVICE_ACCOUNTS),
+                    "fargate": lambda: self.create_fargate_profiles("cluster-autoscaler"),
+                }
+            )
+            self.cluster_autoscaler(action="upgrade")
+
+    def upgrade(self):
+        """
+        Upgrade the cluster-autoscaler chart, the iam service account and fargate profile are
+        left as they are.
+        """
+        if self.provider == "aws":
             self.cluster_autoscaler(action="upgrade")
 
-    def create_iam_service_account_iam_policy(self, service_account):
+    def run_all(self, tasks):
         """
-        Create the IAM policy that will be bound to the eks service account.
+        Run independent provisioning tasks ({name: callable}) at the same time.
         """
-        policy_name = f"{self.cluster}-{self.region}-{service_account}"
-        try:
-            account_id = self.sts.get_caller_identity()["Account"]
-            policy_arn = f"arn:aws:iam::{account_id}:policy/{policy_name}"
-            if self.iam.get_policy(PolicyArn=policy_arn)["Policy"]:
-                return policy_arn
-        except Exception as err:
-            logger.error(err)
+        run_all(tasks, getattr(self.args, "parallelism", 1))
 
+    def resource_name(self, name):
+        """
+        Name the iam policy or role of a service account, unique per cluster and region.
+        """
+        return f"{self.cluster}-{self.region}-{name}"
+
+    def create_iam_service_account_iam_policy(self, service_account):
+        """
+        Create the IAM policy that will be bound to the eks service account, unless it exists.
+        """
         with open(f"assets/iam_policies/{service_account}-iam-policy.json") as f:
-            iam_policy = json.loads(f.read())
+            iam_policy = json.load(f)
+        return self.iam.ensure_policy(self.resource_name(service_account), iam_policy)
 
-        response = objectify(
-            self.iam.create_policy(
-                PolicyName=policy_name,
-                PolicyDocument=json.dumps(iam_policy),
-            )
+    def create_iam_service_account_role(self, service_account, namespace):
+        """
+        Create the IAM role the service account assumes through the oidc provider of the cluster
+        (IRSA), with its policy attached.
+        """
+        policy_arn = self.create_iam_service_account_iam_policy(service_account)
+        return self.iam.ensure_role(
+            role_name(self.resource_name(service_account)),
+            self.iam.service_account_trust(self.cluster, namespace, service_account),
+            [policy_arn],
+            description=f"IRSA role of {namespace}/{service_account} on {self.cluster}",
         )
-        return response.Policy.Arn
-
-    def create_iam_service_account(self, service_account, namespace, iam_policy_arn=None):
-        """
-        Create the iam service account using eksctl.
-        """
-        if iam_policy_arn is None:
-            iam_policy_arn = self.create_iam_service_account_iam_policy(service_account)
-        logger.info(
-            [
-                "/usr/local/bin/eksctl",
-                "create",
-                "iamserviceaccount",
-                "--cluster",
-                self.cluster,
-                "--region",
-                self.region,
-                "--namespace",
-                namespace,
-                "--name",
-                service_account,
-                "--attach-policy-arn",
-                iam_policy_arn,
-                "--approve",
-            ]
+
+    def create_iam_service_accounts(self, service_accounts):
+        """
+        Create the IAM roles of the service accounts ({name: namespace}) concurrently, then the
+        service accounts annotated with their role, and their namespaces, in one apply.
+        """
+        roles = {}
+
+        def provision(service_account, namespace):
+            roles[service_account] = self.create_iam_service_account_role(
+                service_account, namespace
+            )
+
+        self.run_all(
+            {
+                service_account: functools.partial(provision, service_account, namespace)
+                for service_account, namespace in service_accounts.items()
+            }
         )
-        run_command(
-            [
-                "/usr/local/bin/eksctl",
-                "create",
-                "iamserviceaccount",
-                "--cluster",
-                self.cluster,
-                "--region",
-                self.region,
-                "--namespace",
-                namespace,
-                "--name",
-                service_account,
-                "--attach-policy-arn",
-                iam_policy_arn,
-                "--approve",
-            ]
+        bundle = self.bundle()
+        for namespace in sorted(set(service_accounts.values())):
+            bundle.add({"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": namespace}})
+        for service_account, namespace in service_accounts.items():
+            bundle.add(self.service_account(service_account, namespace, roles[service_account]))
+        bundle.apply("apply")
+
+    def delete_iam_service_accounts(self, service_accounts):
+        """
+        Delete the service accounts ({name: namespace}), then their IAM roles and policies
+        concurrently. The namespaces are left to the chart.
+        """
+        bundle = self.bundle()
+        for service_account, namespace in service_accounts.items():
+            bundle.add(self.service_account(service_account, namespace))
+        bundle.apply("delete")
+        self.run_all(
+            {
+                service_account: functools.partial(self.delete_iam_service_account, service_account)
+                for service_account in service_accounts
+            }
         )
 
-    def delete_iam_policy(self, name):
-        """
-        Delete the specified policy that was used the service account.
-        """
-        policy = f"{self.cluster}-{self.region}-{name}"
-        policies = self.iam.list_policies(Scope="Local").get("Policies")
-        try:
-            arn = [p.get("Arn") for p in policies if p["PolicyName"] == policy][0]
-            count = 6
-            wait = 10
-            attached = True
-            while attached is True:
-                status = self.iam.get_policy(PolicyArn=arn)
-                if status["Policy"]["AttachmentCount"] == 0:
-                    wait = 0
-                    attached = False
-                else:
-                    count += 1
-                    time.sleep(wait)
-                    if count <= 6:
-                        logging.error(
-                            "Policy %s is still attached to %s entities.",
-                            arn,
-                            status["Policy"]["AttachmentCount"],
-                        )
-                        sys.exit(1)
-            self.iam.delete_policy(PolicyArn=arn)
-            logger.info("Deleted IAM policy for service account: %s", arn)
-        except IndexError:
-            logging.error("Policy %s does not exist.", policy)
-
-    def delete_iam_service_account(self, service_account, namespace):
-        """
-        Create the iam service account using eksctl.
-        """
-        run_command(
-            [
-                "/usr/local/bin/eksctl",
-                "delete",
-                "iamserviceaccount",
-                "--cluster",
-                self.cluster,
-                "--region",
-                self.region,
-                "--namespace",
-                namespace,
-                "--name",
-                service_account,
-            ]
+    def delete_iam_service_account(self, service_account):
+        """
+        Delete the IAM role of a service account, then its policy.
+        """
+        self.iam.delete_role(role_name(self.resource_name(service_account)))
+        self.iam.delete_policy(self.resource_name(service_account))
+
+    def service_account(self, name, namespace, role_arn=None):
+        """
+        Manage a service account bound to an IAM role.
+        """
+        service_account = {
+            "apiVersion": "v1",
+            "kind": "ServiceAccount",
+            "metadata": {
+                "name": name,
+                "namespace": namespace,
+                "labels": {"app.kubernetes.io/managed-by": "addon-manager"},
+            },
+        }
+        if role_arn:
+            service_account["metadata"]["annotations"] = {"eks.amazonaws.com/role-arn": role_arn}
+        return service_account
+
+    def fargate_profiles(self, namespace):
+        """
+        Return the fargate profiles of assets/fargate_profiles selecting pods of a namespace. The
+        files are eksctl cluster configs, only the ones of the cluster and region of the run are
+        read: their profiles name subnets of that cluster's vpc.
+        """
+        profiles = []
+        for path in sorted(glob.glob(FARGATE_PROFILES)):
+            with open(path) as f:
+                cluster_config = YAML(typ="safe").load(f) or {}
+            metadata = cluster_config.get("metadata") or {}
+            if (metadata.get("name"), metadata.get("region")) != (self.cluster, self.region):
+                logger.info("Skipping %s, it is for %s", path, metadata.get("name"))
+                continue
+            for profile in cluster_config.get("fargateProfiles") or []:
+                if any(s.get("namespace") == namespace for s in profile.get("selectors") or []):
+                    profiles.append(profile)
+        return profiles
+
+    def fargate_pod_execution_role(self):
+        """
+        Create the role the fargate pods of the cluster run as, unless it exists. It is shared by
+        every profile of the cluster and kept when a profile is deleted.
+        """
+        trust = {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Effect": "Allow",
+                    "Principal": {"Service": "eks-fargate-pods.amazonaws.com"},
+                    "Action": "sts:AssumeRole",
+                }
+            ],
+        }
+        return self.iam.ensure_role(
+            role_name(self.resource_name("fargate-pod-execution")),
+            trust,
+            [FARGATE_POD_EXECUTION_POLICY],
+            description=f"Fargate pod execution role of {self.cluster}",
         )
-        self.delete_iam_policy(service_account)
+
+    def create_fargate_profiles(self, namespace):
+        """
+        Create the fargate profiles selecting pods of a namespace, unless they exist. eks
+        changes one profile of a cluster at a time, so they are created one after the other.
+        """
+        for profile in self.fargate_profiles(namespace):
+            name = profile["name"]
+            try:
+                self.eks.describe_fargate_profile(clusterName=self.cluster, fargateProfileName=name)
+                logger.info("Fargate profile %s already exists", name)
+                continue
+            except self.eks.exceptions.ResourceNotFoundException:
+                pass
+            params = {
+                "fargateProfileName": name,
+                "clusterName": self.cluster,
+                "podExecutionRoleArn": profile.get("podExecutionRoleARN")
+                or self.fargate_pod_execution_role(),
+                "selectors": profile["selectors"],
+            }
+            if profile.get("subnets"):
+                params["subnets"] = profile["subnets"]
+            if profile.get("tags"):
+                params["tags"] = profile["tags"]
+            self.eks.create_fargate_profile(**params)
+            self.eks.get_waiter("fargate_profile_active").wait(
+                clusterName=self.cluster,
+                fargateProfileName=name,
+                WaiterConfig={"Delay": 10, "MaxAttempts": 60},
+            )
+            logger.info("Created fargate profile %s", name)
+
+    def delete_fargate_profiles(self, namespace):
+        """
+        Delete the fargate profiles selecting pods of a namespace, one after the other.
+        """
+        for profile in self.fargate_profiles(namespace):
+            name = profile["name"]
+            try:
+                self.eks.delete_fargate_profile(clusterName=self.cluster, fargateProfileName=name)
+            except self.eks.exceptions.ResourceNotFoundException:
+                logger.info("Fargate profile %s does not exist", name)
+                continue
+            self.eks.get_waiter("fargate_profile_deleted").wait(
+                clusterName=self.cluster,
+                fargateProfileName=name,
+                WaiterConfig={"Delay": 10, "MaxAttempts": 60},
+            )
+            logger.info("Deleted fargate profile %s", name)
@@ -1,13 +1,14 @@
 import logging
-import os
 
 from manager import BaseManager, helm, utils
-from ruamel.yaml import YAML
+from manager.values import node_selector
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["kubernetes_dashboard"]
+
     def dashboard(self, action="upgrade"):
         """
         Install the kubernetes dashboard.
@@ -15,13 +16,11 @@ class Manager(BaseManager):
         values = {
             "rbac": {"create": True},
             "serviceAccount": {"create": True, "name": "k8s-dasboard"},
-            "nodeSelector": {"nodegroup": "addons"},
             "cert-manager": {"enabled": False},
             "nginx": {"enabled": False},
             "metrics-server": {"enabled": False},
         }
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        values = self.layer_values("dashboard", values, node_selector())
 
         params = {
             "action": action,
@@ -30,11 +29,10 @@ class Manager(BaseManager):
         }
         if action != "delete":
             params["chart"] = "kubernetes_dashboard/kubernetes-dashboard"
-            params["values"] = "values.yaml"
+            params["values"] = values
             logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(values))
 
         helm(**params)
-        os.unlink("values.yaml")
 
     def delete(self):
         """
@@ -47,3 +45,9 @@ class Manager(BaseManager):
         Logic for the initial installation of the kubernetes-dashboard.
         """
         self.dashboard(action="upgrade")
+
+    def upgrade(self):
+        """
+        Upgrade the kubernetes-dashboard chart.
+        """
+        self.dashboard(action="upgrade")
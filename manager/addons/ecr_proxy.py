@@ -2,13 +2,15 @@ import base64
 import logging
 import os
 
-from manager import BaseManager, helm, kubectl, utils
-from ruamel.yaml import YAML
+from manager import BaseManager, helm, utils
+from manager.values import ingress, node_selector
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["evryfs"]
+
     def post_init(self):
         self.args = self.kwargs.get("args")
         self.config = self.kwargs.get("config")
@@ -18,31 +20,32 @@ class Manager(BaseManager):
         Delete the ecr_proxy addon.
         """
         self.ecr_proxy(action="delete")
-        self.ecr_creds_secret(action="delete")
-        self.ecr_proxy_certificate(action="delete")
+        self.manifests().apply("delete")
 
     def install(self):
         """
         Logic for the installation of ecr_proxy.
         """
-        self.ecr_proxy_certificate(action="create")
-        self.ecr_creds_secret(action="create")
+        self.manifests().apply("create")
         self.ecr_proxy(action="install")
 
+    def manifests(self):
+        """
+        Bundle the registry credentials secret and the ingress certificate.
+        """
+        return self.bundle().add(self.ecr_creds_secret(), self.ecr_proxy_certificate())
+
     def upgrade(self):
         """
         Upgrade the chart installs.
         """
-        self.ecr_proxy_certificate(action="apply")
-        self.ecr_creds_secret(action="apply")
+        self.manifests().apply("apply")
         self.ecr_proxy(action="upgrade")
 
-    def ecr_creds_secret(self, action="create"):
+    def ecr_creds_secret(self):
         """
         Create kubernetes secret with the secret_id for the vault approle auth.
         """
-        if action not in ["create", "apply", "delete"]:
-            raise ValueError("action must be create, apply, or delete.")
         secret = {
             "apiVersion": "v1",
             "kind": "Secret",
@@ -56,19 +59,17 @@ class Manager(BaseManager):
                 "secret-key": base64.b64encode(os.getenv("ECR_SECRET_ACCESS_KEY").encode("utf-8")),
             },
         }
-        with open("secret.yaml", "w") as f:
-            YAML().dump(secret, f)
-
-        kubectl(action=action, filename="secret.yaml")
+        return secret
 
     def ecr_proxy(self, action="upgrade"):
         """
         Handle the values file.
         """
+        host = f"ep-{self.args.cluster}.sisu.ai"
         values = {
             "env": [
-                {"name": "UPSTREAM", "value": f"https://{self.config.get('ecr_registry')}"},
-                {"name": "AWS_REGION", "value": self.config.get("ecr_registry").split(".")[3]},
+                {"name": "UPSTREAM", "value": f"https://{self.config.ecr_registry}"},
+                {"name": "AWS_REGION", "value": self.config.ecr_registry.split(".")[3]},
                 {
                     "name": "AWS_ACCESS_KEY_ID",
                     "valueFrom": {"secretKeyRef": {"name": "ecr-credentials", "key": "access-key"}},
@@ -80,37 +81,23 @@ class Manager(BaseManager):
                 {"name": "RESOLVER", "value": "kube-dns.kube-system.svc.cluster.local"},
             ],
             "ingress": {
-                "enabled": True,
-                "annotations": {
-                    "cert-manager.io/cluster-issuer": "letsencrypt",
-                    "external-dns.alpha.kubernetes.io/hostname": f"ep-{self.args.cluster}.sisu.ai",
-                    "external-dns/passthrough-record": "true",
-                    "kubernetes.io/ingress.class": "nginx-private",
-                    "kubernetes.io/tls-acme": "true",
-                },
                 "hosts": [
                     {
-                        "host": f"ep-{self.args.cluster}.sisu.ai",
+                        "host": host,
                         "paths": ["/"],
                     }
                 ],
-                "tls": [
-                    {
-                        "hosts": [f"ep-{self.args.cluster}.sisu.ai"],
-                        "secretName": "kube-ecr-proxy-tls",
-                    }
-                ],
             },
             "replicaCount": "1",
         }
-
-        if self.args.providers == "gcp":
-            values["nodeSelector"] = {"nodegroup": "addons"}
-            # values["ingress"]["annotations"]["kubernetes.io/ingress.class"] = "gce-internal"
-            # values["ingress"]["annotations"]["kubernetes.io/ingress.allow-http"] = "false"
-
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        # on gcp the ingress could use "kubernetes.io/ingress.class": "gce-internal" and
+        # "kubernetes.io/ingress.allow-http": "false" instead
+        values = self.layer_values(
+            "kube",
+            ingress(host, "kube-ecr-proxy-tls"),
+            values,
+            providers={"gcp": node_selector()},
+        )
 
         params = {
             "action": action,
@@ -119,13 +106,12 @@ class Manager(BaseManager):
         }
         if action != "delete":
             params["chart"] = "evryfs/ecr-proxy"
-            params["values"] = "values.yaml"
+            params["values"] = values
             logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(values))
 
         helm(**params)
-        os.unlink("values.yaml")
 
-    def ecr_proxy_certificate(self, issuer="letsencrypt", action="create"):
+    def ecr_proxy_certificate(self, issuer="letsencrypt"):
         """
         Obtain the certificate from letsencrypt to use as the default certificate on the ingress.
         """
@@ -143,8 +129,4 @@ class Manager(BaseManager):
                 "dnsNames": [f"ep-{self.args.cluster}.sisu.ai"],
             },
         }
-        with open("ecr-proxy.yaml", "w") as f:
-            YAML().dump(certificate, f)
-
-        kubectl(action=action, filename="ecr-proxy.yaml")
-        os.unlink("ecr-proxy.yaml")
+        return certificate
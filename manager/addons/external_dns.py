@@ -1,13 +1,16 @@
+import functools
 import logging
 import os
 
 from manager import BaseManager, helm, utils
-from ruamel.yaml import YAML
+from manager.values import node_selector
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["bitnami"]
+
     def post_init(self):
         self.args = self.kwargs.get("args")
         self.config = self.kwargs.get("config")
@@ -36,43 +39,45 @@ class Manager(BaseManager):
         if zone_type == "passthrough":
             values["cloudflare"]["proxied"] = False
 
-        if self.kwargs.get("provider") == "gcp":
-            values["nodeSelector"] = {"nodegroup": "addons"}
-
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        release = f"external-dns-{zone_type}-zones"
+        values = self.layer_values(release, values, providers={"gcp": node_selector()})
 
         params = {
             "action": action,
             "namespace": "external-dns",
-            "release": f"external-dns-{zone_type}-zones",
+            "release": release,
         }
         if action != "delete":
             params["chart"] = "bitnami/external-dns"
-            params["values"] = "values.yaml"
+            params["values"] = values
             params["version"] = self.config.version
             logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(values))
 
         helm(**params)
-        os.unlink("values.yaml")
 
     def delete(self):
         """
         Delete the external-dns addon.
         """
-        self.external_dns(self.config.zones, "passthrough", action="delete")
-        self.external_dns(self.config.zones, "proxied", action="delete")
+        self.run_releases(self.releases(action="delete"))
 
     def install(self):
         """
         Logic for the installation of external-dns.
         """
-        self.external_dns(self.config.zones, "proxied")
-        self.external_dns(self.config.zones, "passthrough")
+        self.run_releases(self.releases())
+
+    def releases(self, action="upgrade"):
+        """
+        One release per zone type, they don't depend on each other.
+        """
+        return {
+            zone_type: functools.partial(self.external_dns, self.config.zones, zone_type, action)
+            for zone_type in ["proxied", "passthrough"]
+        }
 
     def upgrade(self):
         """
         Upgrade the chart installs.
         """
-        self.external_dns(self.config.zones, "proxied")
-        self.external_dns(self.config.zones, "passthrough")
+        self.run_releases(self.releases())
@@ -1,15 +1,15 @@
+import functools
 import logging
-import os
-import subprocess
-import time
 
-from manager import BaseManager, helm, kubectl, utils
-from ruamel.yaml import YAML
+from manager import BaseManager, helm, kubectl, utils, wait
+from manager.values import layer, nest, node_selector
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["ingress_nginx"]
+
     def post_init(self):
         self.args = self.kwargs.get("args")
         self.cluster = self.args.cluster
@@ -20,53 +20,48 @@ class Manager(BaseManager):
         """
         Delete the nginx-ingress addon.
         """
-        for endpoint in self.config.endpoints:
-            self.nginx_ingress(endpoint, action="delete")
-        self.nginx_ingress_default_certificate(
-            self.config.get("issuer", "letsencrypt"), action="delete"
-        )
+        self.run_releases(self.releases(action="delete"))
+        self.manifests().apply("delete")
 
     def install(self, issuer="letsencrypt"):
         """
         Logic for the initial installation of the nginx-ingress controllers.
         """
-        if self.provider == "gcp":
-            self.nginx_ingress_backendconfig(action="create")
-        self.nginx_ingress_default_certificate(self.config.get("issuer", "letsencrypt"))
+        self.manifests().apply("create")
 
-        # setup poll loop to detect successful issuing of certificate
-        # using subprocess as this is a CRD and not dug in enough to handle in python k8s client
+        # wait for the certificate to be issued, the ingress controllers use it as default
         certificate = f"wildcard.{self.cluster}"
-        status = "False"
-        count = 0
-        sleep = 45
-        command = subprocess.getoutput("which kubectl")
-        while status == "False":
-            results = subprocess.check_output(
-                [command, "-n", "nginx-ingress", "get", "certificate"],
-                encoding="utf-8",
-            ).split("\n")
-            for line in results:
-                if certificate in line:
-                    status = line.split()[1]
-                    logger.info("%s certificate status is %s", certificate, status)
-                    if status == "True":
-                        # Still sleeps a little to make sure cert secret gets created before install
-                        sleep = 5
-                        break
-            time.sleep(sleep)
-            count += 1
-            if count == 20:
-                kubectl(
-                    action="describe",
-                    namespace="nginx-ingress",
-                    resource=f"certificate wildcard.{self.cluster}",
-                )
-                kubectl(action="logs", namespace="cert-manager", resource="-l app=cert-manager")
-                raise Exception(f"{issuer} wildcard certificate validation has failed.")
-
-        for endpoint in self.config.endpoints:
-            self.nginx_ingress(endpoint)
+        try:
+            wait.certificate_ready(
+                certificate, "nginx-ingress", timeout=self.config.certificate_timeout
+            )
+            wait.secret_exists("nginx-ingress-wildcard", "nginx-ingress", timeout=60)
+        except wait.WaitTimeout:
+            kubectl(
+                action="describe",
+                namespace="nginx-ingress",
+                resource=f"certificate {certificate}",
+                check=False,
+            )
+            kubectl(
+                action="logs",
+                namespace="cert-manager",
+                resource="-l app=cert-manager",
+                check=False,
+            )
+            raise Exception(f"{issuer} wildcard certificate validation has failed.")
+
+        self.run_releases(self.releases())
+
+    def manifests(self):
+        """
+        Bundle the default certificate and, on gcp, the backendconfig.
+        """
+        bundle = self.bundle()
+        bundle.add(self.nginx_ingress_default_certificate(self.config.issuer))
+        if self.provider == "gcp":
+            bundle.add(self.nginx_ingress_backendconfig())
+        return bundle
 
     def nginx_ingress(self, endpoint, action="upgrade"):
         """
@@ -131,7 +126,7 @@ class Manager(BaseManager):
             values["controller"]["service"]["loadBalancerSourceRanges"] = self.config.cloudflare_ips
 
         if endpoint == "private":
-            values["tcp"] = self.config.additional_ports.tcp.to_dict()
+            values["tcp"] = dict(self.config.additional_ports.get("tcp") or {})
             for hostname in self.config.additional_dns:
                 hostnames.append(f"{hostname}.{self.cluster}.{self.config.zones[0]}")
 
@@ -139,56 +134,41 @@ class Manager(BaseManager):
             "external-dns.alpha.kubernetes.io/hostname"
         ] = ",".join(hostnames)
 
-        if self.provider == "aws":
-            values["controller"]["service"]["annotations"][
-                "service.beta.kubernetes.io/aws-load-balancer-type"
-            ] = "nlb-ip"
-            values["controller"]["service"]["annotations"][
-                "service.beta.kubernetes.io/aws-load-balancer-backend-protocol"
-            ] = "tcp"
-            values["controller"]["service"]["annotations"][
-                "service.beta.kubernetes.io/aws-load-balancer-cross-zone-load-balancing-enabled"
-            ] = "true"
-            values["controller"]["service"]["annotations"][
-                "service.beta.kubernetes.io/aws-load-balancer-connection-idle-timeout"
-            ] = "3600"
-            values["controller"]["service"]["annotations"][
-                "service.beta.kubernetes.io/aws-load-balancer-connection-draining-timeout"
-            ] = "60"
-
-            if endpoint == "private":
-                values["controller"]["service"]["annotations"][
-                    "service.beta.kubernetes.io/aws-load-balancer-scheme"
-                ] = "internal"
-
-        if self.provider == "gcp":
-            values["nodeSelector"] = {"nodegroup": "addons"}
-            values["controller"]["service"]["annotations"][
-                "cloud.google.com/backend-config"
-            ] = '{"ports": {"80":"nginx-ingress-backendconfig"}}'
-
-            if endpoint == "private":
-                values["controller"]["service"]["annotations"][
-                    "networking.gke.io/load-balancer-type"
-                ] = "Internal"
-
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        aws = {
+            "service.beta.kubernetes.io/aws-load-balancer-type": "nlb-ip",
+            "service.beta.kubernetes.io/aws-load-balancer-backend-protocol": "tcp",
+            "service.beta.kubernetes.io/aws-load-balancer-cross-zone-load-balancing-enabled": "true",
+            "service.beta.kubernetes.io/aws-load-balancer-connection-idle-timeout": "3600",
+            "service.beta.kubernetes.io/aws-load-balancer-connection-draining-timeout": "60",
+        }
+        gcp = {"cloud.google.com/backend-config": '{"ports": {"80":"nginx-ingress-backendconfig"}}'}
+        if endpoint == "private":
+            aws["service.beta.kubernetes.io/aws-load-balancer-scheme"] = "internal"
+            gcp["networking.gke.io/load-balancer-type"] = "Internal"
+
+        release = f"nginx-ingress-{endpoint}"
+        values = self.layer_values(
+            release,
+            values,
+            providers={
+                "aws": nest("controller.service.annotations", aws),
+                "gcp": layer(node_selector(), nest("controller.service.annotations", gcp)),
+            },
+        )
 
         params = {
             "action": action,
             "namespace": "nginx-ingress",
-            "release": f"nginx-ingress-{endpoint}",
+            "release": release,
         }
         if action != "delete":
             params["chart"] = "ingress_nginx/ingress-nginx"
-            params["values"] = "values.yaml"
+            params["values"] = values
             logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(values))
 
         helm(**params)
-        os.unlink("values.yaml")
 
-    def nginx_ingress_backendconfig(self, action="create"):
+    def nginx_ingress_backendconfig(self):
         """
         Handle the backendconfig that will set timeout for the load balancers.
         """
@@ -199,13 +179,9 @@ class Manager(BaseManager):
             "spec": {"timeoutSec": 600},
         }
 
-        with open("nginx-ingress-backendconfig.yaml", "w") as f:
-            YAML().dump(spec, f)
-
-        kubectl(action=action, filename="nginx-ingress-backendconfig.yaml")
-        os.unlink("nginx-ingress-backendconfig.yaml")
+        return spec
 
-    def nginx_ingress_default_certificate(self, issuer="letsencrypt", action="create"):
+    def nginx_ingress_default_certificate(self, issuer="letsencrypt"):
         """
         Obtain the certificate from letsencrypt to use as the default certificate on the ingress.
         """
@@ -228,20 +204,20 @@ class Manager(BaseManager):
                 "dnsNames": domains,
             },
         }
-        with open("nginx-ingress-wildcard.yaml", "w") as f:
-            YAML().dump(certificate, f)
+        return certificate
 
-        kubectl(action=action, filename="nginx-ingress-wildcard.yaml")
-        os.unlink("nginx-ingress-wildcard.yaml")
+    def releases(self, action="upgrade"):
+        """
+        The ingress controller release of every endpoint, they don't depend on each other.
+        """
+        return {
+            endpoint: functools.partial(self.nginx_ingress, endpoint, action=action)
+            for endpoint in self.config.endpoints
+        }
 
     def upgrade(self, issuer="letsencrypt"):
         """
         Logic for the upgrade of the nginx-ingress controllers.
         """
-        self.nginx_ingress_default_certificate(
-            self.config.get("issuer", "letsencrypt"), action="apply"
-        )
-        if self.provider == "gcp":
-            self.nginx_ingress_backendconfig(action="apply")
-        for endpoint in self.config.endpoints:
-            self.nginx_ingress(endpoint)
+        self.manifests().apply("apply")
+        self.run_releases(self.releases())
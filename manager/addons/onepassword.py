@@ -1,13 +1,14 @@
 import logging
 import os
 
-from manager import BaseManager, helm, kubectl, utils
-from ruamel.yaml import YAML
+from manager import BaseManager, helm, manifest, utils
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["onepassword"]
+
     def post_init(self):
         self.config = self.kwargs.get("config")
 
@@ -17,7 +18,14 @@ class Manager(BaseManager):
         """
         self.onepassword(action="delete")
         self.secrets_injector(action="delete")
-        kubectl(action="delete mutatingwebhookconfigurations secrets-injector-webhook-config")
+        manifest(
+            action="delete",
+            spec={
+                "apiVersion": "admissionregistration.k8s.io/v1",
+                "kind": "MutatingWebhookConfiguration",
+                "metadata": {"name": "secrets-injector-webhook-config"},
+            },
+        )
 
     def install(self):
         """
@@ -44,9 +52,7 @@ class Manager(BaseManager):
                     }
                 }
         }
-
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        values = self.layer_values("onepassword-connect", values)
 
         params = {
             "action": action,
@@ -55,13 +61,12 @@ class Manager(BaseManager):
         }
         if action != "delete":
             params["chart"] = "onepassword/connect"
-            params["values"] = "values.yaml"
+            params["values"] = values
             params["version"] = self.config.connect_version
             logger.info("Values for helm chart are:\n%s",
                         utils.stringify_yaml(values))
 
         helm(**params)
-        os.unlink("values.yaml")
 
     def secrets_injector(self, action="upgrade"):
         """
@@ -81,7 +86,12 @@ class Manager(BaseManager):
         if action != "delete":
             params["chart"] = "onepassword/secrets-injector"
             params["version"] = self.config.secrets_injector_chart_version
-            logger.info("Using default values for helm chart")
+            overrides = self.layer_values("secrets-injector")
+            if overrides:
+                params["values"] = overrides
+                logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(overrides))
+            else:
+                logger.info("Using default values for helm chart")
 
         helm(**params)
 
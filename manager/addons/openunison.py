@@ -1,39 +1,52 @@
 import base64
+import functools
 import logging
 import os
-import subprocess
 
-import requests
-from manager import BaseManager, helm, kubectl, utils
-from ruamel.yaml import YAML
+from manager import BaseManager, binaries, helm, utils
+from manager.values import ingress_annotations
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["tremolo"]
+
     def post_init(self):
         self.args = self.kwargs.get("args")
         self.config = self.kwargs.get("config")
-        self.endpoint = self.config.get("endpoint", "private")
+        self.endpoint = self.config.endpoint
 
     def delete(self):
         """
         Delete the openunison addon.
         """
-        helm(action="delete", namespace="openunison", chart="orchestra-login-googlews")
-        helm(action="delete", namespace="openunison", chart="orchestra-login-portal")
-        helm(action="delete", namespace="openunison", chart="orchestra")
-        helm(action="delete", namespace="openunison", chart="openunison")
+        releases = ["orchestra-login-googlews", "orchestra-login-portal", "orchestra", "openunison"]
+        self.run_releases(
+            {
+                release: functools.partial(
+                    helm, action="delete", namespace="openunison", release=release
+                )
+                for release in releases
+            }
+        )
 
     def install(self):
         """
         Logic for the initial installation of openunison.
         """
-        self.openunison_svc_account()
+        self.manifests().apply("apply")
         self.openunison()
-        self.openunison_admin_bindings("create", f"cloud-infra")
 
-    def openunison_admin_bindings(self, action, admin_group):
+    def manifests(self):
+        """
+        Bundle the google service account secret and the admin group bindings.
+        """
+        return self.bundle().add(
+            self.openunison_svc_account(), self.openunison_admin_bindings("cloud-infra")
+        )
+
+    def openunison_admin_bindings(self, admin_group):
         """
         Create the cluster role bindings for the admin group.
         """
@@ -48,18 +61,9 @@ class Manager(BaseManager):
             },
             "subjects": [{"kind": "Group", "name": admin_group}],
         }
-        with open("cluster-admins.yaml", "w") as f:
-            YAML().dump(cluster_role_binding, f)
-
-        kubectl(action=action, filename="cluster-admins.yaml")
-        os.unlink("cluster-admins.yaml")
+        return cluster_role_binding
 
     def openunison(self):
-        if self.endpoint == "public":
-            dns_type = "proxied"
-        if self.endpoint == "private":
-            dns_type = "passthrough"
-
         values = {
             "cert_template": {
                 "ou": self.args.cluster,
@@ -80,7 +84,7 @@ class Manager(BaseManager):
             "enable_impersonation": True,
             "google_ws": {
                 "admin_email": "sso@sisudata.com",
-                "service_account_email": self.config.get("service_account_email"),
+                "service_account_email": self.config.service_account_email,
             },
             "image": "docker.io/tremolosecurity/openunison-k8s",
             "impersonation": {
@@ -100,14 +104,10 @@ class Manager(BaseManager):
                 "session_inactivity_timeout_seconds": 3600,
                 "createIngressCertificate": False,
                 "ingress_type": "nginx",
-                "ingress_annotations": {
-                    "kubernetes.io/ingress.class": f"nginx-{self.endpoint}",
-                    "cert-manager.io/cluster-issuer": "letsencrypt",
-                    f"external-dns/{dns_type}-record": "true",
-                },
+                "ingress_annotations": ingress_annotations(self.endpoint),
             },
             "oidc": {
-                "client_id": self.config.get("oauth_client_id"),
+                "client_id": self.config.oauth_client_id,
                 "issuer": "https://accounts.google.com",
                 "user_in_idtoken": False,
                 "domain": "",
@@ -135,26 +135,25 @@ class Manager(BaseManager):
                 "use_standard_jit_workflow": True,
             },
         }
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        values = self.layer_values("openunison", values)
         logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(values))
 
+        # ouctl only reads files, keep them private and remove them even if the install fails
         client_secret = os.getenv("OAUTH_CLIENT_SECRET")
-        with open("oauth_client_secret.yaml", "w") as f:
-            f.write(client_secret)
-
-        command = [
-            subprocess.getoutput("which ouctl"),
-            "install-auth-portal",
-            "-s",
-            "oauth_client_secret.yaml",
-            "-r",
-            "orchestra-login-googlews=tremolo/orchestra-login-googlews",
-            "values.yaml",
-        ]
-        utils.run_command(command)
-
-    def openunison_svc_account(self, action="apply"):
+        with utils.scratch_file("oauth_client_secret.yaml", client_secret) as secret_file:
+            with utils.scratch_file("values.yaml", utils.stringify_yaml(values)) as values_file:
+                command = [
+                    binaries.path("ouctl"),
+                    "install-auth-portal",
+                    "-s",
+                    secret_file,
+                    "-r",
+                    "orchestra-login-googlews=tremolo/orchestra-login-googlews",
+                    values_file,
+                ]
+                utils.run_command(command)
+
+    def openunison_svc_account(self):
         """
         Create a secret containing the private key for the google service account.
         """
@@ -166,16 +165,11 @@ class Manager(BaseManager):
             "data": {"key": os.getenv("OPENUNISON_SVC_ACCOUNT")},
         }
 
-        with open("openunison_svc_account.yaml", "w") as f:
-            YAML().dump(secret, f)
-
-        kubectl(action=action, filename="openunison_svc_account.yaml")
-        os.unlink("openunison_svc_account.yaml")
+        return secret
 
     def upgrade(self):
         """
         Logic for the initial installation of openunison.
         """
-        self.openunison_svc_account()
+        self.manifests().apply("apply")
         self.openunison()
-        self.openunison_admin_bindings("apply", f"cloud-infra")
@@ -1,14 +1,15 @@
 import base64
 import logging
-import os
 
-from manager import BaseManager, helm, kubectl, utils
-from ruamel.yaml import YAML
+from manager import BaseManager, helm, utils
+from manager.values import ingress, node_selector
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["runix"]
+
     def post_init(self):
         self.args = self.kwargs.get("args")
         self.config = self.kwargs.get("config")
@@ -23,13 +24,20 @@ class Manager(BaseManager):
         """
         Logic for the installation of sumoligc.
         """
-        self.pgadmin_password_secret(action="create")
+        self.manifests().apply("create")
         self.pgadmin(action="install")
 
+    def manifests(self):
+        """
+        Bundle the generated password secret.
+        """
+        return self.bundle().add(self.pgadmin_password_secret())
+
     def pgadmin(self, action="upgrade"):
         """
         Handle the values file.
         """
+        host = f"pgadmin-{self.args.cluster}.local"
         values = {
             "env": {"email": "ryan@local",
                     "variables": [{"name": "PGADMIN_CONFIG_MAX_LOGIN_ATTEMPTS", "value": 25}]
@@ -49,37 +57,23 @@ class Manager(BaseManager):
                 },
             },
             "ingress": {
-                "enabled": True,
-                "annotations": {
-                    "cert-manager.io/cluster-issuer": "letsencrypt",
-                    "external-dns.alpha.kubernetes.io/hostname": f"pgadmin-{self.args.cluster}.local",
-                    "external-dns/passthrough-record": "true",
-                    "kubernetes.io/ingress.class": "nginx-private",
-                    "kubernetes.io/tls-acme": "true",
-                },
                 "hosts": [
                     {
-                        "host": f"pgadmin-{self.args.cluster}.local",
+                        "host": host,
                         "paths": [
                             {"path": '/',
                              "pathType": "ImplementationSpecific"}
                         ],
                     }
                 ],
-                "tls": [
-                    {
-                        "hosts": [f"pgadmin-{self.args.cluster}.local"],
-                        "secretName": "pgadmin-tls",
-                    }
-                ],
             },
         }
-
-        if self.kwargs.get("provider") == "gcp":
-            values["nodeSelector"] = {"nodegroup": "addons"}
-
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        values = self.layer_values(
+            "pgadmin",
+            ingress(host, "pgadmin-tls"),
+            values,
+            providers={"gcp": node_selector()},
+        )
 
         params = {
             "action": action,
@@ -88,14 +82,13 @@ class Manager(BaseManager):
         }
         if action != "delete":
             params["chart"] = "runix/pgadmin4"
-            params["values"] = "values.yaml"
+            params["values"] = values
             params["version"] = self.config.version
             logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(values))
 
         helm(**params)
-        os.unlink("values.yaml")
 
-    def pgadmin_password_secret(self, action):
+    def pgadmin_password_secret(self):
         """
         Create the pgadmin secrets file, and generate the needed password.
         """
@@ -108,11 +101,7 @@ class Manager(BaseManager):
                 "password": base64.encodebytes(utils.gen_password(64, special_characters=False)),
             },
         }
-        with open("secrets.yaml", "w") as f:
-            YAML().dump(secrets, f)
-
-        kubectl(action=action, filename="secrets.yaml")
-        os.unlink("secrets.yaml")
+        return secrets
 
     def upgrade(self):
         """
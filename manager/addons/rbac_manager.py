@@ -1,13 +1,14 @@
 import logging
-import os
 
-from manager import BaseManager, helm, kubectl, utils
-from ruamel.yaml import YAML
+from manager import BaseManager, helm, utils
+from manager.values import node_selector
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["fairwinds-stable"]
+
     def post_init(self):
         self.args = self.kwargs.get("args")
         self.config = self.kwargs.get("config")
@@ -16,14 +17,7 @@ class Manager(BaseManager):
         """
         Delete RBAC Manager.
         """
-        if "dev" in self.args.cluster:
-            self.rbac_dev_binder(action="delete")
-        self.rbac_oncall_binder(action="delete")
-        self.metrics_role(action="delete")
-        self.nodes_clusterrole(action="delete")
-        self.oncall_role(action="delete")
-        self.priorityclass_clusterrole(action="delete")
-        self.priorityclasses(action="delete")
+        self.manifests().apply("delete")
         self.rbac_manager(action="delete")
 
     def install(self):
@@ -31,16 +25,26 @@ class Manager(BaseManager):
         Logic for the installation of RBAC Manager.
         """
         self.rbac_manager(action="upgrade")
-        self.metrics_role(action="apply")
-        self.nodes_clusterrole(action="apply")
-        self.oncall_role(action="apply")
-        self.priorityclass_clusterrole(action="apply")
-        self.priorityclasses(action="apply")
-        self.rbac_oncall_binder(action="apply")
+        self.manifests().apply("apply")
+
+    def manifests(self):
+        """
+        Bundle the roles, priorityclasses and rbac definitions managed next to the chart.
+        """
+        bundle = self.bundle()
+        bundle.add(
+            self.metrics_role(),
+            self.nodes_clusterrole(),
+            self.oncall_role(),
+            self.priorityclass_clusterrole(),
+            *self.priorityclasses(),
+            self.rbac_oncall_binder(),
+        )
         if "dev" in self.args.cluster:
-            self.rbac_dev_binder(action="apply")
+            bundle.add(self.rbac_dev_binder())
+        return bundle
 
-    def metrics_role(self, action="apply"):
+    def metrics_role(self):
         """
         Manage the clusterrole to add in mtrics api.
         """
@@ -64,13 +68,9 @@ class Manager(BaseManager):
             ],
         }
 
-        with open("role.yaml", "w") as f:
-            YAML().dump(role, f)
-
-        kubectl(action=action, filename="role.yaml")
-        os.unlink("role.yaml")
+        return role
 
-    def nodes_clusterrole(self, action="apply"):
+    def nodes_clusterrole(self):
         """
         Manage the clusterrole to add in nodes objects api.
         """
@@ -94,13 +94,9 @@ class Manager(BaseManager):
             ],
         }
 
-        with open("role.yaml", "w") as f:
-            YAML().dump(role, f)
-
-        kubectl(action=action, filename="role.yaml")
-        os.unlink("role.yaml")
+        return role
 
-    def oncall_role(self, action="apply"):
+    def oncall_role(self):
         """
         Manage the oncall role for prod clusters.
         """
@@ -141,13 +137,9 @@ class Manager(BaseManager):
                 },
             ],
         }
-        with open("role.yaml", "w") as f:
-            YAML().dump(role, f)
+        return role
 
-        kubectl(action=action, filename="role.yaml")
-        os.unlink("role.yaml")
-
-    def priorityclass_clusterrole(self, action="apply"):
+    def priorityclass_clusterrole(self):
         """
         Manage the clusterrole to add in priorityclass objects api.
         """
@@ -171,15 +163,11 @@ class Manager(BaseManager):
             ],
         }
 
-        with open("role.yaml", "w") as f:
-            YAML().dump(role, f)
-
-        kubectl(action=action, filename="role.yaml")
-        os.unlink("role.yaml")
+        return role
 
-    def _priorityclass_render(self, pc, action):
+    def _priorityclass_render(self, pc):
         """
-        Helper method to handle the render and applcation of the priorityclass
+        Helper method to handle the render of the priorityclass
         """
         priorityclass = {
             "apiVersion": "scheduling.k8s.io/v1",
@@ -190,33 +178,29 @@ class Manager(BaseManager):
             "value": pc.value,
             "preemptionPolicy": pc.preemptionPolicy,
         }
-        if "labels" in pc.keys():
-            priorityclass["metadata"]["labels"] = pc.labels.to_dict()
-        if "globalDefault" in pc.keys():
+        if pc.labels:
+            priorityclass["metadata"]["labels"] = dict(pc.labels)
+        if pc.globalDefault is not None:
             priorityclass["globalDefault"] = pc.globalDefault
-        if "description" in pc.keys():
+        if pc.description is not None:
             priorityclass["description"] = pc.description
 
-        with open("priorityclass.yaml", "w") as f:
-            YAML().dump(priorityclass, f)
+        return priorityclass
 
-        kubectl(action=action, filename="priorityclass.yaml")
-        os.unlink("priorityclass.yaml")
-
-    def priorityclasses(self, action="apply"):
+    def priorityclasses(self):
         """
         Manage the priorityclasses from config.
         """
-        for pc in self.config.priorityclasses.all:
-            self._priorityclass_render(pc, action)
+        priorityclasses = [self._priorityclass_render(pc) for pc in self.config.priorityclasses.all]
         for pc in self.config.priorityclasses.dev:
             if "dev" in self.args.cluster:
-                self._priorityclass_render(pc, action)
+                priorityclasses.append(self._priorityclass_render(pc))
         for pc in self.config.priorityclasses.prod:
             if "prod" in self.args.cluster:
-                self._priorityclass_render(pc, action)
+                priorityclasses.append(self._priorityclass_render(pc))
+        return priorityclasses
 
-    def rbac_dev_binder(self, action="apply"):
+    def rbac_dev_binder(self):
         """
         Manage bindings for the dev teams in dev clusters.
         """
@@ -249,13 +233,9 @@ class Manager(BaseManager):
                 }
             )
 
-        with open("binder.yaml", "w") as f:
-            YAML().dump(binder, f)
-
-        kubectl(action=action, filename="binder.yaml")
-        os.unlink("binder.yaml")
+        return binder
 
-    def rbac_oncall_binder(self, action="apply"):
+    def rbac_oncall_binder(self):
         """
         Manage the rbac definitiona that will bind permissions based on namespace labels.
         """
@@ -276,21 +256,13 @@ class Manager(BaseManager):
                 }
             ],
         }
-        with open("binder.yaml", "w") as f:
-            YAML().dump(binder, f)
-
-        kubectl(action=action, filename="binder.yaml")
-        os.unlink("binder.yaml")
+        return binder
 
     def rbac_manager(self, action="upgrade"):
         """
         Install RBAC Manager.
         """
-        values = {
-            "nodeSelector": {"nodegroup": "addons"},
-        }
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        values = self.layer_values("rbac-manager", providers={"gcp": node_selector()})
 
         params = {
             "action": action,
@@ -299,23 +271,15 @@ class Manager(BaseManager):
         }
         if action != "delete":
             params["chart"] = "fairwinds-stable/rbac-manager"
-            if self.args.providers == "gcp":
-                params["values"] = "values.yaml"
+            if values:
+                params["values"] = values
                 logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(values))
 
         helm(**params)
-        os.unlink("values.yaml")
 
     def upgrade(self):
         """
         Logic for the upgrade of RBAC Manager.
         """
         self.rbac_manager(action="upgrade")
-        self.metrics_role(action="apply")
-        self.nodes_clusterrole(action="apply")
-        self.oncall_role(action="apply")
-        self.priorityclass_clusterrole(action="apply")
-        self.priorityclasses(action="apply")
-        self.rbac_oncall_binder(action="apply")
-        if "dev" in self.args.cluster:
-            self.rbac_dev_binder(action="apply")
+        self.manifests().apply("apply")
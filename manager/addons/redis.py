@@ -1,14 +1,15 @@
 import base64
 import logging
-import os
 
 from manager import BaseManager, helm, kubectl, utils
-from ruamel.yaml import YAML
+from manager.values import node_selector
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["bitnami"]
+
     def post_init(self):
         self.config = self.kwargs.get("config")
 
@@ -42,11 +43,7 @@ class Manager(BaseManager):
             }
         }
 
-        if self.kwargs.get("provider") == "gcp":
-            values["nodeSelector"] = {"nodegroup": "addons"}
-
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        values = self.layer_values("redis", values, providers={"gcp": node_selector()})
 
         params = {
             "action": action,
@@ -55,9 +52,8 @@ class Manager(BaseManager):
         }
         if action != "delete":
             params["chart"] = "bitnami/redis"
-            params["values"] = "values.yaml"
+            params["values"] = values
             logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(values))
 
         helm(**params)
-        os.unlink("values.yaml")
 
@@ -2,12 +2,14 @@ import logging
 import os
 
 from manager import BaseManager, helm, utils
-from ruamel.yaml import YAML
+from manager.values import node_selector, not_on_fargate
 
 logger = logging.getLogger(__name__)
 
 
 class Manager(BaseManager):
+    repos = ["sumologic"]
+
     def post_init(self):
         self.args = self.kwargs.get("args")
         self.config = self.kwargs.get("config")
@@ -265,70 +267,29 @@ class Manager(BaseManager):
             },
         }
 
-        if self.provider == "aws":
-            values["otellogs"]["daemonset"]["affinity"] = {
-                "nodeAffinity": {
-                    "requiredDuringSchedulingIgnoredDuringExecution": {
-                        "nodeSelectorTerms": [
-                            {
-                                "matchExpressions": [
-                                    {
-                                        "key": "eks.amazonaws.com/compute-type",
-                                        "operator": "NotIn",
-                                        "values": ["fargate"],
-                                    }
-                                ]
-                            }
-                        ]
-                    }
-                }
-            }
-            values["kube-prometheus-stack"]["prometheus-node-exporter"] = {
-                "affinity": {
-                    "nodeAffinity": {
-                        "requiredDuringSchedulingIgnoredDuringExecution": {
-                            "nodeSelectorTerms": [
-                                {
-                                    "matchExpressions": [
-                                        {
-                                            "key": "eks.amazonaws.com/compute-type",
-                                            "operator": "NotIn",
-                                            "values": ["fargate"],
-                                        }
-                                    ]
-                                }
-                            ]
-                        }
-                    }
-                }
-            }
-
-        if self.provider == "gcp":
-            values["sumologic"]["metrics"]["remoteWriteProxy"] = {
-                "nodeSelector": {"nodegroup": "addons"}
-            }
-            values["sumologic"]["metrics"]["collector"] = {
-                "otelcol": {"nodeSelector": {"nodegroup": "addons"}}
-            }
-            values["sumologic"]["setup"] = {"job": {"nodeSelector": {"nodegroup": "addons"}}}
-            values["kube-prometheus-stack"]["kube-state-metrics"] = {
-                "nodeSelector": {"nodegroup": "addons"}
-            }
-            values["kube-prometheus-stack"]["prometheus"]["prometheusSpec"] = {
-                "nodeSelector": {"nodegroup": "addons"}
-            }
-            values["otelevents"] = {"statefulset": {"nodeSelector": {"nodegroup": "addons"}}}
-            values["otelcolInstrumentation"] = {
-                "statefulset": {"nodeSelector": {"nodegroup": "addons"}}
-            }
-            values["tracesGateway"] = {"deployment": {"nodeSelector": {"nodegroup": "addons"}}}
-            values["tracesSampler"] = {"deployment": {"nodeSelector": {"nodegroup": "addons"}}}
-            values["metadata"]["metrics"]["statefulset"] = {"nodeSelector": {"nodegroup": "addons"}}
-            values["metadata"]["logs"]["statefulset"] = {"nodeSelector": {"nodegroup": "addons"}}
-            values["pvcCleaner"] = {"job": {"nodeSelector": {"nodegroup": "addons"}}}
-
-        with open("values.yaml", "w") as f:
-            YAML().dump(values, f)
+        values = self.layer_values(
+            "sumologic",
+            values,
+            providers={
+                "aws": not_on_fargate(
+                    "otellogs.daemonset", "kube-prometheus-stack.prometheus-node-exporter"
+                ),
+                "gcp": node_selector(
+                    "sumologic.metrics.remoteWriteProxy",
+                    "sumologic.metrics.collector.otelcol",
+                    "sumologic.setup.job",
+                    "kube-prometheus-stack.kube-state-metrics",
+                    "kube-prometheus-stack.prometheus.prometheusSpec",
+                    "otelevents.statefulset",
+                    "otelcolInstrumentation.statefulset",
+                    "tracesGateway.deployment",
+                    "tracesSampler.deployment",
+                    "metadata.metrics.statefulset",
+                    "metadata.logs.statefulset",
+                    "pvcCleaner.job",
+                ),
+            },
+        )
 
         params = {
             "action": action,
@@ -337,12 +298,11 @@ class Manager(BaseManager):
         }
         if action != "delete":
             params["chart"] = "sumologic/sumologic"
-            params["values"] = "values.yaml"
+            params["values"] = values
             params["version"] = self.config.version
             logger.info("Values for helm chart are:\n%s", utils.stringify_yaml(values))
 
         helm(**params)
-        os.unlink("values.yaml")
 
     def upgrade(self):
         """
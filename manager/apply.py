@@ -0,0 +1,145 @@
+import atexit
+import logging
+import os
+import tempfile
+import threading
+
+from . import trace
+
+logger = logging.getLogger(__name__)
+
+FIELD_MANAGER = "addon-manager"
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+class ApplyEngine(object):
+    def __init__(self, context=None):
+        """
+        Apply manifests through the kubernetes api on a single pooled client. Api discovery is
+        cached in a file private to this run, so it happens once instead of once per manifest.
+        The kubernetes client takes a while to import, runs that never reach the api skip it.
+        """
+        from kubernetes import client, config
+        from kubernetes.dynamic import DynamicClient
+
+        try:
+            api_client = config.new_client_from_config(context=context)
+        except config.ConfigException:
+            config.load_incluster_config()
+            api_client = client.ApiClient()
+        self.cache_file = os.path.join(
+            tempfile.gettempdir(), f"addon-manager-discovery-{os.getpid()}.json"
+        )
+        atexit.register(self.cleanup)
+        self.client = DynamicClient(api_client, cache_file=self.cache_file)
+        self.resources = {}
+        self.lock = threading.Lock()
+
+    def apply(self, manifest, action="apply"):
+        """
+        Take the kubectl style action (create, apply or delete) on a manifest. Apply is a server
+        side apply, create of an existing object and delete of a missing object are not errors.
+        """
+        from kubernetes.dynamic.exceptions import ResourceNotFoundError
+
+        manifest = sanitize(manifest)
+        kind = manifest["kind"]
+        name = manifest["metadata"]["name"]
+        namespace = manifest["metadata"].get("namespace")
+        try:
+            resource = self.resource(manifest["apiVersion"], kind)
+        except ResourceNotFoundError:
+            if action == "delete":
+                logger.info("%s/%s already deleted, the api is not served.", kind, name)
+                return
+            raise
+        if not resource.namespaced:
+            namespace = None
+
+        with trace.span(f"{action} {kind}/{name}", "api"):
+            self._apply(resource, manifest, action, namespace)
+
+    def _apply(self, resource, manifest, action, namespace):
+        """
+        Send the request for apply.
+        """
+        from kubernetes.dynamic.exceptions import ConflictError, NotFoundError
+
+        kind = manifest["kind"]
+        name = manifest["metadata"]["name"]
+        if action == "apply":
+            self.client.server_side_apply(
+                resource,
+                body=manifest,
+                namespace=namespace,
+                field_manager=FIELD_MANAGER,
+                force_conflicts=True,
+            )
+            logger.info("%s/%s applied", kind, name)
+        elif action == "create":
+            try:
+                self.client.create(
+                    resource, body=manifest, namespace=namespace, field_manager=FIELD_MANAGER
+                )
+                logger.info("%s/%s created", kind, name)
+            except ConflictError:
+                logger.info("%s/%s already exists", kind, name)
+        elif action == "delete":
+            try:
+                self.client.delete(resource, name=name, namespace=namespace)
+                logger.info("%s/%s deleted", kind, name)
+            except NotFoundError:
+                logger.info("%s/%s already deleted", kind, name)
+        else:
+            raise ValueError("action must be create, apply, or delete.")
+
+    def apply_all(self, manifests, action="apply"):
+        """
+        Take the same action on a list of manifests, in order, over the one pooled connection.
+        """
+        for manifest in manifests:
+            self.apply(manifest, action)
+
+    def cleanup(self):
+        """
+        Remove the discovery cache of this run.
+        """
+        if os.path.exists(self.cache_file):
+            os.unlink(self.cache_file)
+
+    def resource(self, api_version, kind):
+        """
+        Look up the api resource for a kind, once per run.
+        """
+        key = (api_version, kind)
+        with self.lock:
+            if key not in self.resources:
+                self.resources[key] = self.client.resources.get(api_version=api_version, kind=kind)
+            return self.resources[key]
+
+
+def engine():
+    """
+    Return the apply engine shared by every addon, creating it on first use so the kubeconfig is
+    only read after it has been updated for the cluster.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ApplyEngine()
+        return _engine
+
+
+def sanitize(data):
+    """
+    Convert a manifest to plain json types, secret data built with base64 is bytes.
+    """
+    if isinstance(data, dict):
+        return {str(key): sanitize(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [sanitize(value) for value in data]
+    if isinstance(data, bytes):
+        return data.decode("utf-8")
+    return data
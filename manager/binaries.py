@@ -1 +1,79 @@
 import logging
+import os
+import shutil
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Arguments that print the version of a binary, binaries not listed aren't version checked.
+VERSION_ARGS = {
+    "aws": ["--version"],
+    "eksctl": ["version"],
+    "gcloud": ["version"],
+    "helm": ["version", "--short"],
+    "kubectl": ["version", "--client"],
+    "op": ["--version"],
+}
+
+_configured = {}
+_paths = {}
+_versions = {}
+_lock = threading.Lock()
+
+
+class MissingBinary(Exception):
+    """
+    Raised when a binary can't be found on the configured path or the PATH.
+    """
+
+
+def configure(required_binaries):
+    """
+    Register the required_binaries entries of the config. An entry is either the name of a
+    binary to look up on the PATH, or a mapping of the name to the path to use.
+    """
+    names = []
+    with _lock:
+        for entry in required_binaries or []:
+            if isinstance(entry, dict):
+                for name, binary_path in entry.items():
+                    _configured[name] = binary_path
+                    _paths.pop(name, None)
+                    names.append(name)
+            else:
+                names.append(entry)
+    return names
+
+
+def path(name):
+    """
+    Return the path of a binary, resolved once for the lifetime of the process.
+    """
+    with _lock:
+        if name not in _paths:
+            binary_path = _configured.get(name) or shutil.which(name)
+            if not binary_path or not os.access(binary_path, os.X_OK):
+                raise MissingBinary(f"{name} is not installed or not executable.")
+            _paths[name] = binary_path
+        return _paths[name]
+
+
+def version(name):
+    """
+    Return the version output of a binary, checked once for the lifetime of the process.
+    """
+    binary_path = path(name)
+    with _lock:
+        if name not in _versions:
+            output = ""
+            if name in VERSION_ARGS:
+                result = subprocess.run(
+                    [binary_path] + VERSION_ARGS[name],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    encoding="utf-8",
+                )
+                output = result.stdout.strip().split("\n")[0]
+            _versions[name] = output
+        return _versions[name]
@@ -0,0 +1,121 @@
+import logging
+import os
+
+from . import recorder, state, utils
+from .apply import engine, sanitize
+
+logger = logging.getLogger(__name__)
+
+# Label naming the addon a manifest belongs to, serve mode watches the objects carrying it.
+OWNER_LABEL = "addon-manager.io/addon"
+
+# Apply order by kind, kinds not listed (custom resources) go last. Deletes run in reverse.
+KIND_ORDER = [
+    "Namespace",
+    "CustomResourceDefinition",
+    "PriorityClass",
+    "ServiceAccount",
+    "Secret",
+    "ConfigMap",
+    "ClusterRole",
+    "ClusterRoleBinding",
+    "Role",
+    "RoleBinding",
+    "Service",
+    "DaemonSet",
+    "Deployment",
+    "StatefulSet",
+    "Job",
+    "CronJob",
+    "Ingress",
+    "MutatingWebhookConfiguration",
+    "ValidatingWebhookConfiguration",
+]
+
+
+class Bundle(object):
+    def __init__(self, name, dump_dir=None, owner=None):
+        """
+        Collect the raw (non helm) manifests of an addon so they are applied in one call, ordered
+        by kind. Every manifest is labeled with the owner addon, when given.
+        """
+        self.name = name
+        self.dump_dir = dump_dir
+        self.owner = owner
+        self.specs = []
+
+    def add(self, *specs):
+        """
+        Add manifests to the bundle, None is skipped so optional manifests can be passed inline.
+        """
+        self.specs.extend(spec for spec in specs if spec is not None)
+        return self
+
+    def apply(self, action="apply"):
+        """
+        Create, apply or delete every manifest of the bundle. Creates of objects the cluster
+        snapshot holds are skipped.
+        """
+        if action not in ["create", "apply", "delete"]:
+            raise ValueError("action must be create, apply, or delete.")
+        manifests = self.manifests()
+        if action == "delete":
+            manifests = manifests[::-1]
+        if self.dump_dir:
+            self.dump(action)
+        if recorder.active():
+            recorder.active().manifests.extend((action, spec) for spec in manifests)
+            return
+        if action == "create":
+            existing = [spec for spec in manifests if state.exists(spec)]
+            if existing:
+                logger.info("%s manifests already exist", len(existing))
+                manifests = [spec for spec in manifests if spec not in existing]
+        logger.info("%s %s manifests", action.capitalize(), len(manifests))
+        engine().apply_all(manifests, action)
+        state.record(action, manifests)
+
+    def dump(self, action):
+        """
+        Write the bundle as a multi document yaml file into the dump directory for review.
+        """
+        os.makedirs(self.dump_dir, exist_ok=True)
+        path = os.path.join(self.dump_dir, f"{self.name}-{action}.yaml")
+        with open(path, "w") as f:
+            f.write(self.stringify())
+        logger.info("Wrote manifests to %s", path)
+
+    def manifests(self):
+        """
+        Return the manifests sorted by kind, keeping the order they were added within a kind,
+        labeled with the owner.
+        """
+        specs = sorted(self.specs, key=kind_rank)
+        if self.owner:
+            specs = [label(spec, OWNER_LABEL, self.owner) for spec in specs]
+        return specs
+
+    def stringify(self):
+        """
+        Render the bundle as a multi document yaml string.
+        """
+        return "---\n".join(utils.stringify_yaml(sanitize(spec)) for spec in self.manifests())
+
+
+def label(spec, key, value):
+    """
+    Return a copy of a manifest with a label added.
+    """
+    metadata = dict(spec["metadata"])
+    metadata["labels"] = dict(metadata.get("labels") or {}, **{key: value})
+    return dict(spec, metadata=metadata)
+
+
+def kind_rank(spec):
+    """
+    Sort key placing a manifest by its kind in KIND_ORDER.
+    """
+    try:
+        return KIND_ORDER.index(spec["kind"])
+    except ValueError:
+        return len(KIND_ORDER)
@@ -0,0 +1,161 @@
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from . import binaries, utils
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIRECTORY = "~/.cache/addon-manager/charts"
+# MiB of chart archives kept before the least recently used ones are removed.
+DEFAULT_MAX_SIZE = 2048
+
+_settings = {"directory": None, "max_size": DEFAULT_MAX_SIZE}
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def configure(directory=DEFAULT_DIRECTORY, max_size=DEFAULT_MAX_SIZE):
+    """
+    Set the cache directory and its size limit in MiB, a directory of None disables the cache.
+    """
+    _settings["directory"] = os.path.expanduser(directory) if directory else None
+    _settings["max_size"] = max_size
+
+
+def archive(chart, version):
+    """
+    Return the path of the cached archive of a chart version, pulling it on first use. Archives
+    are stored by the sha256 of their content, a small ref file maps the chart and version to
+    it. Returns None when the chart can't be cached: the cache is off, the version isn't pinned
+    or the chart is a local path.
+    """
+    directory = _settings["directory"]
+    if not directory or not version or "/" not in chart or os.path.exists(chart):
+        return None
+    ref = os.path.join(directory, "refs", *ref_parts(chart), str(version))
+    with _lock(ref):
+        path = blob(directory, _read(ref))
+        if path:
+            # the modification time orders the archives for eviction
+            os.utime(path)
+            return path
+        path = pull(directory, chart, version)
+        if path is None:
+            return None
+        os.makedirs(os.path.dirname(ref), exist_ok=True)
+        _write(ref, os.path.basename(path)[: -len(".tgz")])
+    logger.info("Cached %s %s as %s", chart, version, os.path.basename(path))
+    evict(directory, _settings["max_size"], keep=path)
+    return path
+
+
+def blob(directory, digest):
+    """
+    Return the path of a cached archive by digest, None if it isn't cached.
+    """
+    if not digest:
+        return None
+    path = os.path.join(directory, "blobs", f"{digest}.tgz")
+    return path if os.path.exists(path) else None
+
+
+def evict(directory, max_size, keep=None):
+    """
+    Remove the least recently used archives until the cache fits in max_size MiB. The keep
+    archive is about to be installed and is never removed.
+    """
+    blobs = []
+    for path in glob.glob(os.path.join(directory, "blobs", "*.tgz")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        blobs.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in blobs)
+    for _, size, path in sorted(blobs):
+        if total <= max_size * 1024 * 1024:
+            break
+        if path == keep:
+            continue
+        try:
+            os.unlink(path)
+            logger.info("Evicted %s from the chart cache", os.path.basename(path))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def pull(directory, chart, version):
+    """
+    Download a chart archive into the cache, returns its path or None if helm pull failed.
+    """
+    os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+    download = tempfile.mkdtemp(prefix="pull-", dir=directory)
+    try:
+        helm = binaries.path("helm")
+        code, _ = utils.capture_command(
+            [helm, "pull", chart, "--version", str(version), "--destination", download]
+        )
+        archives = glob.glob(os.path.join(download, "*.tgz"))
+        if code != 0 or len(archives) != 1:
+            logger.warning("Unable to pull %s %s, installing from the repo", chart, version)
+            return None
+        digest = sha256(archives[0])
+        path = os.path.join(directory, "blobs", f"{digest}.tgz")
+        os.replace(archives[0], path)
+        return path
+    finally:
+        shutil.rmtree(download, ignore_errors=True)
+
+
+def ref_parts(chart):
+    """
+    Split a chart reference (repo/chart or oci://registry/path/chart) into safe path parts.
+    """
+    parts = [part for part in chart.replace("://", "/").split("/") if part not in ["", ".", ".."]]
+    return [part.replace(":", "_") for part in parts]
+
+
+def sha256(path):
+    """
+    Hash the content of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _lock(key):
+    """
+    Return the lock serializing pulls of the same chart version within this process.
+    """
+    with _locks_lock:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def _read(path):
+    """
+    Read a ref file, None if it doesn't exist.
+    """
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _write(path, content):
+    """
+    Replace a ref file atomically, other processes sharing the cache never see a partial ref.
+    """
+    temp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    with open(temp, "w") as f:
+        f.write(content)
+    os.replace(temp, path)
@@ -0,0 +1,367 @@
+import functools
+import hashlib
+import logging
+import signal
+import threading
+import time
+
+from . import repos as helm_repos
+from . import schema, state, trace, utils
+from .apply import FIELD_MANAGER, engine
+from .bundle import OWNER_LABEL
+from .graph import DependencyError
+from .kube import Manager
+
+logger = logging.getLogger(__name__)
+
+# Longest single watch request, the api server closes watches on its own after a while anyway.
+WATCH_SECONDS = 300
+HELM_RELEASE_SELECTOR = "owner=helm"
+
+
+class WorkQueue(object):
+    def __init__(self, min_interval=10, max_backoff=600):
+        """
+        Coalescing, rate limited queue of the addons to reconcile. An addon queued several times
+        before it runs is reconciled once, create wins over upgrade. An addon runs at most once
+        per min_interval seconds, an addon that failed backs off exponentially up to max_backoff.
+        """
+        self.configure(min_interval, max_backoff)
+        self.pending = {}
+        self.not_before = {}
+        self.failures = {}
+        self.condition = threading.Condition()
+
+    def configure(self, min_interval, max_backoff):
+        """
+        Set the rate limits, they apply from the next run of each addon.
+        """
+        self.min_interval = min_interval
+        self.max_backoff = max_backoff
+
+    def add(self, name, action="upgrade"):
+        """
+        Queue an addon for the given action, create or upgrade.
+        """
+        with self.condition:
+            if self.pending.get(name) != "create":
+                self.pending[name] = action
+            self.condition.notify()
+
+    def get(self, stop):
+        """
+        Block until addons are due, then return all of them as {name: action}. Returns an empty
+        dict once stop is set.
+        """
+        with self.condition:
+            while not stop.is_set():
+                now = time.monotonic()
+                due = {
+                    name: action
+                    for name, action in self.pending.items()
+                    if self.not_before.get(name, 0) <= now
+                }
+                if due:
+                    for name in due:
+                        del self.pending[name]
+                    return due
+                waits = [self.not_before[name] - now for name in self.pending]
+                # wake up regularly to notice stop
+                self.condition.wait(min(waits + [1.0]))
+            return {}
+
+    def done(self, name, succeeded):
+        """
+        Rate limit the next run of an addon after it ran.
+        """
+        with self.condition:
+            if succeeded:
+                self.failures.pop(name, None)
+                delay = self.min_interval
+            else:
+                self.failures[name] = self.failures.get(name, 0) + 1
+                delay = min(self.min_interval * 2 ** self.failures[name], self.max_backoff)
+                logger.info("Retrying %s in %ss", name, delay)
+            self.not_before[name] = time.monotonic() + delay
+            self.condition.notify()
+
+
+class Controller(object):
+    def __init__(self, args, path, addons_manager, config):
+        """
+        Keep the addons reconciled: the manager and its addons stay resident and addons are
+        queued when the config file changes, when the helm release, the namespace or a raw object
+        of an addon changes in the cluster, and on every resync. Release revisions and objects
+        written by the controller itself are ignored, so a reconcile doesn't queue another one.
+        """
+        self.args = args
+        self.path = path
+        self.manager = addons_manager
+        self.config = config
+        self.settings = config.controller
+        self.only = None if args.name == "all" else args.name.replace("-", "_")
+        self.queue = WorkQueue(self.settings.min_interval, self.settings.max_backoff)
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.fingerprint = fingerprint(path)
+        # {(namespace, release): revision} of the latest revision a reconcile wrote
+        self.written = {}
+        # watch events held back while a reconcile runs, None when none runs
+        self.deferred = None
+        self.events_lock = threading.Lock()
+
+    def run(self):
+        """
+        Reconcile until SIGINT or SIGTERM, the addons in flight are allowed to finish.
+        """
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(signum, lambda *_: self.stop.set())
+        watchers = {
+            "config": self.watch_config,
+            "releases": lambda: self.watch("Secret", HELM_RELEASE_SELECTOR),
+            "namespaces": lambda: self.watch("Namespace"),
+            "resync": self.resync,
+        }
+        # the raw objects of the addons, labeled with their addon by the bundles
+        for api_version, kind in state.MANAGED_KINDS:
+            if kind != "Namespace":
+                watchers[kind.lower()] = functools.partial(
+                    self.watch, kind, OWNER_LABEL, api_version
+                )
+        for name, target in watchers.items():
+            threading.Thread(target=target, name=f"watch-{name}", daemon=True).start()
+
+        for name in self.manager.changed():
+            self.enqueue(name, "upgrade")
+        logger.info("Watching %s and the cluster for changes", self.path)
+        while not self.stop.is_set():
+            batch = self.queue.get(self.stop)
+            if batch:
+                self.reconcile(batch)
+        logger.info("Stopped")
+
+    def enqueue(self, name, action):
+        """
+        Queue an enabled addon, when serving a single addon the others are left alone.
+        """
+        if name in self.manager.addons and self.only in [None, name]:
+            self.queue.add(name, action)
+
+    def reconcile(self, batch):
+        """
+        Run one batch of addons following depends_on and rate limit each of them.
+        """
+        with self.lock:
+            trace.configure(action="serve")
+            start = time.monotonic()
+            done = []
+            with self.events_lock:
+                self.deferred = []
+            logger.info("Reconciling %s", ", ".join(f"{n} ({a})" for n, a in batch.items()))
+            try:
+                self.manager.reconcile(batch, done)
+            except Exception as err:
+                if isinstance(err, utils.CommandError):
+                    for line in err.result.tail:
+                        logger.error("%s", line)
+                logger.error("Reconcile failed: %s", err)
+            finally:
+                self.record_written()
+                with self.events_lock:
+                    deferred, self.deferred = self.deferred, None
+                for event in deferred:
+                    self.changed_object(*event)
+            for name in batch:
+                self.queue.done(name, name in done)
+            elapsed = time.monotonic() - start
+            logger.info("Reconciled %s of %s addons in %.1fs", len(done), len(batch), elapsed)
+
+    def record_written(self):
+        """
+        Remember the revisions of the releases the last reconcile installed or upgraded, read
+        with one helm list once helm is done with them.
+        """
+        snapshot = state.current()
+        touched = set(snapshot.changed) if snapshot else set()
+        if not touched:
+            return
+        releases = state.ClusterState().list_helm_releases() or {}
+        for key in touched:
+            if key in releases:
+                revision = int(releases[key].get("revision") or 0)
+                self.written[key] = max(self.written.get(key, 0), revision)
+
+    def reload(self):
+        """
+        Load the changed config file, then queue the addons whose digest changed. A config that
+        doesn't load or resolve is logged and the current one is kept.
+        """
+        try:
+            config = schema.load(self.path)
+            addons_manager = Manager(args=self.args, config=config)
+        except (schema.ConfigError, DependencyError) as err:
+            logger.error("Keeping the current config, %s doesn't load: %s", self.path, err)
+            return
+        with self.lock:
+            self.manager = addons_manager
+            self.config = config
+            self.settings = config.controller
+            self.queue.configure(self.settings.min_interval, self.settings.max_backoff)
+            try:
+                helm_repos.sync(config.helm.repos, config.helm.repo_ttl)
+            except utils.CommandError as err:
+                logger.error("Unable to update the helm repos: %s", err)
+        for name in addons_manager.changed():
+            self.enqueue(name, "upgrade")
+
+    def resync(self):
+        """
+        Queue every addon every resync seconds, for drift no event reports.
+        """
+        while not self.stop.wait(self.settings.resync):
+            logger.info("Resync")
+            for name in self.manager.addons:
+                self.enqueue(name, "upgrade")
+
+    def watch(self, kind, label_selector=None, api_version="v1"):
+        """
+        Queue the addon owning a helm release secret or a raw object that changed, and recreate
+        an addon whose namespace was deleted. Objects are listed once, then watched from that
+        version on. A kind the cluster doesn't serve (yet) is looked up again every watch period.
+        """
+        from kubernetes.client.exceptions import ApiException
+        from kubernetes.dynamic.exceptions import ResourceNotFoundError
+
+        version = None
+        delay = 1
+        while not self.stop.is_set():
+            try:
+                client = engine().client
+                resource = engine().resource(api_version, kind)
+                if version is None:
+                    listed = client.get(resource, label_selector=label_selector).to_dict()
+                    version = listed["metadata"]["resourceVersion"]
+                for event in client.watch(
+                    resource,
+                    label_selector=label_selector,
+                    resource_version=version,
+                    timeout=WATCH_SECONDS,
+                ):
+                    if event["type"] == "ERROR":
+                        version = None
+                        break
+                    version = event["raw_object"]["metadata"]["resourceVersion"]
+                    self.changed_object(kind, event["type"], event["raw_object"])
+                delay = 1
+            except ResourceNotFoundError:
+                logger.info("%s is not served, looking again in %ss", kind, WATCH_SECONDS)
+                self.stop.wait(WATCH_SECONDS)
+            except ApiException as err:
+                if err.status == 410:
+                    # resourceVersion expired, start over from a fresh list
+                    version = None
+                    continue
+                logger.warning("Watch of %s failed, retrying in %ss: %s", kind, delay, err)
+                self.stop.wait(delay)
+                delay = min(delay * 2, 60)
+            except Exception as err:
+                logger.warning("Watch of %s failed, retrying in %ss: %s", kind, delay, err)
+                self.stop.wait(delay)
+                delay = min(delay * 2, 60)
+
+    def changed_object(self, kind, event, obj):
+        """
+        Map a watch event to the addon owning the object, by its owner label or its namespace,
+        and queue it. Raw objects only queue their addon when they drifted. Events of release
+        revisions the controller wrote itself, or older ones it superseded or helm pruned, are
+        dropped, except for the delete of the deployed revision (an uninstall). Events seen while
+        a reconcile runs are handled once it finished.
+        """
+        with self.events_lock:
+            if self.deferred is not None:
+                self.deferred.append((kind, event, obj))
+                return
+        owner = (obj["metadata"].get("labels") or {}).get(OWNER_LABEL)
+        if owner:
+            if owner in self.manager.addons and drifted(event, obj):
+                name = obj["metadata"]["name"]
+                logger.info("%s %s %s, queueing %s", kind, name, event.lower(), owner)
+                self.enqueue(owner, "upgrade")
+            return
+        if kind == "Namespace":
+            if event != "DELETED":
+                return
+            namespace, action = obj["metadata"]["name"], "create"
+        else:
+            namespace, action = obj["metadata"].get("namespace"), "upgrade"
+            if self.own_revision(event, obj):
+                return
+        name = (namespace or "").replace("-", "_")
+        if name in self.manager.addons:
+            logger.info("%s in %s %s, queueing %s", kind, namespace, event.lower(), name)
+            self.enqueue(name, action)
+
+    def own_revision(self, event, obj):
+        """
+        Check if a helm release secret event is about a revision a reconcile wrote, or one older.
+        """
+        labels = obj["metadata"].get("labels") or {}
+        key = (obj["metadata"].get("namespace"), labels.get("name"))
+        try:
+            revision = int(labels.get("version") or 0)
+        except ValueError:
+            return False
+        if event == "DELETED" and labels.get("status") == "deployed":
+            return False
+        return 0 < revision <= self.written.get(key, 0)
+
+    def watch_config(self):
+        """
+        Reload the config file whenever its content changes.
+        """
+        while not self.stop.wait(self.settings.poll_interval):
+            current = fingerprint(self.path)
+            if current is None or current == self.fingerprint:
+                continue
+            self.fingerprint = current
+            logger.info("%s changed, reloading", self.path)
+            self.reload()
+
+
+def drifted(event, obj):
+    """
+    Check if a watch event of a raw object of an addon is a change made by someone else: a delete,
+    or a modification last written by another field manager. The writes of the manager and the
+    status updates of the controllers in the cluster are not drift.
+    """
+    if event == "DELETED":
+        return True
+    if event != "MODIFIED":
+        return False
+    writes = [
+        entry
+        for entry in obj["metadata"].get("managedFields") or []
+        if not entry.get("subresource")
+    ]
+    if not writes:
+        return False
+    latest = max(writes, key=lambda entry: entry.get("time") or "")
+    return latest.get("manager") != FIELD_MANAGER
+
+
+def fingerprint(path):
+    """
+    Hash the content of the config file, None while it can't be read (being replaced).
+    """
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def serve(args, path, addons_manager, config):
+    """
+    Run the controller for the cluster until stopped.
+    """
+    Controller(args, path, addons_manager, config).run()
@@ -0,0 +1,59 @@
+import hashlib
+import json
+import logging
+from importlib import resources
+
+from . import manifest
+from .apply import engine
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = "kube-system"
+NAME = "addon-manager-digests"
+
+
+def digest(name, config):
+    """
+    Fingerprint what an addon is deployed from: its config section, which holds the chart
+    versions, and the source of its module, which holds everything else.
+    """
+    content = hashlib.sha256()
+    content.update(json.dumps(config or {}, sort_keys=True, default=str).encode())
+    content.update(resources.files("manager.addons").joinpath(f"{name}.py").read_bytes())
+    return content.hexdigest()
+
+
+def load():
+    """
+    Return the digests ({addon: digest}) of the last successful run on the cluster, empty if
+    the addon manager hasn't run on it yet.
+    """
+    from kubernetes.dynamic.exceptions import NotFoundError
+
+    try:
+        resource = engine().resource("v1", "ConfigMap")
+        configmap = engine().client.get(resource, name=NAME, namespace=NAMESPACE).to_dict()
+    except NotFoundError:
+        logger.info("No digests stored in %s/%s yet", NAMESPACE, NAME)
+        return {}
+    return configmap.get("data") or {}
+
+
+def save(digests):
+    """
+    Store the digests of every addon on the cluster. The whole map is applied each time, a
+    server side apply drops the keys it isn't sent.
+    """
+    manifest(
+        "apply",
+        {
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "metadata": {
+                "name": NAME,
+                "namespace": NAMESPACE,
+                "labels": {"app.kubernetes.io/managed-by": "addon-manager"},
+            },
+            "data": dict(sorted(digests.items())),
+        },
+    )
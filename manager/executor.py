@@ -0,0 +1,90 @@
+import contextvars
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from . import recorder, trace, utils
+
+logger = logging.getLogger(__name__)
+
+
+def run_graph(tasks, dependencies, parallelism=1):
+    """
+    Run the callables in tasks ({name: callable}) on a bounded worker pool. A task is started as
+    soon as every name listed for it in dependencies ({name: [names]}) has finished. Ready tasks
+    are started in the order they appear in tasks so runs are deterministic. On the first failure
+    no new tasks are started, the in flight ones are allowed to finish and the error is raised.
+    """
+    pending = {name: set(dependencies.get(name, [])) & set(tasks) for name in tasks}
+    running = {}
+    failed = None
+
+    with ThreadPoolExecutor(max_workers=max(int(parallelism), 1)) as pool:
+        while pending or running:
+            if failed is None:
+                for name in [n for n, deps in pending.items() if not deps]:
+                    del pending[name]
+                    running[pool.submit(_run_task, name, tasks[name])] = name
+            if not running:
+                if failed is None:
+                    raise RuntimeError(f"Unable to resolve dependencies for {', '.join(pending)}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as err:
+                    logger.error("%s failed: %s", name, err)
+                    if failed is None:
+                        failed = err
+                    continue
+                for deps in pending.values():
+                    deps.discard(name)
+
+    if failed is not None:
+        if pending:
+            logger.error("Skipped after failure: %s", ", ".join(pending))
+        raise failed
+
+
+def run_all(tasks, parallelism=1):
+    """
+    Run independent callables ({name: callable}) of the current addon at the same time on a
+    bounded worker pool, each logged as addon/name. Every task runs even when another one fails,
+    the first error is raised once all of them finished. While recording a plan the tasks run
+    one after the other, so the plan lists them in a stable order.
+    """
+    if recorder.active():
+        for task in tasks.values():
+            task()
+        return
+    parent = utils.current_name()
+
+    def run(name, task):
+        with utils.log_prefix(f"{parent}/{name}" if parent else name):
+            with trace.span(name, "release", addon=parent):
+                return task()
+
+    with ThreadPoolExecutor(max_workers=max(min(int(parallelism), len(tasks)), 1)) as pool:
+        futures = {
+            name: pool.submit(contextvars.copy_context().run, run, name, task)
+            for name, task in tasks.items()
+        }
+    failed = None
+    for name, future in futures.items():
+        try:
+            future.result()
+        except Exception as err:
+            logger.error("%s failed: %s", name, err)
+            failed = failed or err
+    if failed is not None:
+        raise failed
+
+
+def _run_task(name, task):
+    """
+    Run a single task with the log prefix of its name, timed as a whole.
+    """
+    with utils.log_prefix(name), trace.span(name, "addon"):
+        return task()
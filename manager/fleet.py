@@ -0,0 +1,180 @@
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ruamel.yaml import YAML
+
+from . import repos, schema, utils
+
+logger = logging.getLogger(__name__)
+
+# Per cluster options of a fleet file and the addon_manager.py flag each one maps to.
+CLUSTER_FLAGS = {
+    "cluster": "--cluster",
+    "environment": "--environment",
+    "project": "--project",
+    "region": "--region",
+}
+
+_output_lock = threading.Lock()
+
+
+def load(path, default_config):
+    """
+    Load a fleet file, a list of clusters with the provider, cluster name and config file of
+    each one. Clusters without a config file use default_config.
+    """
+    with open(path) as f:
+        fleet = YAML(typ="safe").load(f) or {}
+    clusters = []
+    for cluster in fleet.get("clusters") or []:
+        cluster = dict(cluster)
+        if cluster.get("provider") not in ["aws", "gcp"]:
+            raise ValueError(f"{cluster.get('name')}: provider must be aws or gcp.")
+        if not cluster.get("cluster"):
+            raise ValueError(f"{cluster.get('name')}: cluster is required.")
+        cluster.setdefault("name", cluster["cluster"])
+        cluster.setdefault("config", default_config)
+        clusters.append(cluster)
+    names = [cluster["name"] for cluster in clusters]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError(f"Cluster names must be unique: {', '.join(duplicates)}")
+    return fleet, clusters
+
+
+def add_helm_repos(clusters):
+    """
+    Add the helm repos of every config of the fleet and refresh their stale indexes once, for all
+    the clusters to share. The shortest repo_ttl of the configs wins.
+    """
+    wanted = {}
+    ttl = None
+    for path in sorted(set(cluster["config"] for cluster in clusters)):
+        config = schema.load(path).helm
+        for name, url in config.repos.items():
+            if wanted.setdefault(name, url) != url:
+                raise ValueError(f"helm repo {name} has different urls in the fleet configs.")
+        ttl = config.repo_ttl if ttl is None else min(ttl, config.repo_ttl)
+    repos.sync(wanted, repos.DEFAULT_TTL if ttl is None else ttl)
+
+
+def command(script, args, cluster):
+    """
+    Build the addon_manager.py command line that runs the fleet action on one cluster.
+    """
+    command = [sys.executable, script, "--config-file", cluster["config"], "--skip-helm-repos"]
+    command.extend(["--parallelism", str(cluster.get("parallelism", args.parallelism))])
+    if args.dump_manifests:
+        command.extend(["--dump-manifests", os.path.join(args.dump_manifests, cluster["name"])])
+    if args.force_upgrade:
+        command.append("--force-upgrade")
+    if args.incremental:
+        command.append("--incremental")
+    if args.trace_file:
+        root, extension = os.path.splitext(args.trace_file)
+        command.extend(["--trace-file", f"{root}-{cluster['name']}{extension or '.json'}"])
+    command.extend([cluster["provider"], "--action", args.action, "--name", args.name])
+    for option, flag in CLUSTER_FLAGS.items():
+        if cluster.get(option):
+            command.extend([flag, str(cluster[option])])
+    return command
+
+
+def environment(cluster, workdir, repository):
+    """
+    Environment of a cluster run: a kubeconfig and helm cache of its own, so concurrent runs
+    never switch each other's context or share downloads in flight.
+    """
+    env = dict(os.environ)
+    env["KUBECONFIG"] = os.path.join(workdir, "kubeconfig")
+    env["HELM_CACHE_HOME"] = os.path.join(workdir, "helm-cache")
+    # the repos were refreshed once for the fleet, keep reading them from the shared location
+    env["HELM_REPOSITORY_CACHE"] = repository
+    if cluster["provider"] == "gcp" and cluster.get("project"):
+        env["CLOUDSDK_CORE_PROJECT"] = str(cluster["project"])
+    return env
+
+
+def run(args, script):
+    """
+    Run the action of args on every cluster of the fleet file, at most args.max_clusters at the
+    same time. The output of each cluster is prefixed with its name. Returns the results of the
+    clusters in the order of the fleet file.
+    """
+    fleet, clusters = load(args.fleet_file, args.config)
+    max_clusters = args.max_clusters or fleet.get("max_clusters") or len(clusters) or 1
+    root = tempfile.mkdtemp(prefix="addon-manager-fleet-")
+    try:
+        add_helm_repos(clusters)
+        repository = repos.cache_dir()
+
+        logger.info(
+            "Running %s on %s clusters, %s at a time", args.action, len(clusters), max_clusters
+        )
+        with ThreadPoolExecutor(max_workers=int(max_clusters)) as pool:
+            futures = [
+                pool.submit(run_cluster, command(script, args, cluster), cluster, root, repository)
+                for cluster in clusters
+            ]
+            return [future.result() for future in futures]
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def run_cluster(command, cluster, root, repository):
+    """
+    Run addon_manager.py for one cluster, streaming its output line by line.
+    """
+    workdir = os.path.join(root, "clusters", cluster["name"])
+    os.makedirs(workdir)
+    start = time.monotonic()
+    with utils.log_prefix(cluster["name"]):
+        logger.info("Starting %s", " ".join(command[1:]))
+    process = subprocess.Popen(
+        command,
+        env=environment(cluster, workdir, repository),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding="utf-8",
+        errors="replace",
+    )
+    for line in process.stdout:
+        with _output_lock:
+            sys.stdout.write(f"[{cluster['name']}] {line}")
+            sys.stdout.flush()
+    process.wait()
+    return {
+        "name": cluster["name"],
+        "cluster": cluster["cluster"],
+        "provider": cluster["provider"],
+        "returncode": process.returncode,
+        "seconds": time.monotonic() - start,
+    }
+
+
+def summary(results):
+    """
+    Render the results of a fleet run as a table.
+    """
+    rows = [["CLUSTER", "PROVIDER", "RESULT", "DURATION"]]
+    for result in results:
+        status = "ok" if result["returncode"] == 0 else f"failed ({result['returncode']})"
+        rows.append(
+            [
+                result["name"],
+                f"{result['provider']}/{result['cluster']}",
+                status,
+                f"{result['seconds']:.1f}s",
+            ]
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows
+    )
@@ -0,0 +1,110 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyError(Exception):
+    """
+    Raised when the depends_on graph of the enabled addons can't be resolved.
+    """
+
+
+class DependencyGraph(object):
+    def __init__(self, nodes, dependencies, known=None):
+        """
+        Resolve the dependency graph of nodes (ordered list) where dependencies maps a node to the
+        nodes it depends on. known is the set of every node that could exist, used to tell a
+        dependency on a disabled node apart from one on a node that doesn't exist at all.
+        """
+        self.nodes = list(nodes)
+        self.dependencies = {
+            node: list(dict.fromkeys(dependencies.get(node, []))) for node in self.nodes
+        }
+        self.known = set(known or self.nodes)
+        self.check_dangling()
+        self.levels = self.resolve_levels()
+
+    def check_dangling(self):
+        """
+        Raise for any depends_on entry that points at a node outside of the graph.
+        """
+        enabled = set(self.nodes)
+        for node in self.nodes:
+            for dep in self.dependencies[node]:
+                if dep in enabled:
+                    continue
+                if dep in self.known:
+                    raise DependencyError(f"{node} -> {dep}: {dep} is not enabled.")
+                raise DependencyError(f"{node} -> {dep}: {dep} is not a valid addon name.")
+
+    def dependents(self):
+        """
+        Map each node to the nodes that depend on it.
+        """
+        dependents = {node: [] for node in self.nodes}
+        for node in self.nodes:
+            for dep in self.dependencies[node]:
+                dependents[dep].append(node)
+        return dependents
+
+    def downstream(self, nodes):
+        """
+        Return the given nodes and every node that depends on them, directly or not, in order.
+        """
+        dependents = self.dependents()
+        reached = set()
+        stack = [node for node in nodes if node in dependents]
+        while stack:
+            node = stack.pop()
+            if node not in reached:
+                reached.add(node)
+                stack.extend(dependents[node])
+        return [node for node in self.order() if node in reached]
+
+    def find_cycle(self, remaining):
+        """
+        Return one dependency cycle among the remaining nodes as a path, first node repeated last.
+        """
+        path = []
+        position = {}
+        node = remaining[0]
+        remaining = set(remaining)
+        while node not in position:
+            position[node] = len(path)
+            path.append(node)
+            node = next(dep for dep in self.dependencies[node] if dep in remaining)
+        return path[position[node] :] + [node]
+
+    def order(self):
+        """
+        Flatten the levels into a single install order.
+        """
+        return [node for level in self.levels for node in level]
+
+    def resolve_levels(self):
+        """
+        Group the nodes into topological levels with Kahn's algorithm. Every node of a level only
+        depends on nodes of earlier levels, so a level can run fully in parallel.
+        """
+        index = {node: i for i, node in enumerate(self.nodes)}
+        indegree = {node: len(self.dependencies[node]) for node in self.nodes}
+        dependents = self.dependents()
+        levels = []
+        level = [node for node in self.nodes if indegree[node] == 0]
+        resolved = 0
+        while level:
+            levels.append(level)
+            resolved += len(level)
+            ready = set()
+            for node in level:
+                for dependent in dependents[node]:
+                    indegree[dependent] -= 1
+                    if indegree[dependent] == 0:
+                        ready.add(dependent)
+            level = sorted(ready, key=index.get)
+
+        if resolved != len(self.nodes):
+            remaining = [node for node in self.nodes if indegree[node] > 0]
+            cycle = self.find_cycle(remaining)
+            raise DependencyError(f"Dependency cycle: {' -> '.join(cycle)}")
+        return levels
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds a deleted policy may stay attached while its roles are detached from it.
+DETACH_TIMEOUT = 300
+# Longest role name iam accepts.
+ROLE_NAME_LENGTH = 64
+
+
+class PolicyAttached(Exception):
+    """
+    Raised when a policy is still attached to entities after the detach timeout.
+    """
+
+
+class NoOidcProvider(Exception):
+    """
+    Raised when the oidc issuer of an eks cluster has no iam identity provider.
+    """
+
+
+def role_name(name):
+    """
+    Return a valid role name for a name, names that are too long are cut and suffixed with their
+    hash so they stay unique.
+    """
+    if len(name) <= ROLE_NAME_LENGTH:
+        return name
+    suffix = hashlib.sha256(name.encode()).hexdigest()[:8]
+    return f"{name[:ROLE_NAME_LENGTH - len(suffix) - 1]}-{suffix}"
+
+
+class Iam(object):
+    def __init__(self, iam, sts, eks=None):
+        """
+        Provision iam policies and roles by name with the given boto3 clients. Policies and
+        roles are looked up by name or ARN, which is built from the account id. The account id
+        and the oidc provider of each cluster (from eks) are read once per session.
+        """
+        self.iam = iam
+        self.sts = sts
+        self.eks = eks
+        self.account = None
+        self.oidc_providers = {}
+        self.lock = threading.Lock()
+
+    def account_id(self):
+        """
+        Return the id of the account of the session, cached after the first call.
+        """
+        with self.lock:
+            if self.account is None:
+                self.account = self.sts.get_caller_identity()["Account"]
+            return self.account
+
+    def policy_arn(self, name):
+        """
+        Return the ARN of a customer managed policy of the account.
+        """
+        return f"arn:aws:iam::{self.account_id()}:policy/{name}"
+
+    def get_policy(self, name):
+        """
+        Return a policy by name, None if it doesn't exist.
+        """
+        try:
+            return self.iam.get_policy(PolicyArn=self.policy_arn(name))["Policy"]
+        except self.iam.exceptions.NoSuchEntityException:
+            return None
+
+    def ensure_policy(self, name, document):
+        """
+        Create a policy unless it exists and return its ARN once iam serves it, an existing
+        policy is left as it is.
+        """
+        arn = self.policy_arn(name)
+        if self.get_policy(name):
+            logger.info("IAM policy %s already exists", arn)
+            return arn
+        try:
+            arn = self.iam.create_policy(PolicyName=name, PolicyDocument=json.dumps(document))[
+                "Policy"
+            ]["Arn"]
+            logger.info("Created IAM policy %s", arn)
+        except self.iam.exceptions.EntityAlreadyExistsException:
+            logger.info("IAM policy %s was created concurrently", arn)
+        # iam is eventually consistent, attaching a policy it doesn't serve yet fails
+        self.iam.get_waiter("policy_exists").wait(
+            PolicyArn=arn, WaiterConfig={"Delay": 1, "MaxAttempts": 30}
+        )
+        return arn
+
+    def delete_policy(self, name, timeout=DETACH_TIMEOUT, backoff=1):
+        """
+        Delete a policy once it is detached from every entity, waiting with exponential backoff
+        from backoff seconds. A delete refused with DeleteConflict, iam is eventually consistent
+        and may not see a detach yet, backs off the same way. Its non default versions are
+        deleted first, iam refuses to delete a policy that has any. A policy that doesn't exist
+        is not an error.
+        """
+        arn = self.policy_arn(name)
+        deadline = time.monotonic() + timeout
+        delay = backoff
+        while True:
+            policy = self.get_policy(name)
+            if policy is None:
+                logger.info("IAM policy %s does not exist", arn)
+                return
+            if policy["AttachmentCount"] == 0:
+                try:
+                    self.delete_policy_versions(arn)
+                    self.iam.delete_policy(PolicyArn=arn)
+                    logger.info("Deleted IAM policy %s", arn)
+                    return
+                except self.iam.exceptions.NoSuchEntityException:
+                    logger.info("IAM policy %s was deleted concurrently", arn)
+                    return
+                except self.iam.exceptions.DeleteConflictException:
+                    reason = "still in use"
+            else:
+                reason = f"attached to {policy['AttachmentCount']} entities"
+            if time.monotonic() + delay > deadline:
+                raise PolicyAttached(f"IAM policy {arn} is {reason}")
+            logger.info("IAM policy %s is %s, checking again in %ss", arn, reason, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def delete_policy_versions(self, arn):
+        """
+        Delete the non default versions of a policy.
+        """
+        versions = self.iam.list_policy_versions(PolicyArn=arn)["Versions"]
+        for version in versions:
+            if not version["IsDefaultVersion"]:
+                self.iam.delete_policy_version(PolicyArn=arn, VersionId=version["VersionId"])
+
+    def oidc_provider(self, cluster):
+        """
+        Return the ARN and the issuer (without scheme) of the iam oidc provider of an eks
+        cluster, cached per cluster.
+        """
+        with self.lock:
+            if cluster in self.oidc_providers:
+                return self.oidc_providers[cluster]
+        issuer = self.eks.describe_cluster(name=cluster)["cluster"]["identity"]["oidc"]["issuer"]
+        issuer = issuer.replace("https://", "", 1)
+        arn = f"arn:aws:iam::{self.account_id()}:oidc-provider/{issuer}"
+        try:
+            self.iam.get_open_id_connect_provider(OpenIDConnectProviderArn=arn)
+        except self.iam.exceptions.NoSuchEntityException:
+            raise NoOidcProvider(
+                f"Cluster {cluster} has no iam oidc provider, associate one with "
+                f"`eksctl utils associate-iam-oidc-provider --cluster {cluster} --approve`"
+            )
+        with self.lock:
+            self.oidc_providers[cluster] = (arn, issuer)
+        return arn, issuer
+
+    def service_account_trust(self, cluster, namespace, service_account):
+        """
+        Return the trust policy letting a kubernetes service account of a cluster assume a role
+        through the oidc provider of the cluster (IRSA).
+        """
+        arn, issuer = self.oidc_provider(cluster)
+        return {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Effect": "Allow",
+                    "Principal": {"Federated": arn},
+                    "Action": "sts:AssumeRoleWithWebIdentity",
+                    "Condition": {
+                        "StringEquals": {
+                            f"{issuer}:sub": f"system:serviceaccount:{namespace}:{service_account}",
+                            f"{issuer}:aud": "sts.amazonaws.com",
+                        }
+                    },
+                }
+            ],
+        }
+
+    def ensure_role(self, name, trust, policy_arns=(), description=""):
+        """
+        Create a role unless it exists, keep its trust policy current and attach the policies.
+        Returns the ARN of the role once iam serves it.
+        """
+        try:
+            arn = self.iam.get_role(RoleName=name)["Role"]["Arn"]
+            self.iam.update_assume_role_policy(RoleName=name, PolicyDocument=json.dumps(trust))
+            logger.info("IAM role %s already exists", arn)
+        except self.iam.exceptions.NoSuchEntityException:
+            arn = self.iam.create_role(
+                RoleName=name, AssumeRolePolicyDocument=json.dumps(trust), Description=description
+            )["Role"]["Arn"]
+            self.iam.get_waiter("role_exists").wait(
+                RoleName=name, WaiterConfig={"Delay": 1, "MaxAttempts": 30}
+            )
+            logger.info("Created IAM role %s", arn)
+        for policy_arn in policy_arns:
+            # attaching an attached policy is a no-op
+            self.iam.attach_role_policy(RoleName=name, PolicyArn=policy_arn)
+        return arn
+
+    def delete_role(self, name):
+        """
+        Detach the managed policies of a role, delete its inline policies, then the role. A role
+        that doesn't exist is not an error.
+        """
+        try:
+            attached = self.iam.list_attached_role_policies(RoleName=name)["AttachedPolicies"]
+            for policy in attached:
+                self.iam.detach_role_policy(RoleName=name, PolicyArn=policy["PolicyArn"])
+            for policy_name in self.iam.list_role_policies(RoleName=name)["PolicyNames"]:
+                self.iam.delete_role_policy(RoleName=name, PolicyName=policy_name)
+            self.iam.delete_role(RoleName=name)
+            logger.info("Deleted IAM role %s", name)
+        except self.iam.exceptions.NoSuchEntityException:
+            logger.info("IAM role %s does not exist", name)
@@ -1,13 +1,51 @@
 import logging
+import threading
+from collections.abc import Mapping
 
 import manager.addons
 import manager.utils as utils
-from dotted_dict import PreserveKeysDottedDict as dd
 
-from . import BaseManager, helm, kubectl
+from . import BaseManager, charts, digests, plan, schema, state, wait
+from . import repos as helm_repos
+from .bundle import Bundle
+from .executor import run_graph
+from .graph import DependencyGraph
+from .recorder import recording
 
 logger = logging.getLogger(__name__)
 
+# Seconds the namespaces of deleted addons may take to finish terminating.
+NAMESPACE_DELETE_TIMEOUT = 900
+
+
+class Addons(Mapping):
+    def __init__(self, names, args, config):
+        """
+        The managers of the enabled addons in install order. An addon module is only imported,
+        and its manager created, the first time the addon is looked up.
+        """
+        self.names = names
+        self.args = args
+        self.config = config
+        self.managers = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        with self.lock:
+            if name not in self.managers:
+                self.managers[name] = manager.addons.load(name).Manager(
+                    args=self.args, config=self.config.addons[name], name=name
+                )
+            return self.managers[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
 
 class Manager(BaseManager):
     def post_init(self):
@@ -16,36 +54,59 @@ class Manager(BaseManager):
         """
         self.args = self.kwargs.get("args")
         self.config = self.kwargs.get("config")
+        self.parallelism = getattr(self.args, "parallelism", 1)
 
-        self.add_helm_repos(self.config.helm.repos.items())
+        self.addons = Addons(self.order_addons(), self.args, self.config)
 
-        self.addons = {}
-        for addon in self.order_addons():
-            self.addons[addon] = getattr(manager.addons, addon).Manager(
-                args=self.args, config=self.config.addons.get(addon)
-            )
+    def add_helm_repos(self, repos, ttl=helm_repos.DEFAULT_TTL, service="all"):
+        """
+        Make the helm repos ({name: url}) available with indexes no older than ttl seconds. When a
+        single addon is worked on, only the repos of its charts are refreshed.
+        """
+        only = None
+        service = service.replace("-", "_")
+        if service in self.addons and self.addons[service].repos is not None:
+            only = self.addons[service].repos
+        helm_repos.sync(dict(repos), ttl, only)
 
-    def add_helm_repos(self, repos):
+    def changed(self):
         """
-        Take list of repos [(name, url)] to add to helm in container.
+        Return the addons whose digest differs from the one stored by the last successful run,
+        and every addon that depends on them, in install order.
         """
-        for repo in repos:
-            helm(action=f"repo add {repo[0]} {repo[1]}", noout=True)
-        # helm(action="repo update", noout=True)
-        helm(action="repo update")
+        stored = digests.load()
+        changed = [name for name in self.addons if stored.get(name) != self.digest(name)]
+        names = self.graph.downstream(changed)
+        if names:
+            logger.info("Changed since the last run: %s", ", ".join(changed))
+            logger.info("Upgrading %s", ", ".join(names))
+        else:
+            logger.info("Nothing changed since the last run")
+        return names
 
     def delete(self, service):
         """
-        Delete the specified addon. If all, delete all addons.
+        Delete the specified addon. If all, delete all addons, dependents before their dependencies.
+        The namespaces of the deleted addons are deleted together once the addons are gone.
         """
         service = service.replace("-", "_")
         if service == "all":
-            for name, manager in list(self.addons.items())[::-1]:
-                manager.delete()
-                self.namespace("delete", name)
+            tasks = {name: self.addons[name].delete for name in list(self.addons)[::-1]}
+            done = []
+            try:
+                self.run_tracked(tasks, self.graph.dependents(), forget=True, done=done)
+            finally:
+                self.namespace("delete", done)
         else:
             self.addons[service].delete()
-            self.namespace("delete", service)
+            self.namespace("delete", [service])
+            self.record_digests([], forget=[service])
+
+    def digest(self, name):
+        """
+        Fingerprint the config section and code an addon is deployed from.
+        """
+        return digests.digest(name, schema.to_dict(self.config.addons[name]))
 
     def install(self, service="all"):
         """
@@ -53,63 +114,177 @@ class Manager(BaseManager):
         """
         service = service.replace("-", "_")
         if service == "all":
-            for service, manager in self.addons.items():
-                self.namespace("create", service)
-                manager.install()
+            tasks = {name: self.addons[name].install for name in self.addons}
+            self.run_tracked(tasks, self.graph.dependencies, namespaces=list(tasks))
         else:
-            self.namespace("create", service)
-            try:
-                self.addons[service].install()
-            except KeyError as err:
+            if service not in self.addons:
                 logging.error("%s is not a valid addon name", service)
+                return
+            self.run_tracked({service: self.addons[service].install}, {}, namespaces=[service])
+
+    def namespace(self, action, names):
+        """
+        Create or delete the namespaces of the given addons as one bundle. Creates leave existing
+        namespaces alone, deletes return once every namespace has finished terminating, followed
+        by a single watch.
+        """
+        namespaces = [name.replace("_", "-") for name in names]
+        if not namespaces:
+            return
+        bundle = Bundle("namespaces", dump_dir=getattr(self.args, "dump_manifests", None))
+        for namespace in namespaces:
+            bundle.add({"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": namespace}})
+        bundle.apply(action)
+        if action == "delete":
+            wait.deleted("v1", "Namespace", namespaces, timeout=NAMESPACE_DELETE_TIMEOUT)
 
-    def namespace(self, action, namespace):
+    def namespaces(self):
         """
-        Take specified action on the specified namespace.
+        Return the namespaces of the enabled addons.
         """
-        namespace = namespace.replace("_", "-")
-        kubectl(action=action, resource=f"namespace {namespace}")
+        return [name.replace("_", "-") for name in self.addons]
 
     def order_addons(self):
         """
         Handle processing of addons to order for use. Handles enable and dependency resolution.
         """
-        addons = [a for a in dir(manager.addons) if a[0] != "_"]
+        addons = manager.addons.names()
         enable = []
-        disabled = []
-        if self.args.providers == "aws":
-            enable.append("cluster_autoscaler")
-        while (len(enable) + len(disabled)) != len(addons):
-            for addon in addons:
-                if addon in enable or addon in disabled:
+        dependencies = {}
+        for addon in addons:
+            config = self.config.addons[addon]
+            forced = addon == "cluster_autoscaler" and self.args.providers == "aws"
+            if config.enabled or forced:
+                enable.append(addon)
+                dependencies[addon] = [dep.replace("-", "_") for dep in config.depends_on]
+        self.graph = DependencyGraph(enable, dependencies, known=addons)
+        return self.graph.order()
+
+    def plan(self):
+        """
+        Return the resolved topological levels, every addon of a level can run at the same time.
+        """
+        return {
+            "levels": self.graph.levels,
+            "parallelism": max((len(level) for level in self.graph.levels), default=0),
+        }
+
+    def diff(self, service="all"):
+        """
+        Work out what upgrading the addons would change, without changing anything: every addon
+        is rendered through its upgrade logic with helm, kubectl and the api recorded instead of
+        run, then compared with the live state of the cluster.
+        """
+        rendered = self.render(service)
+        live = state.ClusterState(self.namespaces()).load(plan.kinds(rendered), self.parallelism)
+        return plan.changes(rendered, live)
+
+    def prefetch(self, service="all"):
+        """
+        Pull the pinned chart versions of the addons into the local chart cache, all at once.
+        """
+        pinned = {}
+        for name, recorded in self.render(service).items():
+            for release in recorded.releases:
+                if release["action"] == "delete" or not release["chart"]:
+                    continue
+                if not release["version"]:
+                    logger.info("%s is not pinned to a version, not cached", release["chart"])
                     continue
-                config = self.config.addons.get(addon, dd({"enabled": True}))
-                if config.enabled is True:
-                    if config.get("depends_on", None):
-                        found = True
-                        for dep in config.depends_on:
-                            dep = dep.replace("-", "_")
-                            if dep not in enable:
-                                found = False
-                                break
-                        if found:
-                            if addon not in enable:
-                                enable.append(addon)
-                    else:
-                        if addon not in enable:
-                            enable.append(addon)
-                else:
-                    if addon not in disabled:
-                        disabled.append(addon)
-        return enable
+                pinned[f"{release['chart']} {release['version']}"] = release
+
+        def task(release):
+            return lambda: charts.archive(release["chart"], release["version"])
+
+        run_graph({key: task(release) for key, release in pinned.items()}, {}, self.parallelism)
+        logger.info("Prefetched %s charts", len(pinned))
+
+    def reconcile(self, actions, done=None):
+        """
+        Create or upgrade the given addons ({name: action}) following depends_on, for the
+        controller. Addons that aren't enabled are ignored.
+        """
+        tasks = {}
+        for name in self.addons:
+            if actions.get(name) == "create":
+                tasks[name] = self.addons[name].install
+            elif actions.get(name) == "upgrade":
+                tasks[name] = self.addons[name].upgrade
+        created = [name for name in tasks if actions[name] == "create"]
+        self.run_tracked(tasks, self.graph.dependencies, done=done, namespaces=created)
+
+    def record_digests(self, names, forget=()):
+        """
+        Store the digests of the given addons on the cluster and drop the ones of the addons to
+        forget, which the next incremental run then treats as changed.
+        """
+        if not names and not forget:
+            return
+        stored = digests.load()
+        for name in forget:
+            stored.pop(name, None)
+        for name in names:
+            stored[name] = self.digest(name)
+        digests.save(stored)
+
+    def render(self, service="all"):
+        """
+        Record the upgrade of the addons. Recording never waits on the cluster, so every addon
+        is rendered at the same time regardless of dependencies.
+        """
+        service = service.replace("-", "_")
+        names = list(self.addons) if service == "all" else [service]
+        rendered = {}
+
+        def task(name):
+            def record():
+                with recording() as recorder:
+                    self.addons[name].upgrade()
+                rendered[name] = recorder
+
+            return record
+
+        run_graph({name: task(name) for name in names}, {}, self.parallelism)
+        return {name: rendered[name] for name in names}
+
+    def run_tracked(self, tasks, dependencies, forget=False, done=None, namespaces=()):
+        """
+        Take the cluster snapshot the addons consult, create the namespaces of the given addons
+        all at once, run the addon tasks with run_graph, then record the digests of the addons
+        that finished, also when another one failed. The addons that failed or never started lose
+        theirs. With forget every digest of the tasks is dropped, for deletes. The names of the
+        finished addons are appended to done.
+        """
+        done = [] if done is None else done
+        if tasks:
+            state.snapshot(self.parallelism, self.namespaces())
+            self.namespace("create", namespaces)
+
+        def track(name, task):
+            def run():
+                task()
+                done.append(name)
+
+            return run
+
+        tasks = {name: track(name, task) for name, task in tasks.items()}
+        try:
+            run_graph(tasks, dependencies, self.parallelism)
+        finally:
+            if forget:
+                self.record_digests([], forget=list(tasks))
+            else:
+                self.record_digests(done, forget=[name for name in tasks if name not in done])
 
     def upgrade(self, service="all"):
         """
-        Install all defined addons.
+        Upgrade all defined addons. Incremental runs only upgrade the addons that changed since
+        the last run and their dependents.
         """
         service = service.replace("-", "_")
         if service == "all":
-            for service, manager in self.addons.items():
-                manager.upgrade()
+            names = self.changed() if getattr(self.args, "incremental", False) else self.addons
+            tasks = {name: self.addons[name].upgrade for name in names}
+            self.run_tracked(tasks, self.graph.dependencies)
         else:
-            self.addons[service].upgrade()
+            self.run_tracked({service: self.addons[service].upgrade}, {})
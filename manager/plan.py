@@ -0,0 +1,172 @@
+import base64
+import difflib
+
+from . import utils
+from .apply import sanitize
+from .release import normalize
+
+# Symbols of the change set, the same as terraform so they read at a glance.
+ADD = "+"
+CHANGE = "~"
+DELETE = "-"
+UNCHANGED = "="
+UNKNOWN = "?"
+
+
+def changes(rendered, state):
+    """
+    Diff what every addon rendered ({addon: Recorder}) against the live state of the cluster.
+    Returns {addon: [(symbol, description, diff lines)]}.
+    """
+    result = {}
+    for addon, recorded in rendered.items():
+        entries = []
+        for release in recorded.releases:
+            entries.append(release_change(release, state))
+        for action, spec in recorded.manifests:
+            entries.append(manifest_change(action, spec, state))
+        for command in recorded.commands:
+            entries.append((UNKNOWN, f"run {' '.join(command)}", []))
+        result[addon] = entries
+    return result
+
+
+def kinds(rendered):
+    """
+    Return the (api_version, kind) of every manifest rendered, to list them in bulk.
+    """
+    found = []
+    for recorded in rendered.values():
+        for _, spec in recorded.manifests:
+            key = (spec["apiVersion"], spec["kind"])
+            if key not in found:
+                found.append(key)
+    return found
+
+
+def manifest_change(action, spec, state):
+    """
+    Compare a manifest with its live object. Only the fields set in the manifest are compared,
+    the api server fills in the rest. Secret data is never printed.
+    """
+    spec = sanitize(spec)
+    kind = spec["kind"]
+    name = spec["metadata"]["name"]
+    namespace = spec["metadata"].get("namespace")
+    description = f"{kind} {namespace}/{name}" if namespace else f"{kind} {name}"
+    live = state.get(spec["apiVersion"], kind, name, namespace)
+
+    if action == "delete":
+        return (DELETE if live else UNCHANGED, description, [])
+    if live is None:
+        return (ADD, description, [])
+    if action == "create":
+        # create leaves existing objects alone
+        return (UNCHANGED, description, [])
+
+    if kind == "Secret":
+        spec = secret_data(spec)
+    current = project(live, spec)
+    if current == spec:
+        return (UNCHANGED, description, [])
+    if kind == "Secret":
+        return (CHANGE, description, ["(secret data changed, not shown)"])
+    return (CHANGE, description, unified(current, spec))
+
+
+def project(live, desired):
+    """
+    Return the part of a live object that has a counterpart in the desired manifest.
+    """
+    if isinstance(desired, dict) and isinstance(live, dict):
+        return {key: project(live[key], value) for key, value in desired.items() if key in live}
+    if isinstance(desired, list) and isinstance(live, list) and len(desired) == len(live):
+        return [project(current, value) for current, value in zip(live, desired)]
+    return live
+
+
+def release_change(release, state):
+    """
+    Compare a helm release with its deployed revision: the chart version and the values.
+    """
+    description = f"release {release['namespace']}/{release['release']}"
+    live = state.release(release["release"], release["namespace"])
+    if release["action"] == "delete":
+        return (DELETE if live else UNCHANGED, description, [])
+
+    chart = release["chart"]
+    wanted = f"{chart} {release['version'] or '(latest)'}"
+    if live is None:
+        return (ADD, f"{description} {wanted}", [])
+
+    lines = []
+    version = str(release["version"] or "").lstrip("v")
+    if not version or version != str(live["version"]).lstrip("v"):
+        lines.append(f"chart {live['chart']} -> {wanted}")
+    values = normalize(release["values"])
+    if values != normalize(live["values"]):
+        lines.extend(unified(normalize(live["values"]), values))
+    return (CHANGE if lines else UNCHANGED, f"{description} {wanted}", lines)
+
+
+def report(planned):
+    """
+    Render the change set as text, unchanged entries are only counted.
+    """
+    lines = []
+    counts = {ADD: 0, CHANGE: 0, DELETE: 0, UNCHANGED: 0, UNKNOWN: 0}
+    for addon, entries in planned.items():
+        lines.append(f"{addon}:")
+        for symbol, description, diff in entries:
+            counts[symbol] += 1
+            if symbol == UNCHANGED:
+                continue
+            lines.append(f"  {symbol} {description}")
+            lines.extend(f"      {line}" for line in diff)
+        unchanged = len([entry for entry in entries if entry[0] == UNCHANGED])
+        if unchanged:
+            lines.append(f"  {UNCHANGED} {unchanged} unchanged")
+    lines.append(
+        f"Plan: {counts[ADD]} to add, {counts[CHANGE]} to change, {counts[DELETE]} to delete, "
+        f"{counts[UNCHANGED]} unchanged, {counts[UNKNOWN]} commands not diffed."
+    )
+    return "\n".join(lines)
+
+
+def secret_data(spec):
+    """
+    Fold the stringData of a secret into data, the way the api server stores it.
+    """
+    spec = dict(spec)
+    data = dict(spec.get("data") or {})
+    for key, value in (spec.pop("stringData", None) or {}).items():
+        data[key] = base64.b64encode(str(value).encode("utf-8")).decode("utf-8")
+    if data:
+        spec["data"] = data
+    return spec
+
+
+def unified(current, desired):
+    """
+    Return the unified diff of two objects rendered as yaml with sorted keys.
+    """
+    return list(
+        difflib.unified_diff(
+            utils.stringify_yaml(sort_keys(current)).splitlines(),
+            utils.stringify_yaml(sort_keys(desired)).splitlines(),
+            fromfile="live",
+            tofile="desired",
+            lineterm="",
+        )
+    )
+
+
+def sort_keys(data):
+    """
+    Sort mappings recursively so key order never shows up as a change.
+    """
+    if isinstance(data, dict):
+        return {key: sort_keys(data[key]) for key in sorted(data)}
+    if isinstance(data, list):
+        return [sort_keys(value) for value in data]
+    return data
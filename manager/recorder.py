@@ -0,0 +1,35 @@
+import contextvars
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("recorder", default=None)
+
+
+class Recorder(object):
+    def __init__(self):
+        """
+        Collect the helm releases, manifests and commands an addon would run, instead of running
+        them.
+        """
+        self.commands = []
+        self.manifests = []
+        self.releases = []
+
+
+def active():
+    """
+    Return the recorder of the current context, None when commands should really run.
+    """
+    return _current.get()
+
+
+@contextmanager
+def recording():
+    """
+    Record instead of running every helm, kubectl, manifest and command call made in the block.
+    """
+    recorder = Recorder()
+    token = _current.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current.reset(token)
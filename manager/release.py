@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+
+from . import binaries, state, utils
+from .apply import sanitize
+
+logger = logging.getLogger(__name__)
+
+_settings = {"force": False}
+
+
+def configure(force=False):
+    """
+    Set force to upgrade every release, even the ones that look unchanged.
+    """
+    _settings["force"] = force
+
+
+def listed(release, namespace):
+    """
+    Return the helm list entry of the deployed revision of a release, None if the release isn't
+    deployed. The cluster snapshot is used when it lists the release.
+    """
+    snapshot = state.current()
+    entry = state.UNKNOWN if snapshot is None else snapshot.helm_release(release, namespace)
+    if entry is not state.UNKNOWN:
+        return entry
+    helm = binaries.path("helm")
+    code, output = utils.capture_command(
+        [helm, "list", "--namespace", namespace, "--filter", f"^{release}$", "--output", "json"]
+    )
+    releases = json.loads(output) if code == 0 and output.strip() else []
+    releases = [r for r in releases if r.get("name") == release and r.get("status") == "deployed"]
+    return releases[0] if releases else None
+
+
+def deployed(release, namespace):
+    """
+    Return the chart and user supplied values of the deployed revision of a release, None if the
+    release isn't deployed. Only the values are read from helm when the cluster snapshot lists
+    the release.
+    """
+    entry = listed(release, namespace)
+    if entry is None:
+        return None
+
+    helm = binaries.path("helm")
+    code, output = utils.capture_command(
+        [helm, "get", "values", release, "--namespace", namespace, "--output", "json"]
+    )
+    if code != 0:
+        return None
+    return {"chart": entry["chart"], "values": json.loads(output or "null") or {}}
+
+
+def fingerprint(chart, version, values):
+    """
+    Hash a chart, its version and the values rendered for it.
+    """
+    document = json.dumps(
+        {"chart": chart, "version": version, "values": normalize(values)},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(document.encode("utf-8")).hexdigest()
+
+
+def normalize(values):
+    """
+    Convert values to what helm stores for them, plain json types with string keys.
+    """
+    return json.loads(json.dumps(sanitize(values or {}), default=str))
+
+
+def unchanged(release, namespace, chart, version, values):
+    """
+    Check if upgrading a release would be a no-op: the deployed revision uses the same chart
+    version and the same values. Releases without a pinned chart version are never considered
+    unchanged, there is no way to tell if a newer chart would be pulled.
+    """
+    if _settings["force"] or not version:
+        return False
+    current = deployed(release, namespace)
+    if current is None:
+        return False
+
+    name = chart.split("/")[-1]
+    if current["chart"] not in [f"{name}-{version}", f"{name}-v{str(version).lstrip('v')}"]:
+        return False
+    wanted = fingerprint(chart, version, values)
+    if fingerprint(chart, version, current["values"]) != wanted:
+        return False
+    logger.info("%s is up to date (%s), no-op", release, wanted[:12])
+    return True
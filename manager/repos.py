@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import time
+
+from . import binaries, helm, utils
+
+logger = logging.getLogger(__name__)
+
+# Seconds a repo index stays fresh when the config doesn't set helm.repo_ttl.
+DEFAULT_TTL = 3600
+
+
+def cache_dir():
+    """
+    Return the directory helm keeps the repo indexes in.
+    """
+    code, output = utils.capture_command([binaries.path("helm"), "env"])
+    if code == 0:
+        for line in output.splitlines():
+            key, _, value = line.partition("=")
+            if key == "HELM_REPOSITORY_CACHE":
+                return value.strip('"')
+    return os.path.join(os.path.expanduser("~"), ".cache", "helm", "repository")
+
+
+def registered():
+    """
+    Return the repos helm already knows as {name: url}.
+    """
+    helm = binaries.path("helm")
+    code, output = utils.capture_command([helm, "repo", "list", "--output", "json"])
+    if code != 0 or not output.strip():
+        # helm exits non zero when no repo is registered yet
+        return {}
+    return {repo["name"]: repo["url"] for repo in json.loads(output)}
+
+
+def stale(names, ttl):
+    """
+    Return the repos whose index is missing or older than ttl seconds.
+    """
+    directory = cache_dir()
+    now = time.time()
+    result = []
+    for name in names:
+        index = os.path.join(directory, f"{name}-index.yaml")
+        if not os.path.exists(index) or now - os.path.getmtime(index) > ttl:
+            result.append(name)
+    return result
+
+
+def sync(repos, ttl=DEFAULT_TTL, only=None):
+    """
+    Make sure helm knows the repos ({name: url}) with an index no older than ttl seconds. Repos
+    registered with the same url are left alone and only stale indexes are downloaded again,
+    missing repos are added at the same time.
+    only limits the work to the named repos. oci:// registries have no index and are skipped.
+    """
+    current = registered()
+    wanted = []
+    fresh = []
+    adds = []
+    for name, url in repos.items():
+        if only is not None and name not in only:
+            continue
+        if url.startswith("oci://"):
+            continue
+        wanted.append(name)
+        if current.get(name) == url:
+            continue
+        if name in current:
+            logger.info("helm repo %s moved from %s to %s", name, current[name], url)
+        command = [binaries.path("helm"), "repo", "add", name, url, "--force-update"]
+        adds.append(utils.start_command(command, noout=True))
+        # adding a repo downloads its index
+        fresh.append(name)
+    # helm locks the repo file, the adds can download their indexes at the same time
+    for add in adds:
+        add.result()
+
+    outdated = [name for name in stale(wanted, ttl) if name not in fresh]
+    if outdated:
+        helm(action=f"repo update {' '.join(outdated)}")
+    logger.info(
+        "helm repos: %s added, %s updated, %s fresh",
+        len(fresh),
+        len(outdated),
+        len(wanted) - len(fresh) - len(outdated),
+    )
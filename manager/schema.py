@@ -0,0 +1,470 @@
+import dataclasses
+import difflib
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import typing
+from dataclasses import dataclass, field
+from importlib import resources
+from typing import Literal, Optional, Union
+
+import manager.addons
+
+from . import charts
+from . import repos as helm_repos
+
+logger = logging.getLogger(__name__)
+
+# Compiled configs are kept here, one file per config path.
+CACHE_DIRECTORY = "~/.cache/addon-manager/config"
+# The modules the compiled configs depend on: the schema and the modules its defaults come from.
+SCHEMA_MODULES = ["schema.py", "charts.py", "repos.py"]
+
+
+class ConfigError(Exception):
+    """
+    Raised when a config file doesn't load or doesn't match the schema, with every problem found.
+    """
+
+
+# Sections of the config file. Every setting an addon reads is declared here with its type and
+# default, a section is built once per file and read through plain attributes. Settings that
+# aren't declared are reported and ignored.
+
+
+@dataclass(slots=True)
+class ChartCache:
+    directory: Optional[str] = charts.DEFAULT_DIRECTORY
+    max_size: int = charts.DEFAULT_MAX_SIZE
+
+
+@dataclass(slots=True)
+class Helm:
+    repos: dict[str, str] = field(default_factory=dict)
+    repo_ttl: int = helm_repos.DEFAULT_TTL
+    chart_cache: ChartCache = field(default_factory=ChartCache)
+
+
+@dataclass(slots=True)
+class Controller:
+    # Seconds between reads of the config file, how often addons may run and how long a failing
+    # addon backs off at most, and how often every addon is upgraded regardless of events.
+    poll_interval: int = 5
+    min_interval: int = 10
+    max_backoff: int = 600
+    resync: int = 3600
+
+
+@dataclass(slots=True)
+class Addon:
+    enabled: bool = True
+    depends_on: list[str] = field(default_factory=list)
+    # helm values overrides by release, for every cluster and by cluster
+    values: dict[str, dict] = field(default_factory=dict)
+    cluster_values: dict[str, dict[str, dict]] = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class Issuer:
+    name: str
+    type: Literal["acme", "private", "vault"]
+    server: Optional[str] = None
+    email: Optional[str] = None
+    zones: list[str] = field(default_factory=list)
+    role: Optional[str] = None
+    secret: Optional[str] = None
+
+
+@dataclass(slots=True)
+class ClusterIssuer:
+    enabled: bool = True
+    issuers: list[Issuer] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class CertManager(Addon):
+    version: Optional[str] = None
+    cluster_issuer: ClusterIssuer = field(default_factory=ClusterIssuer)
+    wait_timeout: int = 300
+
+
+@dataclass(slots=True)
+class EcrProxy(Addon):
+    version: Optional[str] = None
+    ecr_registry: str = None
+
+
+@dataclass(slots=True)
+class ExternalDns(Addon):
+    version: Optional[str] = None
+    cloudflare_email: str = None
+    zones: list[str] = None
+
+
+@dataclass(slots=True)
+class NginxIngress(Addon):
+    endpoints: list[Literal["private", "public"]] = None
+    issuer: str = "letsencrypt"
+    zones: list[str] = None
+    additional_dns: list[str] = field(default_factory=list)
+    # extra ports of the controller by protocol, {tcp: {port: namespace/service:port}}
+    additional_ports: dict[str, dict] = field(default_factory=dict)
+    cloudflare_ips: list[str] = field(default_factory=list)
+    certificate_timeout: int = 900
+
+
+@dataclass(slots=True)
+class Onepassword(Addon):
+    credentials_file: str = None
+    connect_version: Optional[str] = None
+    secrets_injector_version: Optional[str] = None
+    secrets_injector_chart_version: Optional[str] = None
+
+
+@dataclass(slots=True)
+class Openunison(Addon):
+    endpoint: Literal["private", "public"] = "private"
+    oauth_client_id: str = None
+    service_account_email: str = None
+
+
+@dataclass(slots=True)
+class Resources:
+    cpu: Union[str, int]
+    memory: str
+
+
+@dataclass(slots=True)
+class Pgadmin(Addon):
+    version: Optional[str] = None
+    resources: Resources = None
+
+
+@dataclass(slots=True)
+class PriorityClass:
+    name: str
+    value: int
+    preemptionPolicy: Literal["Never", "PreemptLowerPriority"]
+    globalDefault: Optional[bool] = None
+    description: Optional[str] = None
+    labels: dict[str, str] = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class PriorityClasses:
+    all: list[PriorityClass] = field(default_factory=list)
+    dev: list[PriorityClass] = field(default_factory=list)
+    prod: list[PriorityClass] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class RbacManager(Addon):
+    priorityclasses: PriorityClasses = field(default_factory=PriorityClasses)
+
+
+@dataclass(slots=True)
+class Chart(Addon):
+    version: Optional[str] = None
+
+
+# The section of every addon, addons without settings of their own take Addon.
+ADDONS = {
+    "cert_manager": CertManager,
+    "ecr_proxy": EcrProxy,
+    "external_dns": ExternalDns,
+    "nginx_ingress": NginxIngress,
+    "onepassword": Onepassword,
+    "openunison": Openunison,
+    "pgadmin": Pgadmin,
+    "rbac_manager": RbacManager,
+    "redis": Chart,
+    "sumologic": Chart,
+}
+# Settings of an addon section that are required once the addon is enabled, they default to
+# None so disabled addons can leave them out.
+REQUIRED = {
+    "ecr_proxy": ["ecr_registry"],
+    "external_dns": ["cloudflare_email", "zones"],
+    "nginx_ingress": ["endpoints", "zones"],
+    "onepassword": ["credentials_file"],
+    "openunison": ["oauth_client_id", "service_account_email"],
+    "pgadmin": ["resources"],
+}
+
+
+@dataclass(slots=True)
+class Config:
+    # binary names, or {name: path} to pin the path of a binary
+    required_binaries: list[Union[str, dict[str, str]]] = field(default_factory=list)
+    helm: Helm = field(default_factory=Helm)
+    controller: Controller = field(default_factory=Controller)
+    # a section per addon, addons missing from the file get their defaults
+    addons: dict[str, Addon] = field(default_factory=dict)
+
+
+def build(data, source="config"):
+    """
+    Build the config from the parsed yaml of a config file. Every problem is collected and
+    raised at once in a ConfigError, unknown settings are logged.
+    """
+    config, unknown = check(data, source)
+    report(unknown, source)
+    return config
+
+
+def check(data, source="config"):
+    """
+    Build the config like build, returning it with the unknown settings and sections instead of
+    logging them.
+    """
+    errors = []
+    unknown = []
+    data = {} if data is None else data
+    addons = None
+    if isinstance(data, dict):
+        data = dict(data)
+        addons = data.pop("addons", None)
+    config = _build(Config, data, "", errors, unknown)
+    if config is not None:
+        config.addons = _addons(addons, errors, unknown)
+    if errors:
+        raise ConfigError(f"{source} is invalid:\n  " + "\n  ".join(errors))
+    return config, unknown
+
+
+def report(unknown, source="config"):
+    """
+    Log the settings and sections of a config file the schema doesn't declare, they are ignored.
+    """
+    for problem in unknown:
+        logger.warning("%s: ignoring %s", source, problem)
+
+
+def _addons(data, errors, unknown):
+    """
+    Build the section of every addon, typed by ADDONS. Sections of addons that don't exist are
+    unknown, required settings are only checked for enabled addons.
+    """
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        errors.append(f"addons: expected a mapping, got {type(data).__name__}")
+        return {}
+    known = manager.addons.names()
+    for name in data:
+        if name not in known:
+            unknown.append(f"addons.{name}: no such addon{_suggest(name, known)}")
+    sections = {}
+    for name in known:
+        cls = ADDONS.get(name, Addon)
+        section = _build(cls, data.get(name) or {}, f"addons.{name}", errors, unknown)
+        if section is None:
+            continue
+        if section.enabled:
+            for setting in REQUIRED.get(name, []):
+                if getattr(section, setting) is None:
+                    errors.append(f"addons.{name}.{setting}: required")
+        sections[name] = section
+    return sections
+
+
+@functools.lru_cache(maxsize=None)
+def _hints(cls):
+    return typing.get_type_hints(cls)
+
+
+def _build(cls, data, path, errors, unknown):
+    """
+    Build a section from a mapping. Missing settings and values of the wrong type are added to
+    errors and built as None, unknown settings are added to unknown and left out.
+    """
+    if not isinstance(data, dict):
+        errors.append(f"{path or 'config'}: expected a mapping, got {type(data).__name__}")
+        return None
+    fields = {f.name: f for f in dataclasses.fields(cls)}
+    for key in data:
+        if key not in fields:
+            unknown.append(f"{_join(path, key)}: unknown setting{_suggest(key, fields)}")
+    kwargs = {}
+    for name, f in fields.items():
+        if name in data:
+            hint = _hints(cls)[name]
+            kwargs[name] = _convert(hint, data[name], _join(path, name), errors, unknown)
+        elif f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING:
+            errors.append(f"{_join(path, name)}: required")
+            kwargs[name] = None
+    return cls(**kwargs)
+
+
+def _convert(hint, value, path, errors, unknown):
+    """
+    Check a value against a type hint and convert it: sections are built, dicts and lists are
+    copied with their items converted.
+    """
+    origin = typing.get_origin(hint)
+    args = typing.get_args(hint)
+    if origin is Union:
+        if value is None and type(None) in args:
+            return None
+        for arg in args:
+            attempt, ignored = [], []
+            converted = _convert(arg, value, path, attempt, ignored)
+            if not attempt:
+                unknown.extend(ignored)
+                return converted
+        expected = " or ".join(_name(arg) for arg in args if arg is not type(None))
+        errors.append(f"{path}: expected {expected}, got {_describe(value)}")
+        return None
+    if origin is Literal:
+        if value not in args:
+            errors.append(f"{path}: expected one of {', '.join(map(str, args))}, got {value!r}")
+        return value
+    if origin is list:
+        if not isinstance(value, list):
+            errors.append(f"{path}: expected a list, got {_describe(value)}")
+            return None
+        return [
+            _convert(args[0], item, f"{path}[{i}]", errors, unknown)
+            for i, item in enumerate(value)
+        ]
+    if origin is dict or hint is dict:
+        if not isinstance(value, dict):
+            errors.append(f"{path}: expected a mapping, got {_describe(value)}")
+            return None
+        if not args:
+            return dict(value)
+        return {
+            k: _convert(args[1], v, _join(path, k), errors, unknown) for k, v in value.items()
+        }
+    if dataclasses.is_dataclass(hint):
+        return _build(hint, value, path, errors, unknown)
+    # bool is an int, an int setting set to true is a mistake
+    if not isinstance(value, hint) or hint is int and isinstance(value, bool):
+        errors.append(f"{path}: expected {_name(hint)}, got {_describe(value)}")
+        return None
+    return value
+
+
+def _join(path, key):
+    return f"{path}.{key}" if path else str(key)
+
+
+def _name(hint):
+    names = {str: "a string", int: "an integer", bool: "true or false"}
+    return names.get(hint) or ("a mapping" if typing.get_origin(hint) is dict else str(hint))
+
+
+def _describe(value):
+    return "nothing" if value is None else f"{value!r} ({type(value).__name__})"
+
+
+def _suggest(key, known):
+    matches = difflib.get_close_matches(str(key), list(known), n=1)
+    return f", did you mean {matches[0]}?" if matches else ""
+
+
+def to_dict(section):
+    """
+    Return a section as plain dicts and lists, to fingerprint or dump it.
+    """
+    return dataclasses.asdict(section) if section is not None else {}
+
+
+_lock = threading.Lock()
+_loaded = {}
+
+
+def load(path):
+    """
+    Load and compile a config file, once per process and file content. The compiled config is
+    cached on disk next to the file's mtime, size and hash: a file that didn't change is not
+    parsed again. Its unknown settings are logged once per process. Raises ConfigError when the
+    file can't be read or is invalid.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as err:
+        raise ConfigError(f"Unable to read {path}: {err}")
+    stamp = (stat.st_mtime_ns, stat.st_size, _schema_digest())
+    with _lock:
+        loaded = _loaded.get(os.path.abspath(path))
+        if loaded and loaded["stamp"] == stamp:
+            return loaded["config"]
+    cache = _cache_path(path)
+    cached = _read_cache(cache)
+    if cached and cached["stamp"] == stamp:
+        config, unknown = cached["config"], cached["unknown"]
+    else:
+        with open(path, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if cached and cached["digest"] == digest and cached["stamp"][2] == stamp[2]:
+            # touched, not changed
+            config, unknown = cached["config"], cached["unknown"]
+        else:
+            config, unknown = check(_parse(content, path), path)
+        entry = {"stamp": stamp, "digest": digest, "config": config, "unknown": unknown}
+        _write_cache(cache, entry)
+    report(unknown, path)
+    with _lock:
+        _loaded[os.path.abspath(path)] = {"stamp": stamp, "config": config}
+    return config
+
+
+def _parse(content, path):
+    """
+    Parse yaml with the safe loader, it is backed by libyaml when ruamel.yaml.clib is installed.
+    """
+    from ruamel.yaml import YAML, YAMLError
+
+    try:
+        return YAML(typ="safe").load(content)
+    except YAMLError as err:
+        raise ConfigError(f"{path} is not valid yaml: {err}")
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_digest():
+    """
+    Fingerprint the schema, the modules its defaults come from and the addons it is compiled
+    against, a change of any makes the cached configs stale.
+    """
+    content = hashlib.sha256()
+    for module in SCHEMA_MODULES:
+        content.update(resources.files("manager").joinpath(module).read_bytes())
+    content.update(",".join(manager.addons.names()).encode())
+    return content.hexdigest()
+
+
+def _cache_path(path):
+    name = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:32]
+    return os.path.join(os.path.expanduser(CACHE_DIRECTORY), f"{name}.pickle")
+
+
+def _read_cache(cache):
+    try:
+        with open(cache, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        logger.debug("Ignoring the unreadable config cache %s: %s", cache, err)
+        return None
+
+
+def _write_cache(cache, entry):
+    """
+    Replace the cache file atomically, a cache that can't be written only costs the next run a
+    parse.
+    """
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        temp = f"{cache}.{os.getpid()}.{threading.get_ident()}"
+        with open(temp, "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, cache)
+    except OSError as err:
+        logger.debug("Unable to write the config cache %s: %s", cache, err)
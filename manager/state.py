@@ -0,0 +1,282 @@
+import base64
+import gzip
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import binaries, trace, utils
+from .apply import engine, sanitize
+
+logger = logging.getLogger(__name__)
+
+# Helm keeps one secret per release revision, labeled with the status of the revision.
+HELM_RELEASE_SELECTOR = "owner=helm,status=deployed"
+# Label selectors of kinds that are listed partially, the helm release secrets are large and
+# read through their own selector.
+LIST_SELECTORS = {("v1", "Secret"): "owner!=helm"}
+# Namespaced kinds listed only in the namespaces of the addons when those are given, listing them
+# across the cluster would read the payload of every secret.
+SCOPED_KINDS = [("v1", "Secret")]
+# Namespaces of a scoped kind listed at the same time.
+SCOPE_WORKERS = 8
+# The kinds the addons create outside helm, listed in the snapshot taken before a run.
+MANAGED_KINDS = [
+    ("v1", "Namespace"),
+    ("v1", "Secret"),
+    ("rbac.authorization.k8s.io/v1", "ClusterRole"),
+    ("scheduling.k8s.io/v1", "PriorityClass"),
+    ("cert-manager.io/v1", "Certificate"),
+    ("cert-manager.io/v1", "ClusterIssuer"),
+    ("rbacmanager.reactiveops.io/v1beta1", "RBACDefinition"),
+]
+# What helm_release returns when the snapshot can't tell whether a release is deployed.
+UNKNOWN = object()
+
+_current = None
+_current_lock = threading.Lock()
+
+
+class ClusterState(object):
+    def __init__(self, namespaces=None):
+        """
+        Read only snapshot of the live cluster, fetched in bulk: one list call per kind across
+        every namespace instead of one get per object. With namespaces, the SCOPED_KINDS are
+        listed in those namespaces only, their objects elsewhere read as missing.
+        """
+        self.namespaces = namespaces
+        self.kinds = {}
+        self.lock = threading.Lock()
+        self.releases = None
+        self.helm_releases = None
+        self.changed = set()
+
+    def get(self, api_version, kind, name, namespace=None):
+        """
+        Return the live object of a kind, None if it doesn't exist. The kind is listed on first
+        use.
+        """
+        objects = self.list(api_version, kind)
+        if objects is None:
+            return None
+        return objects.get((namespace, name)) or objects.get((None, name))
+
+    def list(self, api_version, kind, strict=True):
+        """
+        Return every live object of a kind keyed by (namespace, name), None when the kind isn't
+        served by the cluster. Unless strict, a kind that can't be listed (forbidden) is logged
+        and left unlisted.
+        """
+        from kubernetes.client.exceptions import ApiException
+        from kubernetes.dynamic.exceptions import ResourceNotFoundError
+
+        key = (api_version, kind)
+        with self.lock:
+            if key in self.kinds:
+                return self.kinds[key]
+        try:
+            resource = engine().resource(api_version, kind)
+            scopes = [None]
+            if key in SCOPED_KINDS and self.namespaces is not None:
+                scopes = self.namespaces
+
+            def fetch(namespace):
+                listed = engine().client.get(
+                    resource, namespace=namespace, label_selector=LIST_SELECTORS.get(key)
+                )
+                return listed.to_dict().get("items") or []
+
+            items = []
+            with ThreadPoolExecutor(max_workers=max(min(len(scopes), SCOPE_WORKERS), 1)) as pool:
+                for listed in pool.map(fetch, scopes):
+                    items.extend(listed)
+            objects = {}
+            for item in items:
+                objects[(item["metadata"].get("namespace"), item["metadata"]["name"])] = item
+        except ResourceNotFoundError:
+            objects = None
+        except ApiException as err:
+            if strict:
+                raise
+            logger.warning("Unable to list %s: %s", kind, err.reason)
+            return None
+        with self.lock:
+            self.kinds[key] = objects
+        return objects
+
+    def load(self, kinds, parallelism=4, releases=None, strict=True):
+        """
+        List the given [(api_version, kind)] and the helm releases at the same time, releases
+        is the callable reading them, the helm storage secrets by default.
+        """
+        with ThreadPoolExecutor(max_workers=max(int(parallelism), 1)) as pool:
+            futures = [
+                pool.submit(self.list, api_version, kind, strict) for api_version, kind in kinds
+            ]
+            futures.append(pool.submit(releases or (lambda: self.release(None, None))))
+            for future in futures:
+                future.result()
+        return self
+
+    def known(self, api_version, kind, name, namespace=None):
+        """
+        Return an object of a kind that was already listed, None if it doesn't exist or its kind
+        wasn't listed. Never calls the api.
+        """
+        with self.lock:
+            objects = self.kinds.get((api_version, kind))
+        if objects is None:
+            return None
+        return objects.get((namespace, name)) or objects.get((None, name))
+
+    def record(self, action, spec):
+        """
+        Keep a listed kind current with a create, apply or delete made during the run. Created
+        and applied objects are kept as their manifest, they exist but their status is unknown.
+        """
+        key = (spec["apiVersion"], spec["kind"])
+        name = (spec["metadata"].get("namespace"), spec["metadata"]["name"])
+        with self.lock:
+            objects = self.kinds.get(key)
+            if objects is None:
+                return
+            if action == "delete":
+                objects.pop(name, None)
+                objects.pop((None, name[1]), None)
+            elif action == "apply" or name not in objects:
+                objects[name] = sanitize(spec)
+
+    def list_helm_releases(self):
+        """
+        List the deployed helm releases of every namespace with one helm call, keyed by
+        (namespace, name). A failing helm list leaves them unknown.
+        """
+        code, output = utils.capture_command(
+            [binaries.path("helm"), "list", "--all-namespaces", "--max", "0", "--output", "json"]
+        )
+        releases = None
+        if code == 0:
+            releases = {
+                (release["namespace"], release["name"]): release
+                for release in json.loads(output or "null") or []
+                if release.get("status") == "deployed"
+            }
+        with self.lock:
+            self.helm_releases = releases
+        return releases
+
+    def helm_release(self, name, namespace):
+        """
+        Return the helm list entry of a deployed release, None if it isn't deployed, UNKNOWN
+        when releases weren't listed or the release changed since.
+        """
+        with self.lock:
+            if self.helm_releases is None or (namespace, name) in self.changed:
+                return UNKNOWN
+            return self.helm_releases.get((namespace, name))
+
+    def release_changed(self, name, namespace):
+        """
+        Forget what was listed for a release helm installed, upgraded or deleted during the run.
+        """
+        with self.lock:
+            self.changed.add((namespace, name))
+
+    def release(self, name, namespace):
+        """
+        Return the deployed revision of a helm release as {chart, version, values}, None if it
+        isn't deployed. Every release is read at once from the helm storage secrets.
+        """
+        with self.lock:
+            releases = self.releases
+        if releases is None:
+            resource = engine().resource("v1", "Secret")
+            secrets = engine().client.get(resource, label_selector=HELM_RELEASE_SELECTOR)
+            releases = {}
+            for secret in secrets.to_dict().get("items") or []:
+                try:
+                    release = decode_release(secret["data"]["release"])
+                except (KeyError, TypeError, ValueError, OSError) as err:
+                    logger.warning(
+                        "Unable to read helm release %s: %s", secret["metadata"]["name"], err
+                    )
+                    continue
+                releases[(release["namespace"], release["name"])] = release
+            with self.lock:
+                self.releases = releases
+        return releases.get((namespace, name))
+
+
+def snapshot(parallelism=4, namespaces=None):
+    """
+    Take the snapshot the addons of a run consult: every object of the managed kinds, secrets
+    only in the given namespaces, and every deployed helm release, read at the same time.
+    Objects it holds aren't created again and waits for them start from it.
+    """
+    global _current
+    cluster_state = ClusterState(namespaces)
+    with trace.span("snapshot", "api"):
+        cluster_state.load(MANAGED_KINDS, parallelism, cluster_state.list_helm_releases, False)
+    counts = {kind: len(cluster_state.kinds.get((v, kind)) or {}) for v, kind in MANAGED_KINDS}
+    logger.info(
+        "Cluster snapshot: %s, %s helm releases",
+        ", ".join(f"{count} {kind}" for kind, count in counts.items()),
+        "unknown" if cluster_state.helm_releases is None else len(cluster_state.helm_releases),
+    )
+    with _current_lock:
+        _current = cluster_state
+    return cluster_state
+
+
+def current():
+    """
+    Return the snapshot of the run, None before one is taken.
+    """
+    with _current_lock:
+        return _current
+
+
+def exists(spec):
+    """
+    Check if the snapshot holds the object of a manifest.
+    """
+    cluster_state = current()
+    if cluster_state is None:
+        return False
+    metadata = spec["metadata"]
+    return (
+        cluster_state.known(
+            spec["apiVersion"], spec["kind"], metadata["name"], metadata.get("namespace")
+        )
+        is not None
+    )
+
+
+def record(action, specs):
+    """
+    Keep the snapshot current with the manifests a create, apply or delete was sent for.
+    """
+    cluster_state = current()
+    if cluster_state is not None:
+        for spec in specs:
+            cluster_state.record(action, spec)
+
+
+def decode_release(data):
+    """
+    Decode the release stored by helm in a secret: base64 encoded by kubernetes, then base64
+    encoded gzipped json by helm.
+    """
+    payload = base64.b64decode(base64.b64decode(data))
+    if payload[:2] == b"\x1f\x8b":
+        payload = gzip.decompress(payload)
+    release = json.loads(payload)
+    metadata = (release.get("chart") or {}).get("metadata") or {}
+    return {
+        "name": release["name"],
+        "namespace": release["namespace"],
+        "chart": f"{metadata.get('name')}-{metadata.get('version')}",
+        "version": metadata.get("version"),
+        "revision": release.get("version"),
+        "values": release.get("config") or {},
+    }
@@ -0,0 +1,155 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+# Rows of the summary table, the slowest steps come first.
+SUMMARY_ROWS = 25
+
+_settings = {"action": None, "start": time.monotonic(), "epoch": time.time()}
+_spans = []
+_lock = threading.Lock()
+
+
+def configure(action=None):
+    """
+    Set the action the spans of this run belong to and restart the run clock.
+    """
+    with _lock:
+        _settings["action"] = action
+        _settings["start"] = time.monotonic()
+        _settings["epoch"] = time.time()
+        del _spans[:]
+
+
+@contextmanager
+def span(step, category="step", addon=None):
+    """
+    Time the block as a step of the current addon. The yielded dict takes extra details, such
+    as the exit code of a command. A block that raises is recorded with the error.
+    """
+    details = {}
+    start = time.monotonic()
+    try:
+        yield details
+    except Exception as err:
+        details.setdefault("error", f"{type(err).__name__}: {err}")
+        raise
+    finally:
+        record(step, category, start, time.monotonic(), details, addon)
+
+
+def record(step, category, start, end, details=None, addon=None):
+    """
+    Add a finished span, start and end are time.monotonic() values.
+    """
+    if addon is None:
+        addon = utils.current_name() or "main"
+    with _lock:
+        _spans.append(
+            {
+                "addon": addon,
+                "step": step,
+                "category": category,
+                "action": _settings["action"],
+                "start": start - _settings["start"],
+                "duration": end - start,
+                "thread": threading.current_thread().name,
+                "details": details or {},
+            }
+        )
+
+
+def instrument(client):
+    """
+    Record every api call of a boto3 client as a span.
+    """
+
+    def before(context, **kwargs):
+        context["trace_start"] = time.monotonic()
+
+    def after(context, model, http_response=None, **kwargs):
+        start = context.get("trace_start")
+        if start is not None:
+            details = {"status": getattr(http_response, "status_code", None)}
+            step = f"{client.meta.service_model.service_name} {model.name}"
+            record(step, "aws", start, time.monotonic(), details)
+
+    client.meta.events.register("before-call", before)
+    client.meta.events.register("after-call", after)
+    return client
+
+
+def spans():
+    """
+    Return a copy of the spans recorded so far.
+    """
+    with _lock:
+        return list(_spans)
+
+
+def summary(limit=SUMMARY_ROWS):
+    """
+    Render the time spent per addon and step as a table, slowest first. The share is the part of
+    the wall clock of the run spent in the step, parallel steps can add up to more than 100%.
+    """
+    wall = max(time.monotonic() - _settings["start"], 1e-9)
+    totals = {}
+    for entry in spans():
+        key = (entry["addon"], entry["category"], entry["step"])
+        count, total = totals.get(key, (0, 0.0))
+        totals[key] = (count + 1, total + entry["duration"])
+
+    rows = [["ADDON", "STEP", "CALLS", "SECONDS", "SHARE"]]
+    ranked = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)
+    for (addon, category, step), (count, total) in ranked[:limit]:
+        name = step if category in ["step", "aws", "command"] else f"{category} {step}"
+        rows.append([addon, name, str(count), f"{total:.1f}", f"{100 * total / wall:.0f}%"])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = [
+        "  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows
+    ]
+    lines.append(f"Total wall clock {wall:.1f}s, {len(totals)} distinct steps")
+    return "\n".join(lines)
+
+
+def write(path):
+    """
+    Write the spans as a chrome trace (chrome://tracing, ui.perfetto.dev), one lane per thread.
+    """
+    events = []
+    threads = {}
+    for entry in spans():
+        tid = threads.setdefault(entry["thread"], len(threads) + 1)
+        args = dict(entry["details"], addon=entry["addon"], action=entry["action"])
+        events.append(
+            {
+                "name": entry["step"],
+                "cat": entry["category"],
+                "ph": "X",
+                "ts": int(entry["start"] * 1e6),
+                "dur": int(entry["duration"] * 1e6),
+                "pid": 1,
+                "tid": tid,
+                "args": args,
+            }
+        )
+    for name, tid in threads.items():
+        events.append(
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}}
+        )
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "traceEvents": events,
+                "displayTimeUnit": "ms",
+                "otherData": {"action": _settings["action"], "started": _settings["epoch"]},
+            },
+            f,
+        )
+    logger.info("Wrote %s spans to %s", len(events) - len(threads), path)
@@ -1,15 +1,84 @@
+import collections
+import contextvars
 import io
 import logging
 import os
 import random
+import shutil
 import string
 import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from dotted_dict import PreserveKeysDottedDict as dd
 from ruamel.yaml import YAML
 
+from . import recorder, trace
+
 logger = logging.getLogger(__name__)
 
+# Commands started with start_command that can run at the same time.
+COMMAND_WORKERS = 8
+# Lines of output kept from every command, to report why it failed.
+TAIL_LINES = 20
+
+_command_pool = None
+_command_pool_lock = threading.Lock()
+_context = threading.local()
+
+
+class PrefixFilter(logging.Filter):
+    """
+    Add the prefix of the current thread to log records as %(prefix)s.
+    """
+
+    def filter(self, record):
+        record.prefix = current_prefix()
+        return True
+
+
+def current_name():
+    """
+    Return the name the current thread works on (its log prefix), None if none is set.
+    """
+    return getattr(_context, "prefix", None)
+
+
+def current_prefix():
+    """
+    Return the log prefix set for the current thread, empty if none is set.
+    """
+    prefix = current_name()
+    if not prefix:
+        return ""
+    return f"[{prefix}] "
+
+
+class CommandResult(object):
+    def __init__(self, command, returncode, duration, tail):
+        """
+        Outcome of a command: the exit code, the seconds it ran and the last lines it printed.
+        """
+        self.command = command
+        self.duration = duration
+        self.returncode = returncode
+        self.tail = tail
+
+
+class CommandError(Exception):
+    """
+    Raised when a command exits non zero, the result holds the last lines it printed.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        message = f"{' '.join(result.command)} exited with {result.returncode}"
+        if result.tail:
+            message = f"{message}: {result.tail[-1]}"
+        super().__init__(message)
+
 
 def gen_password(length, numbers=True, special_characters=True):
     """
@@ -30,34 +99,150 @@ def gen_password(length, numbers=True, special_characters=True):
     return password.encode("utf-8")
 
 
-def objectify(data):
+@contextmanager
+def log_prefix(prefix):
+    """
+    Prefix all log lines emitted by the current thread with the given name.
+    """
+    previous = getattr(_context, "prefix", None)
+    _context.prefix = prefix
+    try:
+        yield
+    finally:
+        _context.prefix = previous
+
+
+def capture_command(command):
     """
-    Take json/dict and convert dot notation python object representation.
+    Exec the specified command and return its exit code and stdout, stderr is passed through.
     """
-    return dd(data)
+    with trace.span(step_name(command), "command") as details:
+        process = subprocess.run(command, shell=False, stdout=subprocess.PIPE, encoding="utf-8")
+        details["exit_code"] = process.returncode
+    return process.returncode, process.stdout
 
 
-def run_command(command, noout=None):
+def run_command(command, noout=None, stdin=None, check=True):
     """
-    Exec the specified command and push its stdout to stdout in realtime.
+    Exec the specified command, streaming its output to the log line by line with the prefix of
+    the current thread and the name of the binary. noout keeps the output out of the log, stdin
+    is an optional string written to the standard input of the command. Returns a CommandResult,
+    a non zero exit raises CommandError unless check is False. While recording a plan the
+    command is only recorded.
     """
-    if noout:
-        process = subprocess.Popen(
-            command,
-            shell=False,
-            cwd=os.getcwd(),
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-    else:
+    if recorder.active():
+        recorder.active().commands.append(list(command))
+        return CommandResult(command, 0, 0.0, [])
+
+    step = os.path.basename(command[0])
+    if not noout:
         logger.info("Running command '%s'", " ".join(command))
-        process = subprocess.Popen(command, shell=False, cwd=os.getcwd())
-        process.communicate()
+    with trace.span(step_name(command), "command") as details:
+        result = _run(command, step, noout, stdin)
+        details["exit_code"] = result.returncode
+    if check and result.returncode != 0:
+        raise CommandError(result)
+    return result
+
+
+def _run(command, step, noout, stdin):
+    """
+    Run a command to completion for run_command.
+    """
+    start = time.monotonic()
+    process = subprocess.Popen(
+        command,
+        shell=False,
+        cwd=os.getcwd(),
+        stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding="utf-8",
+        errors="replace",
+    )
+    if stdin is not None:
+        # written from a thread, a command can fill the output pipe before reading all of stdin
+        writer = threading.Thread(target=_write_stdin, args=(process, stdin), daemon=True)
+        writer.start()
+    tail = collections.deque(maxlen=TAIL_LINES)
+    for line in process.stdout:
+        line = line.rstrip("\n")
+        tail.append(line)
+        if not noout:
+            logger.info("%s: %s", step, line)
+    process.wait()
+    return CommandResult(command, process.returncode, time.monotonic() - start, list(tail))
+
+
+def step_name(command):
+    """
+    Name a command by its binary and subcommand, "helm upgrade" or "helm repo add", for timing.
+    """
+    words = [os.path.basename(command[0])]
+    previous = None
+    for arg in command[1:]:
+        if not arg.startswith("-") and previous not in ["--namespace", "-n"]:
+            words.append(arg)
+            if len(words) == 3 or words[1] not in ["container", "eks", "get", "repo"]:
+                break
+        previous = arg
+    return " ".join(words)
+
+
+def start_command(command, noout=None, stdin=None, check=True):
+    """
+    Start run_command on the shared command pool and return a future of its CommandResult, so a
+    caller can run several commands at the same time and collect every result (and failure).
+    """
+    global _command_pool
+    with _command_pool_lock:
+        if _command_pool is None:
+            _command_pool = ThreadPoolExecutor(max_workers=COMMAND_WORKERS)
+    prefix = getattr(_context, "prefix", None)
 
-    if process.returncode != 0:
-        return {"error": "exit code of {0}".format(process.returncode)}
-    else:
-        return {"error": None}
+    def run():
+        with log_prefix(prefix):
+            return run_command(command, noout, stdin=stdin, check=check)
+
+    # carries the recorder of a plan over to the pool thread
+    return _command_pool.submit(contextvars.copy_context().run, run)
+
+
+def _write_stdin(process, stdin):
+    """
+    Feed stdin to a command and close it so the command sees the end of its input.
+    """
+    try:
+        process.stdin.write(stdin)
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+
+
+@contextmanager
+def scratch_file(name, content):
+    """
+    Write content to a file only readable by us, on tmpfs when available, for commands that can
+    only read a path. The file is removed when the block exits, even on errors, so secrets are
+    never left behind.
+    """
+    directory = tempfile.mkdtemp(prefix="addon-manager-", dir=_scratch_root())
+    path = os.path.join(directory, name)
+    try:
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as f:
+            f.write(content)
+        yield path
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _scratch_root():
+    """
+    Prefer the shared memory tmpfs for scratch files so they never hit a disk.
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
 
 
 def stringify_yaml(yaml):
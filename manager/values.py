@@ -0,0 +1,110 @@
+import functools
+from collections.abc import Mapping
+
+from mergedeep import Strategy, merge
+
+# Node group the addons are scheduled on where the cluster has one.
+ADDONS_NODEGROUP = "addons"
+
+
+def layer(*layers):
+    """
+    Deep merge layers of helm values into new values, later layers win and lists are replaced.
+    Empty layers are skipped. The layers are copied, never changed, so shared fragments can be
+    layered as often as needed.
+    """
+    return merge({}, *[plain(values) for values in layers if values], strategy=Strategy.REPLACE)
+
+
+def plain(values):
+    """
+    Copy values into plain dicts and lists, any mapping yaml can't dump included.
+    """
+    if isinstance(values, Mapping):
+        return {key: plain(value) for key, value in values.items()}
+    if isinstance(values, list):
+        return [plain(value) for value in values]
+    return values
+
+
+def nest(path, values):
+    """
+    Wrap values under a dotted path, nest("a.b", v) is {"a": {"b": v}}.
+    """
+    for key in reversed(path.split(".") if path else []):
+        values = {key: values}
+    return values
+
+
+# The fragments below are shared by every addon and every render of the run: layer them, never
+# change them in place.
+
+
+@functools.lru_cache(maxsize=None)
+def node_selector(*paths, nodegroup=ADDONS_NODEGROUP):
+    """
+    Values pinning pods to a node group, at the top level or under each of the dotted paths.
+    """
+    selector = {"nodeSelector": {"nodegroup": nodegroup}}
+    return layer(*[nest(path, selector) for path in paths or [""]])
+
+
+@functools.lru_cache(maxsize=None)
+def not_on_fargate(*paths):
+    """
+    Values keeping pods off eks fargate nodes, under each of the dotted paths. For daemonsets,
+    fargate can't run them.
+    """
+    affinity = {
+        "affinity": {
+            "nodeAffinity": {
+                "requiredDuringSchedulingIgnoredDuringExecution": {
+                    "nodeSelectorTerms": [
+                        {
+                            "matchExpressions": [
+                                {
+                                    "key": "eks.amazonaws.com/compute-type",
+                                    "operator": "NotIn",
+                                    "values": ["fargate"],
+                                }
+                            ]
+                        }
+                    ]
+                }
+            }
+        }
+    }
+    return layer(*[nest(path, affinity) for path in paths or [""]])
+
+
+@functools.lru_cache(maxsize=None)
+def ingress_annotations(endpoint, issuer="letsencrypt", hostname=None):
+    """
+    Annotations of an ingress served by the nginx controller of an endpoint, with a certificate
+    from the cluster issuer and, for a hostname, its dns record.
+    """
+    dns_record = "proxied" if endpoint == "public" else "passthrough"
+    annotations = {
+        "kubernetes.io/ingress.class": f"nginx-{endpoint}",
+        "cert-manager.io/cluster-issuer": issuer,
+        f"external-dns/{dns_record}-record": "true",
+    }
+    if hostname:
+        annotations["external-dns.alpha.kubernetes.io/hostname"] = hostname
+        annotations["kubernetes.io/tls-acme"] = "true"
+    return annotations
+
+
+@functools.lru_cache(maxsize=None)
+def ingress(host, secret_name, endpoint="private", issuer="letsencrypt"):
+    """
+    The ingress block of a chart serving one host with tls, the chart specific hosts entry is
+    left to the addon.
+    """
+    return {
+        "ingress": {
+            "enabled": True,
+            "annotations": ingress_annotations(endpoint, issuer, host),
+            "tls": [{"hosts": [host], "secretName": secret_name}],
+        }
+    }
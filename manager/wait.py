@@ -0,0 +1,218 @@
+import logging
+import time
+
+from . import recorder, state, trace
+from .apply import engine
+
+logger = logging.getLogger(__name__)
+
+# Longest single watch request, the api server closes watches on its own after a while anyway.
+WATCH_SECONDS = 60
+
+
+class WaitTimeout(Exception):
+    """
+    Raised when a resource doesn't reach the expected state before its timeout.
+    """
+
+
+def wait_for(api_version, kind, name, condition, namespace=None, timeout=300, backoff=2):
+    """
+    Block until condition(object) holds for the named resource. The current state is read once,
+    then watch events are streamed so this returns the moment the condition holds. While the
+    kind isn't served yet (CRDs still installing) or the object doesn't exist, retries back off
+    exponentially from backoff seconds. Raises WaitTimeout after timeout seconds. Nothing is
+    waited for while recording a plan, nor for an object the cluster snapshot holds in the
+    expected state.
+    """
+    if recorder.active():
+        return {}
+    snapshot = state.current()
+    known = snapshot.known(api_version, kind, name, namespace) if snapshot else None
+    if known is not None and condition(known):
+        logger.info("%s/%s is ready", kind, name)
+        return known
+    with trace.span(f"{kind}/{name}", "wait") as details:
+        result = _wait(api_version, kind, name, condition, namespace, timeout, backoff)
+        details["outcome"] = "ready"
+        return result
+
+
+def _wait(api_version, kind, name, condition, namespace, timeout, backoff):
+    """
+    Read, then watch the resource until the condition holds, for wait_for.
+    """
+    from kubernetes.client.exceptions import ApiException
+    from kubernetes.dynamic.exceptions import NotFoundError, ResourceNotFoundError
+
+    deadline = time.monotonic() + timeout
+    delay = backoff
+    description = f"{kind}/{name}"
+    logger.info("Waiting up to %ss for %s", timeout, description)
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise WaitTimeout(f"Timed out after {timeout}s waiting for {description}")
+        try:
+            client = engine().client
+            resource = engine().resource(api_version, kind)
+            current = client.get(resource, name=name, namespace=namespace).to_dict()
+            if condition(current):
+                logger.info("%s is ready", description)
+                return current
+            for event in client.watch(
+                resource,
+                namespace=namespace,
+                name=name,
+                resource_version=current["metadata"]["resourceVersion"],
+                timeout=max(int(min(remaining, WATCH_SECONDS)), 1),
+            ):
+                if event["type"] == "ERROR":
+                    break
+                if event["type"] != "DELETED" and condition(event["raw_object"]):
+                    logger.info("%s is ready", description)
+                    return event["raw_object"]
+            delay = backoff
+            continue
+        except (NotFoundError, ResourceNotFoundError):
+            logger.info("%s does not exist yet, retrying in %ss", description, delay)
+        except ApiException as err:
+            if err.status != 410:
+                raise
+            # resourceVersion expired, start over from a fresh read
+            continue
+        time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        delay = min(delay * 2, 30)
+
+
+def deleted(api_version, kind, names, namespace=None, timeout=300):
+    """
+    Block until none of the named resources of a kind exist, namespaces keep terminating until
+    their finalizers ran. The kind is listed once, then a single watch follows the deletes of
+    every name. Raises WaitTimeout after timeout seconds. Nothing is waited for while recording a
+    plan.
+    """
+    if recorder.active() or not names:
+        return
+    with trace.span(f"{kind} deleted", "wait") as details:
+        _deleted(api_version, kind, set(names), namespace, timeout)
+        details["outcome"] = "deleted"
+
+
+def _deleted(api_version, kind, names, namespace, timeout):
+    """
+    List, then watch the kind until the named resources are gone, for deleted.
+    """
+    from kubernetes.client.exceptions import ApiException
+    from kubernetes.dynamic.exceptions import ResourceNotFoundError
+
+    deadline = time.monotonic() + timeout
+    pending = names
+    logger.info("Waiting up to %ss for %s %s to be deleted", timeout, len(names), kind)
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise WaitTimeout(
+                f"Timed out after {timeout}s waiting for {kind} {', '.join(sorted(pending))} "
+                "to be deleted"
+            )
+        try:
+            client = engine().client
+            resource = engine().resource(api_version, kind)
+            listed = client.get(resource, namespace=namespace).to_dict()
+            pending = names & {item["metadata"]["name"] for item in listed.get("items") or []}
+            if not pending:
+                logger.info("%s %s deleted", len(names), kind)
+                return
+            for event in client.watch(
+                resource,
+                namespace=namespace,
+                resource_version=listed["metadata"]["resourceVersion"],
+                timeout=max(int(min(remaining, WATCH_SECONDS)), 1),
+            ):
+                if event["type"] == "ERROR":
+                    break
+                if event["type"] == "DELETED":
+                    pending.discard(event["raw_object"]["metadata"]["name"])
+                    if not pending:
+                        logger.info("%s %s deleted", len(names), kind)
+                        return
+        except ResourceNotFoundError:
+            # the kind isn't served, none of its resources exist
+            return
+        except ApiException as err:
+            if err.status != 410:
+                raise
+            # resourceVersion expired, start over from a fresh list
+
+
+def has_condition(obj, condition_type, status="True"):
+    """
+    Check the status.conditions list of an object for a condition with the given status.
+    """
+    for condition in (obj.get("status") or {}).get("conditions") or []:
+        if condition.get("type") == condition_type:
+            return condition.get("status") == status
+    return False
+
+
+def certificate_ready(name, namespace, timeout=900):
+    """
+    Wait for a cert-manager certificate to be issued.
+    """
+    return wait_for(
+        "cert-manager.io/v1",
+        "Certificate",
+        name,
+        lambda obj: has_condition(obj, "Ready"),
+        namespace=namespace,
+        timeout=timeout,
+    )
+
+
+def crd_established(name, timeout=300):
+    """
+    Wait for a custom resource definition to be established, so its kind can be used.
+    """
+    return wait_for(
+        "apiextensions.k8s.io/v1",
+        "CustomResourceDefinition",
+        name,
+        lambda obj: has_condition(obj, "Established"),
+        timeout=timeout,
+    )
+
+
+def deployment_available(name, namespace, timeout=300):
+    """
+    Wait for the latest generation of a deployment to be rolled out and available.
+    """
+
+    def available(obj):
+        status = obj.get("status") or {}
+        return (
+            status.get("observedGeneration", 0) >= obj["metadata"].get("generation", 0)
+            and status.get("updatedReplicas", 0) >= (obj.get("spec") or {}).get("replicas", 1)
+            and has_condition(obj, "Available")
+        )
+
+    return wait_for("apps/v1", "Deployment", name, available, namespace=namespace, timeout=timeout)
+
+
+def secret_exists(name, namespace, timeout=300):
+    """
+    Wait for a secret to be created.
+    """
+    return wait_for("v1", "Secret", name, lambda obj: True, namespace=namespace, timeout=timeout)
+
+
+def webhook_ready(service, namespace, timeout=300):
+    """
+    Wait for the service behind an admission webhook to have a ready endpoint, so the api server
+    can call it.
+    """
+
+    def ready(obj):
+        return any(subset.get("addresses") for subset in obj.get("subsets") or [])
+
+    return wait_for("v1", "Endpoints", service, ready, namespace=namespace, timeout=timeout)
@@ -0,0 +1,126 @@
+from types import SimpleNamespace
+
+from manager import bundle, controller, schema, state
+
+
+def release_secret(name, namespace, revision, status):
+    return {
+        "metadata": {
+            "name": f"sh.helm.release.v1.{name}.v{revision}",
+            "namespace": namespace,
+            "labels": {"name": name, "owner": "helm", "status": status, "version": str(revision)},
+        }
+    }
+
+
+class FakeManager(object):
+    def __init__(self, events):
+        """
+        Stands in for kube.Manager: a reconcile upgrades the redis release, which the watch
+        reports while the reconcile runs.
+        """
+        self.addons = {"redis": None}
+        self.events = events
+        self.controller = None
+
+    def changed(self):
+        return []
+
+    def reconcile(self, actions, done):
+        snapshot = state.ClusterState()
+        snapshot.release_changed("redis", "redis")
+        state._current = snapshot
+        for event, obj in self.events:
+            self.controller.changed_object("Secret", event, obj)
+        done.extend(actions)
+
+
+def make_controller(monkeypatch, events, deployed=2):
+    monkeypatch.setattr(state, "_current", None)
+    monkeypatch.setattr(
+        state.ClusterState,
+        "list_helm_releases",
+        lambda self: {("redis", "redis"): {"name": "redis", "revision": str(deployed)}},
+    )
+    manager = FakeManager(events)
+    config = SimpleNamespace(controller=schema.Controller())
+    serving = controller.Controller(SimpleNamespace(name="all"), "missing.yaml", manager, config)
+    manager.controller = serving
+    return serving
+
+
+def test_reconcile_does_not_enqueue_another(monkeypatch):
+    events = [
+        ("ADDED", release_secret("redis", "redis", 2, "pending-upgrade")),
+        ("MODIFIED", release_secret("redis", "redis", 2, "deployed")),
+        ("MODIFIED", release_secret("redis", "redis", 1, "superseded")),
+    ]
+    serving = make_controller(monkeypatch, events)
+    serving.reconcile({"redis": "upgrade"})
+    assert serving.queue.pending == {}
+    # the same events arriving late are ignored too
+    for event, obj in events:
+        serving.changed_object("Secret", event, obj)
+    assert serving.queue.pending == {}
+
+
+def test_external_changes_enqueue(monkeypatch):
+    serving = make_controller(monkeypatch, [])
+    serving.reconcile({"redis": "upgrade"})
+    serving.changed_object("Secret", "ADDED", release_secret("redis", "redis", 3, "deployed"))
+    assert serving.queue.pending == {"redis": "upgrade"}
+
+    serving = make_controller(monkeypatch, [])
+    serving.reconcile({"redis": "upgrade"})
+    serving.changed_object("Secret", "DELETED", release_secret("redis", "redis", 2, "deployed"))
+    assert serving.queue.pending == {"redis": "upgrade"}
+
+
+def owned_object(kind, name, writes, owner="redis"):
+    return {
+        "kind": kind,
+        "metadata": {
+            "name": name,
+            "labels": {bundle.OWNER_LABEL: owner},
+            "managedFields": [
+                dict({"manager": manager, "operation": "Apply", "time": time}, **extra)
+                for manager, time, extra in writes
+            ],
+        },
+    }
+
+
+def test_drift_of_raw_objects_enqueues(monkeypatch):
+    serving = make_controller(monkeypatch, [])
+    ours = ("addon-manager", "2024-01-01T00:00:00Z", {})
+    status = ("cert-manager", "2024-01-02T00:00:00Z", {"subresource": "status"})
+    edit = ("kubectl-edit", "2024-01-03T00:00:00Z", {})
+
+    serving.changed_object("Certificate", "MODIFIED", owned_object("Certificate", "a", [ours]))
+    serving.changed_object(
+        "Certificate", "MODIFIED", owned_object("Certificate", "a", [ours, status])
+    )
+    serving.changed_object("ClusterRole", "ADDED", owned_object("ClusterRole", "b", [ours]))
+    serving.changed_object("ClusterRole", "MODIFIED", owned_object("ClusterRole", "c", [ours], "x"))
+    assert serving.queue.pending == {}
+
+    serving.changed_object(
+        "ClusterRole", "MODIFIED", owned_object("ClusterRole", "b", [ours, edit])
+    )
+    assert serving.queue.pending == {"redis": "upgrade"}
+
+    serving = make_controller(monkeypatch, [])
+    serving.changed_object("PriorityClass", "DELETED", owned_object("PriorityClass", "d", [ours]))
+    assert serving.queue.pending == {"redis": "upgrade"}
+
+
+def test_reload_applies_the_controller_settings(monkeypatch):
+    serving = make_controller(monkeypatch, [])
+    settings = schema.Controller(poll_interval=1, min_interval=30, max_backoff=60)
+    reloaded = SimpleNamespace(controller=settings, helm=schema.Helm())
+    monkeypatch.setattr(schema, "load", lambda path: reloaded)
+    monkeypatch.setattr(controller, "Manager", lambda args, config: FakeManager([]))
+    monkeypatch.setattr(controller.helm_repos, "sync", lambda repos, ttl: None)
+    serving.reload()
+    assert serving.settings is settings
+    assert (serving.queue.min_interval, serving.queue.max_backoff) == (30, 60)
@@ -0,0 +1,165 @@
+import pytest
+
+from bench.fakes import Counter, FakeAws, FakeAwsClient, FakeExceptions
+from manager import iam
+
+DOCUMENT = {"Version": "2012-10-17", "Statement": []}
+
+
+@pytest.fixture
+def account():
+    return FakeAws()
+
+
+@pytest.fixture
+def calls():
+    return Counter()
+
+
+class FakeClock(object):
+    def __init__(self):
+        """
+        Stands in for the time module of manager.iam, sleeping only moves the clock forward.
+        """
+        self.now = 0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(iam, "time", clock)
+    return clock.sleeps
+
+
+def make_iam(account, calls):
+    return iam.Iam(
+        FakeAwsClient("iam", calls, state=account),
+        FakeAwsClient("sts", calls, state=account),
+        FakeAwsClient("eks", calls, state=account),
+    )
+
+
+def test_account_id_is_cached(account, calls):
+    layer = make_iam(account, calls)
+    assert layer.account_id() == account.account
+    assert layer.policy_arn("a") == f"arn:aws:iam::{account.account}:policy/a"
+    assert calls.calls["sts get_caller_identity"] == 1
+
+
+def test_ensure_policy_creates_and_waits(account, calls):
+    arn = make_iam(account, calls).ensure_policy("autoscaler", DOCUMENT)
+    assert arn in account.policies
+    assert calls.calls["iam create_policy"] == 1
+    # one lookup before the create, one by the policy_exists waiter
+    assert calls.calls["iam get_policy"] == 2
+
+
+def test_ensure_policy_leaves_an_existing_policy(account, calls):
+    account.create_policy(PolicyName="autoscaler", PolicyDocument="{}")
+    arn = make_iam(account, calls).ensure_policy("autoscaler", DOCUMENT)
+    assert arn == f"arn:aws:iam::{account.account}:policy/autoscaler"
+    assert "iam create_policy" not in calls.calls
+
+
+def test_delete_policy_cleans_up_versions(account, calls, sleeps):
+    arn = account.create_policy(PolicyName="autoscaler", PolicyDocument="{}")["Policy"]["Arn"]
+    account.policies[arn]["Versions"].append({"VersionId": "v2", "IsDefaultVersion": False})
+    make_iam(account, calls).delete_policy("autoscaler")
+    assert arn not in account.policies
+    assert calls.calls["iam delete_policy_version"] == 1
+    assert sleeps == []
+
+
+def test_delete_policy_backs_off_until_detached(account, calls, sleeps, monkeypatch):
+    layer = make_iam(account, calls)
+    arn = layer.ensure_policy("autoscaler", DOCUMENT)
+    account.create_role(RoleName="role", AssumeRolePolicyDocument="{}")
+    account.attach_role_policy(RoleName="role", PolicyArn=arn)
+    conflicts = []
+    delete = account.delete_policy
+    sleep = iam.time.sleep
+
+    def detach(delay):
+        sleep(delay)
+        if len(sleeps) == 2:
+            account.detach_role_policy(RoleName="role", PolicyArn=arn)
+
+    def delete_policy(PolicyArn):
+        # the first delete after the detach doesn't see it yet
+        if not conflicts:
+            conflicts.append(PolicyArn)
+            raise FakeExceptions.DeleteConflictException(PolicyArn)
+        return delete(PolicyArn=PolicyArn)
+
+    monkeypatch.setattr(iam.time, "sleep", detach)
+    monkeypatch.setattr(account, "delete_policy", delete_policy)
+    layer.delete_policy("autoscaler", backoff=1)
+    assert arn not in account.policies
+    assert conflicts == [arn]
+    assert sleeps == [1, 2, 4]
+
+
+def test_delete_policy_gives_up_while_attached(account, calls, sleeps):
+    layer = make_iam(account, calls)
+    arn = layer.ensure_policy("autoscaler", DOCUMENT)
+    account.create_role(RoleName="role", AssumeRolePolicyDocument="{}")
+    account.attach_role_policy(RoleName="role", PolicyArn=arn)
+    with pytest.raises(iam.PolicyAttached):
+        layer.delete_policy("autoscaler", timeout=10, backoff=1)
+    assert sleeps == [1, 2, 4]
+    assert arn in account.policies
+
+
+def test_delete_policy_of_a_missing_policy(account, calls):
+    make_iam(account, calls).delete_policy("missing")
+    assert "iam delete_policy" not in calls.calls
+
+
+def test_ensure_and_delete_role(account, calls):
+    layer = make_iam(account, calls)
+    policy = layer.ensure_policy("autoscaler", DOCUMENT)
+    trust = layer.service_account_trust("prod", "cluster-autoscaler", "cluster-autoscaler")
+    arn = layer.ensure_role("prod-autoscaler", trust, [policy])
+    assert arn == f"arn:aws:iam::{account.account}:role/prod-autoscaler"
+    assert account.roles["prod-autoscaler"]["Policies"] == [policy]
+    assert account.policies[policy]["AttachmentCount"] == 1
+
+    # an existing role gets its trust policy updated, the attached policy isn't attached twice
+    assert layer.ensure_role("prod-autoscaler", trust, [policy]) == arn
+    assert calls.calls["iam create_role"] == 1
+    assert calls.calls["iam update_assume_role_policy"] == 1
+    assert account.policies[policy]["AttachmentCount"] == 1
+
+    layer.delete_role("prod-autoscaler")
+    assert "prod-autoscaler" not in account.roles
+    assert account.policies[policy]["AttachmentCount"] == 0
+    layer.delete_role("prod-autoscaler")
+
+
+def test_oidc_provider_is_looked_up_once_per_cluster(account, calls):
+    layer = make_iam(account, calls)
+    for cluster in ["prod", "dev", "prod"]:
+        trust = layer.service_account_trust(cluster, "kube-system", "autoscaler")
+    statement = trust["Statement"][0]
+    issuer = "oidc.eks.us-west-2.amazonaws.com/id/PROD"
+    assert statement["Principal"]["Federated"].endswith(f":oidc-provider/{issuer}")
+    assert statement["Condition"]["StringEquals"][f"{issuer}:sub"] == (
+        "system:serviceaccount:kube-system:autoscaler"
+    )
+    assert calls.calls["eks describe_cluster"] == 2
+    assert calls.calls["iam get_open_id_connect_provider"] == 2
+
+
+def test_role_name_is_cut_and_hashed():
+    name = "x" * 80
+    assert len(iam.role_name(name)) == iam.ROLE_NAME_LENGTH
+    assert iam.role_name(name) != iam.role_name("x" * 81)
+    assert iam.role_name("short") == "short"